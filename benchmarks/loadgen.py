@@ -0,0 +1,227 @@
+import math
+import multiprocessing
+import os
+import selectors
+import socket
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Add src to path for the response framer
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from http_parser import ResponseFramer
+
+# Seconds requests still in flight at the end of a run may take
+DRAIN_TIMEOUT = 10
+
+
+@dataclass
+class RequestFactory:
+    """
+    Builds proxied GET requests for `path` on the origin. With unique,
+    every request gets its own query string (and so its own cache key).
+    With origin_form, requests are written as to the origin itself, for
+    sending through a tunnel.
+    """
+
+    origin: str
+    path: str
+    unique: bool = False
+    origin_form: bool = False
+
+    def __call__(self, sequence: int) -> bytes:
+        path = f"{self.path}?n={sequence}" if self.unique else self.path
+        target = path if self.origin_form else f"http://{self.origin}{path}"
+        return (
+            f"GET {target} HTTP/1.1\r\nHost: {self.origin}\r\n\r\n"
+        ).encode()
+
+
+@dataclass
+class LoadResult:
+    """
+    What one or more load generator processes measured.
+    """
+
+    # Seconds each successful request took, send to last response byte
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+    # Response bytes received, heads included
+    bytes_received: int = 0
+
+    def merge(self, other: "LoadResult") -> None:
+        self.latencies += other.latencies
+        self.errors += other.errors
+        self.bytes_received += other.bytes_received
+
+
+@dataclass
+class ClientConnection:
+    sock: socket.socket
+    # CONNECT request still to be answered before requests can be sent
+    tunnel_request: Optional[bytes] = None
+    tunnel_reply: bytearray = field(default_factory=bytearray)
+    outgoing: bytes = b""
+    framer: Optional[ResponseFramer] = None
+    started: float = 0.0
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of samples (which it sorts in place).
+    """
+    if not samples:
+        return 0.0
+    samples.sort()
+    rank = max(1, min(len(samples), math.ceil(fraction * len(samples))))
+    return samples[rank - 1]
+
+
+def _generate(
+    address: tuple[str, int],
+    make_request: RequestFactory,
+    connections: int,
+    duration: float,
+    tunnel_to: Optional[str],
+    first: int = 0,
+    step: int = 1,
+) -> LoadResult:
+    """
+    Keep `connections` keep-alive connections to address busy with one
+    request each for `duration` seconds, from a single event loop. With
+    tunnel_to ("host:port"), each connection first opens a CONNECT
+    tunnel and sends its requests through it. Requests are numbered
+    first, first + step, ...
+    """
+    selector = selectors.DefaultSelector()
+    result = LoadResult()
+    sequence = first
+
+    def next_request(conn: ClientConnection) -> None:
+        nonlocal sequence
+        conn.outgoing = make_request(sequence)
+        sequence += step
+        conn.framer = ResponseFramer()
+        conn.started = time.perf_counter()
+        selector.modify(conn.sock, selectors.EVENT_WRITE, conn)
+
+    def open_connection() -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        sock.connect_ex(address)
+        conn = ClientConnection(sock)
+        selector.register(sock, selectors.EVENT_WRITE, conn)
+        if tunnel_to is not None:
+            conn.tunnel_request = (
+                f"CONNECT {tunnel_to} HTTP/1.1\r\n"
+                f"Host: {tunnel_to}\r\n\r\n"
+            ).encode()
+            conn.outgoing = conn.tunnel_request
+        else:
+            next_request(conn)
+
+    def reopen(conn: ClientConnection, failed: bool) -> None:
+        if failed:
+            result.errors += 1
+        selector.unregister(conn.sock)
+        conn.sock.close()
+        if time.perf_counter() < deadline:
+            open_connection()
+
+    deadline = time.perf_counter() + duration
+    for _ in range(connections):
+        open_connection()
+    while selector.get_map():
+        if time.perf_counter() > deadline + DRAIN_TIMEOUT:
+            for key in list(selector.get_map().values()):
+                result.errors += 1
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+            break
+        for key, mask in selector.select(timeout=1):
+            conn = key.data
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    sent = conn.sock.send(conn.outgoing)
+                    conn.outgoing = conn.outgoing[sent:]
+                    if not conn.outgoing:
+                        selector.modify(conn.sock, selectors.EVENT_READ, conn)
+                    continue
+                data = conn.sock.recv(262144)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                reopen(conn, failed=True)
+                continue
+            if not data:
+                reopen(conn, failed=True)
+                continue
+            result.bytes_received += len(data)
+            if conn.tunnel_request is not None:
+                conn.tunnel_reply += data
+                if b"\r\n\r\n" not in conn.tunnel_reply:
+                    continue
+                if not conn.tunnel_reply.startswith(b"HTTP/1.1 200"):
+                    reopen(conn, failed=True)
+                    continue
+                conn.tunnel_request = None
+                next_request(conn)
+                continue
+            conn.framer.feed(data)
+            if not conn.framer.complete:
+                continue
+            if conn.framer.status == 200:
+                result.latencies.append(time.perf_counter() - conn.started)
+            else:
+                result.errors += 1
+            if time.perf_counter() >= deadline:
+                selector.unregister(conn.sock)
+                conn.sock.close()
+            elif conn.framer.keep_alive:
+                next_request(conn)
+            else:
+                reopen(conn, failed=False)
+    selector.close()
+    return result
+
+
+def _generate_into(queue, *args) -> None:
+    queue.put(_generate(*args))
+
+
+def run_load(
+    address: tuple[str, int],
+    make_request: RequestFactory,
+    concurrency: int,
+    duration: float,
+    processes: int = 1,
+    tunnel_to: Optional[str] = None,
+) -> LoadResult:
+    """
+    Drive address with `concurrency` connections spread over `processes`
+    generator processes for `duration` seconds. Request sequence numbers
+    are unique across the processes.
+    """
+    processes = max(1, min(processes, concurrency))
+    queue = multiprocessing.Queue()
+    workers = []
+    for i in range(processes):
+        share = concurrency // processes + (i < concurrency % processes)
+        worker = multiprocessing.Process(
+            target=_generate_into,
+            args=(
+                queue, address, make_request, share, duration, tunnel_to,
+                i, processes,
+            ),
+        )
+        worker.start()
+        workers.append(worker)
+    result = LoadResult()
+    for _ in workers:
+        result.merge(queue.get(timeout=duration + 60))
+    for worker in workers:
+        worker.join()
+    return result
@@ -0,0 +1,77 @@
+import argparse
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class BenchmarkOrigin(BaseHTTPRequestHandler):
+    """
+    Origin stand-in: GET /size/N[?anything] answers N bytes after the
+    server's latency. Query strings only make URLs unique, so that
+    cache-miss scenarios can ask for the same object under new keys.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # The head and body are separate writes; without TCP_NODELAY the body
+    # waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+    latency = 0.0
+    keep_alive = True
+    _bodies = {}
+
+    def do_GET(self):
+        path = self.path
+        if "://" in path:
+            # Absolute form, as a proxy may forward it
+            path = "/" + path.split("://", 1)[1].partition("/")[2]
+        path = path.partition("?")[0]
+        if not path.startswith("/size/"):
+            self.send_error(404)
+            return
+        try:
+            size = int(path[len("/size/"):])
+        except ValueError:
+            self.send_error(400)
+            return
+        body = self._bodies.get(size)
+        if body is None:
+            body = self._bodies[size] = b"x" * size
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Content-Type", "application/octet-stream")
+        if not self.keep_alive:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve(port: int, latency_ms: float = 0, keep_alive: bool = True):
+    """
+    Run the origin on 127.0.0.1:port until the process is terminated.
+    """
+    BenchmarkOrigin.latency = latency_ms / 1000
+    BenchmarkOrigin.keep_alive = keep_alive
+    server = OriginServer(("127.0.0.1", port), BenchmarkOrigin)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark origin server")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--no-keep-alive", action="store_true")
+    args = parser.parse_args()
+    serve(args.port, args.latency_ms, not args.no_keep_alive)
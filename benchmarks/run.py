@@ -0,0 +1,328 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+from benchmarks.loadgen import RequestFactory, percentile, run_load
+from benchmarks.origin import serve
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SERVER = os.path.join(ROOT, "src", "server.py")
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: str
+    # Every request asks for a new URL, so every request is a miss
+    unique: bool = False
+    # Requests go through CONNECT tunnels instead of the cache
+    tunnel: bool = False
+    # Proxy settings the scenario runs with, under any given by --env
+    env: dict[str, str] = field(default_factory=dict)
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario("cache_hit", "/size/1024"),
+        Scenario("cache_miss", "/size/1024", unique=True),
+        Scenario("large_object", "/size/1048576"),
+        Scenario("connect_tunnel", "/size/1024", tunnel=True),
+    )
+}
+if hasattr(os, "sched_setaffinity"):
+    # cache_hit with each worker on its own CPU, taking the connections
+    # the kernel processes there; compare the two p99s
+    SCENARIOS["cache_hit_pinned"] = Scenario(
+        "cache_hit_pinned", "/size/1024", env={"CPU_AFFINITY": "auto"}
+    )
+
+
+def free_port() -> int:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def process_tree(pid: int) -> list[int]:
+    """
+    pid and all its descendants, from /proc (empty where there is none).
+    """
+    parents = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        parents.setdefault(int(fields[1]), []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(parents.get(parent, ()))
+    return tree
+
+
+def cpu_seconds(pids: list[int]) -> float:
+    """
+    User plus system CPU time used so far by pids.
+    """
+    ticks = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of stat(5)
+        ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def memory_bytes(pids: list[int]) -> dict[str, Optional[int]]:
+    """
+    Summed resident (RSS) and proportional (PSS) set sizes of pids. PSS
+    counts pages shared between workers, such as the shared cache, once.
+    """
+    rss = pss = 0
+    have_pss = True
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        pss += int(line.split()[1]) * 1024
+        except OSError:
+            have_pss = False
+    return {"rss_bytes": rss, "pss_bytes": pss if have_pss else None}
+
+
+def start_proxy(port: int, workers: int, env: dict[str, str]):
+    """
+    Start src/server.py as a separate process with its output discarded.
+    """
+    proxy_env = dict(os.environ)
+    proxy_env.update(
+        LISTEN_PORT=str(port), NUM_WORKERS=str(workers), ADMIN_PORT="0"
+    )
+    proxy_env.update(env)
+    proxy = subprocess.Popen(
+        [sys.executable, SERVER],
+        env=proxy_env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+    except OSError:
+        proxy.kill()
+        raise
+    return proxy
+
+
+def run_scenario(
+    scenario: Scenario,
+    origin_port: int,
+    workers: int,
+    concurrency: int,
+    duration: float,
+    clients: int = 1,
+    env: Optional[dict[str, str]] = None,
+) -> dict:
+    """
+    Measure one scenario against a freshly started proxy with `workers`
+    workers. Cacheable scenarios are warmed with one request first.
+    """
+    origin = f"127.0.0.1:{origin_port}"
+    port = free_port()
+    proxy = start_proxy(port, workers, {**scenario.env, **(env or {})})
+    try:
+        address = ("127.0.0.1", port)
+        requests = RequestFactory(
+            origin, scenario.path, scenario.unique, scenario.tunnel
+        )
+        tunnel_to = origin if scenario.tunnel else None
+        if not scenario.unique and not scenario.tunnel:
+            run_load(address, requests, 1, 0.01)
+        pids = process_tree(proxy.pid)
+        cpu_before = cpu_seconds(pids)
+        started = time.perf_counter()
+        result = run_load(
+            address, requests, concurrency, duration, clients, tunnel_to
+        )
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(pids) - cpu_before
+        memory = memory_bytes(pids)
+    finally:
+        proxy.terminate()
+        proxy.wait(timeout=10)
+
+    latencies = result.latencies
+    count = len(latencies)
+    return {
+        "scenario": scenario.name,
+        "workers": workers,
+        "concurrency": concurrency,
+        "duration_s": round(elapsed, 3),
+        "requests": count,
+        "errors": result.errors,
+        "rps": round(count / elapsed, 1),
+        "received_bytes_per_s": round(result.bytes_received / elapsed),
+        "latency_ms": {
+            "mean": round(sum(latencies) / count * 1000, 3) if count else 0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "p999": round(percentile(latencies, 0.999) * 1000, 3),
+            "max": round(max(latencies, default=0) * 1000, 3),
+        },
+        "cpu_seconds": round(cpu, 3),
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+        **memory,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Load-test the proxy against a local origin; prints "
+        "one JSON report"
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help="comma-separated subset of: " + ", ".join(SCENARIOS),
+    )
+    parser.add_argument(
+        "--workers",
+        default=",".join(sorted({"1", str(multiprocessing.cpu_count())})),
+        help="comma-separated NUM_WORKERS values to run each scenario with",
+    )
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=min(4, multiprocessing.cpu_count()),
+        help="load generator processes",
+    )
+    parser.add_argument("--origin-latency-ms", type=float, default=0)
+    parser.add_argument("--origin-no-keep-alive", action="store_true")
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="extra proxy environment, e.g. CACHE_BACKEND=local",
+    )
+    parser.add_argument("--output", help="also write the report here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    scenarios = [SCENARIOS[name] for name in args.scenarios.split(",")]
+    worker_counts = [int(count) for count in args.workers.split(",")]
+    env = dict(item.split("=", 1) for item in args.env)
+
+    origin_port = free_port()
+    origin = multiprocessing.Process(
+        target=serve,
+        args=(
+            origin_port, args.origin_latency_ms, not args.origin_no_keep_alive
+        ),
+        daemon=True,
+    )
+    origin.start()
+    results = []
+    try:
+        wait_for_port(origin_port)
+        for scenario in scenarios:
+            for workers in worker_counts:
+                print(
+                    f"Running {scenario.name} with {workers} workers...",
+                    file=sys.stderr,
+                )
+                results.append(
+                    run_scenario(
+                        scenario,
+                        origin_port,
+                        workers,
+                        args.concurrency,
+                        args.duration,
+                        args.clients,
+                        env,
+                    )
+                )
+    finally:
+        origin.terminate()
+        origin.join()
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "origin_latency_ms": args.origin_latency_ms,
+            "origin_keep_alive": not args.origin_no_keep_alive,
+            "clients": args.clients,
+            "env": env,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
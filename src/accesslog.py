@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+from typing import TYPE_CHECKING
+from logwriter import BackgroundWriter
+
+if TYPE_CHECKING:
+    from datastructures import RequestLog
+
+# (name, start, end) of each phase reported: RequestLog timestamp names,
+# or a tuple of names meaning the first of them that is set
+PHASES = (
+    ("wait", "accepted", "received"),
+    ("parse", "received", "parsed"),
+    ("dns", "resolving", "resolved"),
+    ("connect", "connecting", "connected"),
+    ("send", ("connected", "resolved", "parsed"), "sent"),
+    ("ttfb", "sent", "first_byte"),
+    ("transfer", "first_byte", "upstream_done"),
+    ("write", ("upstream_done", "first_byte", "parsed"), "finished"),
+)
+
+
+def _timestamp(log: "RequestLog", names) -> float:
+    if isinstance(names, str):
+        return getattr(log, names)
+    for name in names:
+        value = getattr(log, name)
+        if value:
+            return value
+    return 0.0
+
+
+def format_access_line(address: tuple[str, int], log: "RequestLog") -> str:
+    """
+    One access log line: client, request line, status, bytes sent, cache
+    outcome, total time from the request's first byte, then the time
+    spent in each phase the request went through. Times are in
+    milliseconds; phases that did not happen are "-".
+    """
+    phases = []
+    for name, start, end in PHASES:
+        started, ended = _timestamp(log, start), getattr(log, end)
+        if started and ended:
+            phases.append(f"{name}={(ended - started) * 1000:.3f}")
+        else:
+            phases.append(f"{name}=-")
+    begin = log.received or log.parsed
+    total = (log.finished - begin) * 1000 if begin and log.finished else 0
+    status = log.status or "-"
+    return (
+        f"{address[0]}:{address[1]} "
+        f'{time.strftime("[%d/%b/%Y:%H:%M:%S %z]")} '
+        f'"{log.request_line}" {status} {log.bytes_sent} '
+        f"cache={log.cache} total={total:.3f} {' '.join(phases)}\n"
+    )
+
+
+class AccessLog:
+    """
+    A worker's access log: a line per request, formatted and appended by
+    a BackgroundWriter off the event loop.
+    """
+
+    def __init__(self, path: str):
+        if path == "-":
+            self._fd = sys.stdout.fileno()
+            self._owned = False
+        else:
+            self._fd = os.open(
+                path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            self._owned = True
+        self._writer = BackgroundWriter(
+            self._fd, lambda entry: format_access_line(*entry)
+        )
+
+    def write(self, address: tuple[str, int], log: "RequestLog") -> None:
+        """
+        Queue a line for a finished request. log must not change after
+        this; connections start a new RequestLog for their next request.
+        """
+        self._writer.submit((address, log))
+
+    def flush(self) -> None:
+        self._writer.flush()
+
+    def close(self) -> None:
+        self._writer.close()
+        if self._owned:
+            os.close(self._fd)
@@ -0,0 +1,52 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from metrics import MetricsRegion
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+log = logging.getLogger(__name__)
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    """
+    Serves GET /metrics from the server's MetricsRegion.
+    """
+
+    server: "AdminServer"
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AdminServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], metrics: MetricsRegion):
+        super().__init__(address, AdminHandler)
+        self.metrics = metrics
+
+
+def start_admin_server(
+    address: str, port: int, metrics: MetricsRegion
+) -> AdminServer:
+    """
+    Serve the metrics endpoint from a background thread of the calling
+    (master) process. Stop it with shutdown() and server_close().
+    """
+    server = AdminServer((address, port), metrics)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    log.info("Metrics available at http://%s:%d/metrics", address, port)
+    return server
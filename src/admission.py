@@ -0,0 +1,110 @@
+from typing import Optional
+from shared_cache import AVERAGE_OBJECT_SIZE
+
+CACHE_POLICIES = ("lru", "tinylfu")
+
+# Counters saturate here, as TinyLFU's 4-bit counters do
+MAX_COUNT = 15
+# Multipliers hashing a key to one counter per row of the sketch
+ROW_SEEDS = (
+    0x9E3779B97F4A7C15,
+    0xC2B2AE3D27D4EB4F,
+    0x165667B19E3779F9,
+    0xD6E8FEB86659FD93,
+)
+# Halves every counter in a single bytes.translate() pass
+_HALVE = bytes(count >> 1 for count in range(256))
+
+
+class FrequencySketch:
+    """
+    Count-min sketch estimating how often keys have been seen recently.
+
+    One row of byte counters per seed; a key's estimate is the smallest
+    of its counters, so hash collisions only ever overestimate.
+    Increments only raise the key's smallest counters (conservative
+    update). After 10 * width increments every counter is halved, so
+    keys that were popular once fade unless they keep being seen.
+
+    Keys are hashed with hash(), which is salted per process: a sketch
+    is private to its worker.
+    """
+
+    def __init__(self, width: int):
+        bits = max(4, (width - 1).bit_length())
+        self.width = 1 << bits
+        self._shift = 64 - bits
+        self._counters = bytearray(len(ROW_SEEDS) * self.width)
+        self.sample_size = 10 * self.width
+        self.additions = 0
+        self.resets = 0
+
+    def _indexes(self, key: str) -> list[int]:
+        key_hash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return [
+            row * self.width
+            + (((key_hash * seed) & 0xFFFFFFFFFFFFFFFF) >> self._shift)
+            for row, seed in enumerate(ROW_SEEDS)
+        ]
+
+    def estimate(self, key: str) -> int:
+        counters = self._counters
+        return min(counters[i] for i in self._indexes(key))
+
+    def increment(self, key: str) -> None:
+        counters = self._counters
+        indexes = self._indexes(key)
+        smallest = min(counters[i] for i in indexes)
+        if smallest < MAX_COUNT:
+            for i in indexes:
+                if counters[i] == smallest:
+                    counters[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def reset(self) -> None:
+        """
+        Age the sketch by halving every counter.
+        """
+        self._counters = bytearray(self._counters.translate(_HALVE))
+        self.additions //= 2
+        self.resets += 1
+
+
+class TinyLFU:
+    """
+    Cache admission policy: a new entry is only stored if the sketch
+    estimates it to be more popular than every entry it would evict, so
+    a scan of one-off URLs cannot flush the cache.
+
+    The cache calls record() on every lookup and admit() when storing an
+    entry would evict others. admitted / rejected count those decisions.
+    """
+
+    def __init__(self, capacity: int):
+        self.sketch = FrequencySketch(capacity)
+        self.admitted = 0
+        self.rejected = 0
+
+    def record(self, key: str) -> None:
+        self.sketch.increment(key)
+
+    def admit(self, key: str, victims: list[str]) -> bool:
+        frequency = self.sketch.estimate(key)
+        for victim in victims:
+            if self.sketch.estimate(victim) >= frequency:
+                self.rejected += 1
+                return False
+        self.admitted += 1
+        return True
+
+
+def make_admission(policy: str, max_bytes: int) -> Optional[TinyLFU]:
+    """
+    Build the admission policy for a cache of max_bytes; None for plain
+    LRU, which admits everything.
+    """
+    if policy == "tinylfu":
+        return TinyLFU(max(1, max_bytes // AVERAGE_OBJECT_SIZE))
+    return None
@@ -0,0 +1,64 @@
+import logging
+import os
+import socket
+
+# Linux's value, for Python builds that do not define the constant
+SO_INCOMING_CPU = getattr(socket, "SO_INCOMING_CPU", 49)
+
+AFFINITY_SUPPORTED = hasattr(os, "sched_setaffinity")
+
+log = logging.getLogger(__name__)
+
+
+def parse_cpu_list(text: str) -> list[int]:
+    """
+    CPU numbers from a list like "0-3,8,10-11", in the order given.
+    """
+    cpus = []
+    for part in text.split(","):
+        first, sep, last = part.strip().partition("-")
+        try:
+            start = int(first)
+            end = int(last) if sep else start
+        except ValueError:
+            raise ValueError(f"invalid CPU list {text!r}") from None
+        if start < 0 or end < start:
+            raise ValueError(f"invalid CPU range {part.strip()!r}")
+        cpus.extend(range(start, end + 1))
+    return cpus
+
+
+def affinity_cpus(setting: str) -> list[int]:
+    """
+    The CPUs a cpu_affinity setting pins workers to: none for "", every
+    CPU this process may run on for "auto", else the listed ones.
+    """
+    if not setting:
+        return []
+    if setting == "auto":
+        return sorted(os.sched_getaffinity(0))
+    return parse_cpu_list(setting)
+
+
+def pin_to_cpu(cpu: int) -> bool:
+    """
+    Keep the calling process on `cpu`. Returns False (leaving it to the
+    scheduler) if that CPU is not available to it.
+    """
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except OSError as e:
+        log.warning("Cannot pin to CPU %d: %s", cpu, e)
+        return False
+    return True
+
+
+def set_incoming_cpu(sock: socket.socket, cpu: int) -> None:
+    """
+    Prefer sock, among the SO_REUSEPORT sockets on its port, for
+    connections whose packets the kernel processes on `cpu`.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, cpu)
+    except OSError as e:
+        log.warning("Cannot set SO_INCOMING_CPU: %s", e)
@@ -0,0 +1,896 @@
+import asyncio
+import logging
+import multiprocessing.synchronize
+import socket
+import time
+from collections import deque
+from typing import Optional
+from affinity import pin_to_cpu
+from datastructures import Connection, ProxyConfig, RequestLog, WorkerContext
+from freshness import (
+    primary_key,
+    request_cacheable,
+    request_wants_validation,
+    response_ttl,
+    variant_key,
+    vary_names,
+)
+from http_parser import (
+    Request,
+    RequestError,
+    RequestParser,
+    ResponseFramer,
+    build_cache_key,
+    build_http_response,
+    prepare_upstream_request,
+    rewrite_response_head,
+)
+from logwriter import configure_logging
+from metrics import MetricsRegion
+from profiling import WorkerProfiler
+from shared_cache import SharedResponseCache
+from tunnel import ESTABLISHED_RESPONSE, parse_host_port
+from worker import (
+    DRAIN_SIGNAL,
+    IDEMPOTENT_METHODS,
+    METRICS_INTERVAL,
+    OVERLOAD_RESPONSE,
+    RESPONSE_BUFFER_SIZE,
+    cached_response_head,
+    client_response_head,
+    collect_response,
+    create_context,
+    discard_response,
+    log_cache_stats,
+    open_listen_socket,
+    publish_cache_stats,
+    read_cached_head,
+    store_response,
+)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+log = logging.getLogger(__name__)
+
+
+class UpstreamProtocol(asyncio.Protocol):
+    """
+    An upstream connection carrying proxied requests. Received bytes are
+    handed to the task reading the response; the origin is paused once
+    RESPONSE_BUFFER_SIZE bytes are waiting for it.
+    """
+
+    def __init__(self):
+        self.transport: Optional[asyncio.Transport] = None
+        self.chunks: deque = deque()
+        self.buffered = 0
+        self.closed = False
+        self.error: Optional[Exception] = None
+        self._waiter: Optional[asyncio.Future] = None
+
+    @property
+    def reusable(self) -> bool:
+        """
+        Whether an idle connection can carry another request: the origin
+        has neither closed it nor sent anything unsolicited.
+        """
+        return not self.closed and not self.chunks
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= RESPONSE_BUFFER_SIZE:
+            self.transport.pause_reading()
+        self._wake()
+
+    def eof_received(self) -> bool:
+        self.closed = True
+        self._wake()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.closed = True
+        self.error = exc
+        self._wake()
+
+    def _wake(self) -> None:
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def read(self) -> bytes:
+        """
+        The next bytes received, or b"" once the origin has closed.
+        """
+        while not self.chunks:
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                return b""
+            self._waiter = asyncio.get_running_loop().create_future()
+            await self._waiter
+            self._waiter = None
+        data = self.chunks.popleft()
+        self.buffered -= len(data)
+        if self.buffered < RESPONSE_BUFFER_SIZE and not self.closed:
+            self.transport.resume_reading()
+        return data
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+
+    def close(self) -> None:
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+
+class TunnelProtocol(asyncio.Protocol):
+    """
+    The upstream side of a CONNECT tunnel: bytes are relayed to the
+    client as they arrive, and each side stops being read while the
+    other cannot take more.
+    """
+
+    def __init__(self, client: "ClientProtocol"):
+        self.client = client
+        self.transport: Optional[asyncio.Transport] = None
+        self.to_client = 0
+        self.to_upstream = 0
+        self.eof = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        self.to_client += len(data)
+        self.client.transport.write(data)
+        self.client.set_timeout(self.client.ctx.config.tunnel_idle_timeout)
+
+    def eof_received(self) -> bool:
+        self.eof = True
+        if self.client.tunnel_eof:
+            self.client.transport.close()
+            return False
+        self.client.transport.write_eof()
+        return True
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.client.transport.close()
+        self.client.end_tunnel()
+
+    def pause_writing(self) -> None:
+        self.client.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.client.transport.resume_reading()
+
+
+def upstream_reusable(upstream: UpstreamProtocol) -> bool:
+    return upstream.reusable
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    A client connection. Requests are parsed as bytes arrive and are
+    answered in order, one at a time, by a task of the connection's own;
+    reading pauses while one is answered, so pipelined bytes wait in the
+    kernel rather than the parser.
+    """
+
+    def __init__(self, ctx: WorkerContext, clients: set):
+        self.ctx = ctx
+        self.clients = clients
+        self.transport: Optional[asyncio.Transport] = None
+        self.address: Optional[tuple[str, int]] = None
+        self.parser = RequestParser(
+            ctx.config.max_header_size, ctx.config.max_body_size
+        )
+        self.log = RequestLog(accepted=time.monotonic())
+        self.task: Optional[asyncio.Task] = None
+        # Requests received so far
+        self.requests = 0
+        self.closed = False
+        # Turned away past max_connections
+        self.shed = False
+        self.tunnel: Optional[TunnelProtocol] = None
+        self.tunnel_eof = False
+        self._paused = False
+        self._drain_waiter: Optional[asyncio.Future] = None
+        # What set_timeout last asked for (0 for nothing) and the loop
+        # timer checking it, which may be due earlier
+        self._deadline = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Deadline of the response's first byte while forwarding a
+        # request
+        self.upstream_deadline: Optional[asyncio.Timeout] = None
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        if len(self.clients) >= self.ctx.config.max_connections:
+            self.shed = True
+            self.ctx.metrics.add("proxy_connections_shed_total")
+            transport.write(OVERLOAD_RESPONSE)
+            transport.close()
+            return
+        # asyncio only disables Nagle on sockets made with IPPROTO_TCP,
+        # which the listening socket is not
+        transport.get_extra_info("socket").setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
+        self.clients.add(self)
+        self.ctx.metrics.add("proxy_connections_total")
+        self.ctx.metrics.add("proxy_active_connections")
+        self.set_timeout(self.ctx.config.client_header_timeout)
+
+    def data_received(self, data: bytes) -> None:
+        if self.tunnel is not None:
+            self.tunnel.to_upstream += len(data)
+            self.tunnel.transport.write(data)
+            self.set_timeout(self.ctx.config.tunnel_idle_timeout)
+            return
+        if not self.log.received:
+            self.log.received = time.monotonic()
+            self.set_timeout(self.ctx.config.client_header_timeout)
+        self.parser.feed(data)
+        if self.ctx.debug:
+            log.debug("Received %d bytes from client", len(data))
+        self.ctx.metrics.add(
+            'proxy_client_bytes_total{direction="received"}', len(data)
+        )
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.serve())
+
+    def eof_received(self) -> bool:
+        if self.tunnel is None:
+            return False
+        self.tunnel_eof = True
+        if self.tunnel.eof:
+            self.tunnel.transport.close()
+            return False
+        self.tunnel.transport.write_eof()
+        return True
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.closed = True
+        if self.shed:
+            return
+        self.clients.discard(self)
+        self.ctx.metrics.add("proxy_active_connections", -1)
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+        if self.task is not None:
+            self.task.cancel()
+        if self.tunnel is not None:
+            self.tunnel.transport.close()
+
+    @property
+    def idle(self) -> bool:
+        """
+        Kept alive between requests, with nothing of the next one yet.
+        """
+        return (
+            self.requests > 0
+            and (self.task is None or self.task.done())
+            and self.tunnel is None
+            and not self.log.received
+        )
+
+    def set_timeout(self, seconds: int) -> None:
+        """
+        Give up on the connection (see timed_out) `seconds` from now
+        unless the timeout is set again or cleared first; 0 clears it.
+        """
+        if not seconds:
+            self._deadline = 0.0
+            return
+        self._deadline = time.monotonic() + seconds
+        if self._timer is not None:
+            if self._timer.when() <= self._deadline:
+                # Checked then, and pushed back if need be
+                return
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_at(
+            self._deadline, self._check_timeout
+        )
+
+    def _check_timeout(self) -> None:
+        self._timer = None
+        if not self._deadline or self.closed:
+            return
+        if time.monotonic() < self._deadline:
+            self._timer = asyncio.get_running_loop().call_at(
+                self._deadline, self._check_timeout
+            )
+            return
+        self._deadline = 0.0
+        self.timed_out()
+
+    def timed_out(self) -> None:
+        """
+        handle_timeout of the selectors engine for the client side: an
+        idle tunnel or client is closed, and a client that has not sent
+        a complete request gets a 408 first. Origins that do not answer
+        in time are handled by forward_request.
+        """
+        ctx = self.ctx
+        if self.tunnel is not None:
+            ctx.metrics.add('proxy_timeouts_total{phase="tunnel"}')
+            log.info("Closing idle tunnel")
+        elif self.log.received:
+            ctx.metrics.add('proxy_timeouts_total{phase="request"}')
+            log.info("Client timed out sending a request")
+            self.respond_with_error(
+                Connection(socket=None, address=self.address), 408
+            )
+        else:
+            ctx.metrics.add('proxy_timeouts_total{phase="idle"}')
+        self.transport.close()
+
+    def pause_writing(self) -> None:
+        self._paused = True
+        if self.tunnel is not None:
+            self.tunnel.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self._paused = False
+        if self.tunnel is not None:
+            self.tunnel.transport.resume_reading()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def write(self, data: bytes) -> None:
+        self.transport.write(data)
+        self.log.bytes_sent += len(data)
+        self.ctx.metrics.add(
+            'proxy_client_bytes_total{direction="sent"}', len(data)
+        )
+
+    async def drain(self) -> None:
+        """
+        Wait until the client has taken most of what was written.
+        """
+        while self._paused and not self.closed:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            await self._drain_waiter
+        if self.closed:
+            raise ConnectionResetError("Client closed the connection")
+
+    async def serve(self) -> None:
+        """
+        Answer the complete requests buffered in the parser.
+        """
+        while not self.closed and self.tunnel is None:
+            try:
+                parsed = self.parser.next_request()
+            except RequestError as e:
+                log.info("Rejecting request: %s", e)
+                conn = Connection(socket=None, address=self.address)
+                self.respond_with_error(conn, e.status)
+                self.finish_response(conn)
+                return
+            if parsed is None:
+                self.transport.resume_reading()
+                return
+            self.transport.pause_reading()
+            self.set_timeout(0)
+            self.requests += 1
+            request, raw = parsed
+            conn = Connection(
+                socket=None, address=self.address, request=raw, log=self.log
+            )
+            try:
+                await self.process_request(conn, request)
+            except Exception as e:
+                log.warning("Error handling connection: %s", e)
+                self.transport.close()
+                return
+            if self.tunnel is not None:
+                return
+            self.finish_response(conn)
+
+    def finish_response(self, conn: Connection) -> None:
+        """
+        Log a request that has been answered, then close unless the
+        connection is kept alive for the next one.
+        """
+        self.log.finished = time.monotonic()
+        if self.ctx.access_log is not None:
+            self.ctx.access_log.write(self.address, self.log)
+        self.log = RequestLog(accepted=time.monotonic())
+        if not conn.client_keep_alive or self.ctx.draining:
+            self.transport.close()
+            self.closed = True
+        else:
+            self.set_timeout(self.ctx.config.keep_alive_timeout)
+
+    def respond_with_error(self, conn: Connection, status_code: int) -> None:
+        self.ctx.metrics.add("proxy_error_responses_total")
+        self.log.status = status_code
+        self.write(
+            build_http_response(
+                status_code,
+                {"Content-Length": "0", "Connection": "close"},
+                b"",
+            )
+        )
+        conn.client_keep_alive = False
+
+    async def process_request(
+        self, conn: Connection, request: Request
+    ) -> None:
+        """
+        process_request of the selectors engine. Expired entries are not
+        revalidated and concurrent misses are not collapsed here; both
+        simply go to the origin.
+        """
+        ctx = self.ctx
+        method = request.method
+        url = request.target
+        host_string = request.headers.get("host")
+        log.debug("Parsed request: %s %s (Host: %s)", method, url, host_string)
+        ctx.metrics.add("proxy_requests_total")
+        conn.log.parsed = time.monotonic()
+        conn.log.received = conn.log.received or conn.log.parsed
+        conn.log.request_line = f"{method} {url}"
+        if not host_string:
+            log.info("No Host header found")
+            self.respond_with_error(conn, 400)
+            return
+        conn.client_keep_alive = request.keep_alive and not ctx.draining
+
+        if method == "CONNECT":
+            await self.open_tunnel(conn, url)
+            return
+
+        conn.upstream_address = parse_host_port(host_string)
+        caching = ctx.cache is not None or ctx.disk_cache is not None
+        if method == "GET" and caching and request_cacheable(request.headers):
+            key = build_cache_key(method, url, host_string)
+            conn.request_headers = request.headers
+            conn.vary = ctx.vary.get(key) or ()
+            conn.cache_key = variant_key(key, conn.vary, request.headers)
+            if not request_wants_validation(
+                request.headers
+            ) and await self.serve_from_cache(conn):
+                return
+            conn.log.cache = "miss"
+            conn.cache_response = bytearray()
+        await self.forward_request(conn, method)
+
+    async def serve_from_cache(self, conn: Connection) -> bool:
+        """
+        Answer conn from the memory tier, else the disk tier, whose body
+        goes out by loop.sendfile. Returns False on a miss.
+        """
+        ctx = self.ctx
+        cached = None
+        if ctx.cache is not None:
+            cached = ctx.cache.get(conn.cache_key)
+        if cached is not None:
+            head_end = cached.find(b"\r\n\r\n") + 4
+            self.write(
+                cached_response_head(conn, bytes(cached[:head_end]))
+                + cached[head_end:]
+            )
+        else:
+            if ctx.disk_cache is None:
+                return False
+            hit = ctx.disk_cache.lookup(conn.cache_key)
+            if hit is None:
+                return False
+            cache_file, offset, length = hit
+            try:
+                head = read_cached_head(cache_file, offset, length)
+                self.write(cached_response_head(conn, head))
+                await self.drain()
+                sent = await asyncio.get_running_loop().sendfile(
+                    self.transport,
+                    cache_file,
+                    offset + len(head),
+                    length - len(head),
+                )
+            finally:
+                cache_file.close()
+            self.log.bytes_sent += sent
+            ctx.metrics.add('proxy_client_bytes_total{direction="sent"}', sent)
+        log.debug("Cache hit: %s", conn.cache_key)
+        conn.log.cache = "hit"
+        await self.drain()
+        return True
+
+    async def resolve(self, hostname: str) -> str:
+        """
+        Look hostname up with the worker's caching DNSResolver.
+        """
+        found = asyncio.get_running_loop().create_future()
+
+        def resolved(address: Optional[str], error: Optional[OSError]):
+            if found.done():
+                return
+            if error is not None:
+                found.set_exception(error)
+            else:
+                found.set_result(address)
+
+        self.log.resolving = time.monotonic()
+        self.ctx.resolver.resolve(hostname, resolved)
+        address = await found
+        self.log.resolved = time.monotonic()
+        return address
+
+    async def connect(self, conn: Connection, protocol_factory):
+        """
+        Open a new connection to conn.upstream_address, returning its
+        protocol.
+        """
+        hostname, port = conn.upstream_address
+        address = await self.resolve(hostname)
+        conn.log.connecting = time.monotonic()
+        _, protocol = await asyncio.get_running_loop().create_connection(
+            protocol_factory, address, port
+        )
+        conn.log.connected = time.monotonic()
+        self.ctx.metrics.observe(
+            "proxy_upstream_connect_seconds",
+            conn.log.connected - conn.log.connecting,
+        )
+        return protocol
+
+    async def forward_request(self, conn: Connection, method: str) -> None:
+        """
+        Relay conn's request to its origin and the response back. Errors
+        before the response has started, a malformed response head among
+        them, are answered with a 502 (504 if its first byte took longer
+        than upstream_timeout); after that, the client connection is
+        closed.
+        """
+        try:
+            async with asyncio.timeout(
+                self.ctx.config.upstream_timeout or None
+            ) as self.upstream_deadline:
+                await self.exchange(conn, method)
+        except TimeoutError:
+            discard_response(conn)
+            self.ctx.metrics.add('proxy_timeouts_total{phase="upstream"}')
+            log.warning("Timed out waiting for %s:%s", *conn.upstream_address)
+            self.respond_with_error(conn, 504)
+        except (OSError, ValueError) as e:
+            # ValueError: the response's framing is malformed
+            discard_response(conn)
+            if self.closed:
+                return
+            log.warning("Error handling upstream connection: %s", e)
+            if self.log.bytes_sent:
+                conn.client_keep_alive = False
+            else:
+                self.respond_with_error(conn, 502)
+
+    async def exchange(self, conn: Connection, method: str) -> None:
+        """
+        Send conn's request upstream, on a pooled connection if there is
+        one, and stream the response to the client. An idempotent
+        request on a pooled connection the origin had closed is resent
+        once on a new connection.
+        """
+        ctx = self.ctx
+        hostname, port = conn.upstream_address
+        conn.upstream_keep_alive = ctx.pool is not None
+        upstream = None
+        if conn.upstream_keep_alive:
+            upstream = ctx.pool.acquire(conn.upstream_address)
+        conn.upstream_reused = upstream is not None
+        while True:
+            conn.response_framer = ResponseFramer(method)
+            if upstream is None:
+                log.debug("Connecting to %s:%s", hostname, port)
+                upstream = await self.connect(conn, UpstreamProtocol)
+            else:
+                log.debug("Reusing connection to %s:%s", hostname, port)
+            try:
+                upstream.write(
+                    prepare_upstream_request(
+                        conn.request, conn.upstream_keep_alive
+                    )
+                )
+                conn.log.sent = time.monotonic()
+                await self.relay_response(conn, upstream)
+                return
+            except OSError:
+                upstream.close()
+                if (
+                    not conn.upstream_reused
+                    or conn.response_framer.received
+                    or method not in IDEMPOTENT_METHODS
+                ):
+                    raise
+                log.info("Pooled upstream connection was closed, retrying")
+                conn.upstream_reused = False
+                upstream = None
+            except BaseException:
+                # Cancelled by a client disconnect or a timeout
+                upstream.close()
+                discard_response(conn)
+                raise
+
+    async def relay_response(
+        self, conn: Connection, upstream: UpstreamProtocol
+    ) -> None:
+        """
+        Stream the response to conn's request from upstream to the client,
+        collecting it for the cache if it is cacheable, then release the
+        upstream connection.
+        """
+        ctx = self.ctx
+        framer = conn.response_framer
+        head: Optional[bytearray] = bytearray()
+        reusable = True
+        while not framer.complete:
+            data = await upstream.read()
+            if not data:
+                if head is not None:
+                    # Retried on a pooled connection if nothing came
+                    raise ConnectionResetError(
+                        "Upstream closed before responding"
+                    )
+                reusable = False
+                if framer.finish():
+                    break
+                log.warning("Upstream response was cut short")
+                discard_response(conn)
+                conn.client_keep_alive = False
+                upstream.close()
+                return
+            if not framer.received:
+                self.upstream_deadline.reschedule(None)
+                conn.log.first_byte = time.monotonic()
+                ctx.metrics.observe(
+                    "proxy_upstream_ttfb_seconds",
+                    conn.log.first_byte - conn.log.parsed,
+                )
+            used = framer.feed(data)
+            if used < len(data):
+                log.info("Ignoring bytes after the upstream response")
+                reusable = False
+            chunk = data[:used]
+            if ctx.debug:
+                log.debug("Received %d bytes from upstream", used)
+            if head is not None:
+                # Hold bytes back until the head can be rewritten
+                head += chunk
+                if not framer.headers_done:
+                    continue
+                head_size = framer.head_size
+                response_head = bytes(head[:head_size])
+                body = bytes(head[head_size:])
+                head = None
+                if conn.cache_response is not None:
+                    self.apply_cache_policy(conn, framer)
+                collect_response(
+                    conn, ctx, rewrite_response_head(response_head) + body
+                )
+                chunk = client_response_head(conn, response_head, framer)
+                chunk += body
+            else:
+                collect_response(conn, ctx, chunk)
+            self.write(chunk)
+            await self.drain()
+        conn.log.upstream_done = time.monotonic()
+        store_response(conn, ctx)
+        if (
+            reusable
+            and conn.upstream_keep_alive
+            and framer.keep_alive
+            and upstream.reusable
+        ):
+            ctx.pool.release(conn.upstream_address, upstream)
+        else:
+            upstream.close()
+
+    def apply_cache_policy(
+        self, conn: Connection, framer: ResponseFramer
+    ) -> None:
+        """
+        apply_cache_policy of the selectors engine, without followers to
+        move between variants.
+        """
+        ttl = None
+        if framer.status == 200:
+            ttl = response_ttl(framer.headers, self.ctx.config.cache_ttl)
+        names = vary_names(framer.headers)
+        if ttl is None or names is None:
+            conn.cache_response = None
+            return
+        conn.cache_ttl = ttl
+        if names != conn.vary:
+            key = primary_key(conn.cache_key)
+            self.ctx.vary.set(key, names)
+            conn.cache_key = variant_key(key, names, conn.request_headers)
+            conn.vary = names
+
+    async def open_tunnel(self, conn: Connection, url: str) -> None:
+        """
+        Connect a CONNECT tunnel; from then on, bytes are relayed by the
+        two protocols without a task.
+        """
+        ctx = self.ctx
+        conn.upstream_address = parse_host_port(url)
+        log.debug("Tunneling to %s:%s", *conn.upstream_address)
+        ctx.metrics.add("proxy_tunnels_total")
+        try:
+            async with asyncio.timeout(ctx.config.upstream_timeout or None):
+                tunnel = await self.connect(conn, lambda: TunnelProtocol(self))
+        except TimeoutError:
+            ctx.metrics.add('proxy_timeouts_total{phase="upstream"}')
+            log.warning("Timed out waiting for %s:%s", *conn.upstream_address)
+            self.respond_with_error(conn, 504)
+            self.finish_response(conn)
+            return
+        except OSError as e:
+            log.warning("Error connecting tunnel: %s", e)
+            self.respond_with_error(conn, 502)
+            self.finish_response(conn)
+            return
+        ctx.metrics.add("proxy_active_tunnels")
+        self.tunnel = tunnel
+        self.transport.resume_reading()
+        self.set_timeout(ctx.config.tunnel_idle_timeout)
+        self.transport.write(ESTABLISHED_RESPONSE)
+        log.debug("Tunnel established")
+        # Anything after the request already belongs to the tunnel
+        pending = self.parser.take_buffered()
+        if pending:
+            tunnel.to_upstream += len(pending)
+            tunnel.transport.write(pending)
+
+    def end_tunnel(self) -> None:
+        """
+        Account for a tunnel whose upstream connection has closed.
+        """
+        tunnel = self.tunnel
+        metrics = self.ctx.metrics
+        metrics.add("proxy_active_tunnels", -1)
+        metrics.add(
+            'proxy_tunnel_bytes_total{direction="upstream"}',
+            tunnel.to_upstream,
+        )
+        metrics.add(
+            'proxy_tunnel_bytes_total{direction="client"}', tunnel.to_client
+        )
+        if self.ctx.access_log is not None:
+            self.log.status = 200
+            self.log.bytes_sent = tunnel.to_client
+            self.log.finished = time.monotonic()
+            self.ctx.access_log.write(self.address, self.log)
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    A uvloop loop when uvloop is installed, else asyncio's own.
+    """
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def asyncio_worker(
+    id: int,
+    config: ProxyConfig,
+    shared_cache: Optional[SharedResponseCache] = None,
+    metrics: Optional[MetricsRegion] = None,
+    ready: Optional[multiprocessing.synchronize.Event] = None,
+    cpu: Optional[int] = None,
+):
+    """
+    worker() on an asyncio event loop, with the same caches, upstream
+    pool, DNS resolver, metrics and access log, and the same draining
+    and CPU pinning.
+    """
+    log_handler = configure_logging(config.log_level)
+    if cpu is not None and not pin_to_cpu(cpu):
+        cpu = None
+    listen_sock = open_listen_socket(config, cpu)
+    ctx = create_context(
+        id, config, None, shared_cache, metrics, upstream_reusable
+    )
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Lookups finished in the resolver threads wake the loop up
+    loop.add_reader(
+        ctx.resolver.wakeup_socket, ctx.resolver.process_completions
+    )
+    clients: set[ClientProtocol] = set()
+    server = loop.run_until_complete(
+        loop.create_server(
+            lambda: ClientProtocol(ctx, clients),
+            sock=listen_sock,
+            backlog=config.max_connections,
+        )
+    )
+    WorkerProfiler(config.profile_dir, f"worker-{id}").install()
+
+    def housekeeping() -> None:
+        if ctx.pool is not None:
+            ctx.pool.prune()
+        publish_cache_stats(ctx)
+        loop.call_later(METRICS_INTERVAL, housekeeping)
+
+    housekeeping()
+
+    def drain() -> None:
+        if ctx.draining:
+            return
+        log.info("Worker %d draining", id)
+        ctx.draining = True
+        # Closing the socket resets connections still queued on it, so
+        # take them first: another worker is already listening for new
+        # ones
+        while True:
+            try:
+                client_sock, _ = listen_sock.accept()
+            except OSError:
+                break
+            loop.create_task(
+                loop.connect_accepted_socket(
+                    lambda: ClientProtocol(ctx, clients), client_sock
+                )
+            )
+        server.close()
+        for client in list(clients):
+            if client.idle:
+                client.transport.close()
+        # After the connections accepted above have been set up
+        loop.call_later(
+            0.1, wait_drained, time.monotonic() + config.drain_timeout
+        )
+
+    def wait_drained(deadline: float) -> None:
+        if clients and time.monotonic() < deadline:
+            loop.call_later(0.1, wait_drained, deadline)
+            return
+        if clients:
+            log.warning(
+                "Worker %d exiting with %d connections open",
+                id,
+                len(clients),
+            )
+        log_cache_stats(id, ctx)
+        loop.stop()
+
+    loop.add_signal_handler(DRAIN_SIGNAL, drain)
+    log.info(
+        "Worker %d (asyncio engine, %s) started and listening on %s:%d",
+        id,
+        type(loop).__module__.split(".")[0],
+        config.listen_address,
+        config.listen_port,
+    )
+    if ready is not None:
+        ready.set()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        log.info("Worker %d shutting down...", id)
+        log_cache_stats(id, ctx)
+    except Exception as e:
+        log.exception("Error in worker %d: %s", id, e)
+    finally:
+        server.close()
+        for client in list(clients):
+            client.transport.abort()
+        loop.remove_reader(ctx.resolver.wakeup_socket)
+        ctx.resolver.close()
+        if ctx.pool is not None:
+            ctx.pool.close()
+        if ctx.access_log is not None:
+            ctx.access_log.close()
+        loop.close()
+        log_handler.close()
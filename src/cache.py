@@ -0,0 +1,158 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    from admission import TinyLFU
+
+
+@dataclass
+class CacheEntry:
+    response: bytes
+    expires: float
+
+    @property
+    def size(self) -> int:
+        return len(self.response)
+
+
+class ResponseCache:
+    """
+    Per-worker response cache.
+
+    Entries are complete raw HTTP responses keyed by cache key. The total
+    size of stored responses is kept under max_bytes by evicting the least
+    recently used entries. Entries expire ttl seconds after they are
+    stored; an expired entry is kept for another `grace` seconds, during
+    which get_stale() still returns it for revalidation, and is dropped on
+    lookup after that. on_evict, if given, is called with each (key,
+    entry) pushed out to make room, e.g. to spill it to a slower tier.
+
+    With an admission policy (see admission.py), a new entry that would
+    evict others is only stored if the policy prefers it to them.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: int,
+        max_object_size: Optional[int] = None,
+        on_evict: Optional[Callable[[str, CacheEntry], None]] = None,
+        grace: int = 0,
+        admission: Optional["TinyLFU"] = None,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.grace = grace
+        self.on_evict = on_evict
+        self.admission = admission
+        self.max_object_size = min(
+            max_object_size if max_object_size is not None else max_bytes,
+            max_bytes,
+        )
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: str, now: Optional[float] = None) -> Optional[bytes]:
+        """
+        Return the cached response for key, or None on a miss.
+        """
+        if self.admission is not None:
+            self.admission.record(key)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = now if now is not None else time.monotonic()
+        if now >= entry.expires:
+            if now >= entry.expires + self.grace:
+                self.remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.response
+
+    def get_stale(
+        self, key: str, now: Optional[float] = None
+    ) -> Optional[tuple[bytes, float]]:
+        """
+        Return (response, seconds since it expired) for an expired entry
+        still within its grace period, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = now if now is not None else time.monotonic()
+        if not entry.expires <= now < entry.expires + self.grace:
+            return None
+        self._entries.move_to_end(key)
+        return entry.response, now - entry.expires
+
+    def put(
+        self,
+        key: str,
+        response: bytes,
+        now: Optional[float] = None,
+        ttl: Optional[float] = None,
+    ) -> bool:
+        """
+        Store response under key, fresh for ttl seconds (default: the
+        cache's ttl). Returns False if it is too large to cache or the
+        admission policy turned it away.
+        """
+        if len(response) > self.max_object_size:
+            return False
+        now = now if now is not None else time.monotonic()
+        if not self._admit(key, len(response), now):
+            return False
+        self.remove(key)
+        ttl = ttl if ttl is not None else self.ttl
+        self._entries[key] = CacheEntry(response, now + ttl)
+        self.current_bytes += len(response)
+        while self.current_bytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.size
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted_key, evicted)
+        return True
+
+    def _admit(self, key: str, size: int, now: float) -> bool:
+        """
+        Ask the admission policy whether a new entry of `size` bytes may
+        evict the least recently used entries it needs room from.
+        Entries past their grace period are not worth keeping and do not
+        count against it; replacing an entry is always allowed.
+        """
+        if self.admission is None or key in self._entries:
+            return True
+        excess = self.current_bytes + size - self.max_bytes
+        victims = []
+        for victim_key, entry in self._entries.items():
+            if excess <= 0:
+                break
+            excess -= entry.size
+            if now < entry.expires + self.grace:
+                victims.append(victim_key)
+        return not victims or self.admission.admit(key, victims)
+
+    def remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry.size
@@ -1,9 +1,35 @@
 import multiprocessing
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
+import selectors
 import socket
+import tempfile
 from enum import Enum
-from typing import Optional
+from typing import BinaryIO, Mapping, Optional
+from admission import CACHE_POLICIES
+from affinity import AFFINITY_SUPPORTED, parse_cpu_list
+from cache import ResponseCache
+from disk_cache import DiskCache, DiskCacheWriter
+from shared_cache import SharedResponseCache
+from freshness import VaryIndex
+from accesslog import AccessLog
+from logwriter import LOG_LEVELS
+from metrics import WorkerMetrics
+from http_parser import (
+    MAX_REQUEST_BODY,
+    MAX_REQUEST_HEAD,
+    Headers,
+    RequestParser,
+    ResponseFramer,
+)
+from pool import UpstreamPool
+from relay import RELAY_MODES, Relay
+from resolver import DNSResolver
+from sendqueue import SendQueue
+from timers import Timer, TimerHeap
+
+# Worker implementations: worker.worker and asyncio_worker.asyncio_worker
+ENGINES = ("selectors", "asyncio")
 
 
 @dataclass
@@ -12,31 +38,219 @@ class ProxyConfig:
     listen_port: int = 8888
     num_workers: int = multiprocessing.cpu_count()
     cache_size: int = 1024 * 1024 * 100  # 100MB
+    # Freshness for responses that do not state their own (Cache-Control
+    # max-age / s-maxage, Expires)
     cache_ttl: int = 300  # 5 minutes
+    cache_max_object_size: int = 1024 * 1024 * 10  # 10MB
+    # "shared": one cache in shared memory for all workers; "local": one
+    # independent cache per worker
+    cache_backend: str = "shared"
+    # "lru": admit every response; "tinylfu": only admit a response that
+    # is requested more often than the ones it would evict (local
+    # backend only)
+    cache_policy: str = "lru"
+    # Expired entries are kept this long so that they can be revalidated
+    # with a conditional request instead of fetched again
+    cache_keep_stale: int = 3600
+    # For this many seconds after expiry, an entry may be served while a
+    # background request revalidates it, or when the origin fails
+    cache_stale_while_revalidate: int = 0
+    cache_stale_if_error: int = 0
+    # Second cache tier on disk for large and spilled objects; disabled
+    # when disk_cache_dir is empty. disk_cache_size is the budget for
+    # the whole directory, split evenly between the workers
+    disk_cache_dir: str = ""
+    disk_cache_size: int = 1024 * 1024 * 1024 * 10  # 10GB
+    disk_cache_max_object_size: int = 1024 * 1024 * 1024 * 4  # 4GB
     dns_cache_ttl: int = 300  # 5 minutes
+    # Idle keep-alive upstream connections kept per (host, port); 0
+    # disables reuse
+    upstream_max_idle_per_host: int = 8
+    upstream_idle_timeout: int = 30  # seconds
+    # Open client connections per worker; beyond this, new connections
+    # are answered with a 503 and closed
     max_connections: int = 1024
+    # Most connections a worker accepts each time its listening socket
+    # is ready, so that a burst does not hold up connections in progress
+    accept_batch: int = 64
+    # Seconds before giving up on a client that has not sent a complete
+    # request since it connected or started one, on an idle keep-alive
+    # client, on an origin that has not started its response (lookup,
+    # connect and wait included) and on a tunnel with no traffic either
+    # way; 0 disables each
+    client_header_timeout: int = 30
+    keep_alive_timeout: int = 60
+    upstream_timeout: int = 30
+    tunnel_idle_timeout: int = 300
+    # Seconds a worker being replaced (on reload) keeps serving the
+    # requests it has in flight before exiting anyway
+    drain_timeout: int = 30
+    # Largest request header block accepted; larger ones get a 431
+    max_header_size: int = MAX_REQUEST_HEAD
+    # Largest request body accepted; larger ones get a 413
+    max_body_size: int = MAX_REQUEST_BODY
+    tunnel_relay: str = "splice"  # "splice" (Linux) or "buffer"
+    # Local HTTP endpoint serving metrics in Prometheus format from the
+    # master process; 0 disables it
+    admin_address: str = "127.0.0.1"
+    admin_port: int = 8889
+    # File each worker appends a line per request to ("-" for stdout);
+    # empty disables the access log
+    access_log: str = ""
+    # Where SIGUSR2 profiles of a worker are written
+    profile_dir: str = tempfile.gettempdir()
+    # Event loop running the worker: "selectors" or "asyncio" (with
+    # uvloop when it is installed)
+    engine: str = "selectors"
+    # CPUs the workers are pinned to, one each in turn (Linux): "" leaves
+    # them to the scheduler, "auto" takes the CPUs the server may run on,
+    # or a list such as "0-3,8"
+    cpu_affinity: str = ""
+    # Least severe log messages written to stderr; DEBUG adds a line per
+    # chunk relayed
+    log_level: str = "INFO"
 
     def __post_init__(self):
         if self.num_workers < 1:
             raise ValueError("num_workers must be at least 1")
         if self.cache_size < 0:
             raise ValueError("cache_size must be at least 0")
+        if self.cache_max_object_size < 0:
+            raise ValueError("cache_max_object_size must be at least 0")
+        if self.cache_backend not in ("shared", "local"):
+            raise ValueError("cache_backend must be one of shared, local")
+        if self.engine not in ENGINES:
+            raise ValueError(f"engine must be one of {', '.join(ENGINES)}")
+        if self.log_level not in LOG_LEVELS:
+            raise ValueError(
+                f"log_level must be one of {', '.join(LOG_LEVELS)}"
+            )
+        if self.cache_policy not in CACHE_POLICIES:
+            raise ValueError(
+                f"cache_policy must be one of {', '.join(CACHE_POLICIES)}"
+            )
+        if self.cache_policy != "lru" and self.cache_backend != "local":
+            raise ValueError(
+                f"cache_policy {self.cache_policy} requires the local "
+                "cache_backend"
+            )
+        if self.disk_cache_size < 0:
+            raise ValueError("disk_cache_size must be at least 0")
         if self.cache_ttl < 0:
             raise ValueError("cache_ttl must be at least 0")
+        if self.cache_keep_stale < 0:
+            raise ValueError("cache_keep_stale must be at least 0")
+        if self.cache_stale_while_revalidate < 0:
+            raise ValueError("cache_stale_while_revalidate must be at least 0")
+        if self.cache_stale_if_error < 0:
+            raise ValueError("cache_stale_if_error must be at least 0")
+        if self.dns_cache_ttl < 0:
+            raise ValueError("dns_cache_ttl must be at least 0")
+        if self.upstream_max_idle_per_host < 0:
+            raise ValueError("upstream_max_idle_per_host must be at least 0")
+        if self.upstream_idle_timeout < 0:
+            raise ValueError("upstream_idle_timeout must be at least 0")
+        if self.max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        if self.accept_batch < 1:
+            raise ValueError("accept_batch must be at least 1")
+        for name in (
+            "client_header_timeout",
+            "keep_alive_timeout",
+            "upstream_timeout",
+            "tunnel_idle_timeout",
+            "drain_timeout",
+        ):
+            if getattr(self, name) < 0:
+                raise ValueError(f"{name} must be at least 0")
+        if self.max_header_size < 1:
+            raise ValueError("max_header_size must be at least 1")
+        if self.max_body_size < 0:
+            raise ValueError("max_body_size must be at least 0")
+        if self.tunnel_relay not in RELAY_MODES:
+            raise ValueError(
+                f"tunnel_relay must be one of {', '.join(RELAY_MODES)}"
+            )
+        if not 0 <= self.admin_port <= 65535:
+            raise ValueError("admin_port must be between 0 and 65535")
         if self.listen_port > 65535 and self.listen_port < 1:
             raise ValueError("listen_port must be between 1 and 65535")
+        if self.cpu_affinity:
+            if not AFFINITY_SUPPORTED:
+                raise ValueError("cpu_affinity is not supported here")
+            if self.cpu_affinity != "auto":
+                parse_cpu_list(self.cpu_affinity)
+
+    @property
+    def cache_grace(self) -> int:
+        """
+        How long the cache tiers keep entries after they expire.
+        """
+        return max(
+            self.cache_keep_stale,
+            self.cache_stale_while_revalidate,
+            self.cache_stale_if_error,
+        )
 
     @classmethod
-    def from_env(cls):
+    def from_env(cls, env: Optional[Mapping[str, str]] = None):
+        """
+        Configuration from environment variables (`env`, or the process
+        environment), with the defaults above for those not set.
+        """
+        if env is None:
+            env = os.environ
         return cls(
-            listen_address=os.getenv("LISTEN_ADDRESS", "127.0.0.1"),
-            listen_port=int(os.getenv("LISTEN_PORT", "8888")),
+            listen_address=env.get("LISTEN_ADDRESS", "127.0.0.1"),
+            listen_port=int(env.get("LISTEN_PORT", "8888")),
             num_workers=int(
-                os.getenv("NUM_WORKERS", str(multiprocessing.cpu_count()))
+                env.get("NUM_WORKERS", str(multiprocessing.cpu_count()))
+            ),
+            cache_size=int(env.get("CACHE_SIZE", str(1024 * 1024 * 100))),
+            cache_ttl=int(env.get("CACHE_TTL", str(300))),
+            cache_max_object_size=int(
+                env.get("CACHE_MAX_OBJECT_SIZE", str(1024 * 1024 * 10))
+            ),
+            cache_backend=env.get("CACHE_BACKEND", "shared"),
+            cache_policy=env.get("CACHE_POLICY", "lru"),
+            cache_keep_stale=int(env.get("CACHE_KEEP_STALE", "3600")),
+            cache_stale_while_revalidate=int(
+                env.get("CACHE_STALE_WHILE_REVALIDATE", "0")
+            ),
+            cache_stale_if_error=int(env.get("CACHE_STALE_IF_ERROR", "0")),
+            disk_cache_dir=env.get("DISK_CACHE_DIR", ""),
+            disk_cache_size=int(
+                env.get("DISK_CACHE_SIZE", str(1024 * 1024 * 1024 * 10))
+            ),
+            disk_cache_max_object_size=int(
+                env.get(
+                    "DISK_CACHE_MAX_OBJECT_SIZE", str(1024 * 1024 * 1024 * 4)
+                )
             ),
-            cache_size=int(os.getenv("CACHE_SIZE", str(1024 * 1024 * 100))),
-            cache_ttl=int(os.getenv("CACHE_TTL", str(300))),
-            dns_cache_ttl=int(os.getenv("DNS_CACHE_TTL", str(300))),
+            dns_cache_ttl=int(env.get("DNS_CACHE_TTL", str(300))),
+            upstream_max_idle_per_host=int(
+                env.get("UPSTREAM_MAX_IDLE_PER_HOST", "8")
+            ),
+            upstream_idle_timeout=int(env.get("UPSTREAM_IDLE_TIMEOUT", "30")),
+            max_connections=int(env.get("MAX_CONNECTIONS", "1024")),
+            accept_batch=int(env.get("ACCEPT_BATCH", "64")),
+            client_header_timeout=int(env.get("CLIENT_HEADER_TIMEOUT", "30")),
+            keep_alive_timeout=int(env.get("KEEP_ALIVE_TIMEOUT", "60")),
+            upstream_timeout=int(env.get("UPSTREAM_TIMEOUT", "30")),
+            tunnel_idle_timeout=int(env.get("TUNNEL_IDLE_TIMEOUT", "300")),
+            drain_timeout=int(env.get("DRAIN_TIMEOUT", "30")),
+            max_header_size=int(
+                env.get("MAX_HEADER_SIZE", str(MAX_REQUEST_HEAD))
+            ),
+            max_body_size=int(env.get("MAX_BODY_SIZE", str(MAX_REQUEST_BODY))),
+            tunnel_relay=env.get("TUNNEL_RELAY", "splice"),
+            admin_address=env.get("ADMIN_ADDRESS", "127.0.0.1"),
+            admin_port=int(env.get("ADMIN_PORT", "8889")),
+            access_log=env.get("ACCESS_LOG", ""),
+            profile_dir=env.get("PROFILE_DIR", tempfile.gettempdir()),
+            engine=env.get("ENGINE", "selectors"),
+            cpu_affinity=env.get("CPU_AFFINITY", "").strip().lower(),
+            log_level=env.get("LOG_LEVEL", "INFO").upper(),
         )
 
 
@@ -45,22 +259,169 @@ class ProxyConfig:
 
 class ConnectionState(Enum):
     RECV_REQUEST = "RECV_REQUEST"
+    RESOLVING = "RESOLVING"
     RECV_UPSTREAM = "RECV_UPSTREAM"
     SEND_UPSTREAM = "SEND_UPSTREAM"
     SEND_CLIENT = "SEND_CLIENT"
+    TUNNEL = "TUNNEL"
     CLOSED = "CLOSED"
 
 
+@dataclass
+class Tunnel:
+    """
+    Relay state for a CONNECT tunnel, one relay per direction.
+    """
+
+    to_upstream: Relay
+    to_client: Relay
+    connected: bool = False
+    # Read side reached EOF
+    client_eof: bool = False
+    upstream_eof: bool = False
+    # EOF has been propagated to the peer with shutdown(SHUT_WR)
+    client_shut: bool = False
+    upstream_shut: bool = False
+
+
+@dataclass
+class StaleResponse:
+    """
+    An expired cached response being revalidated.
+    """
+
+    # Stored head (no hop-by-hop headers), for validators and 304 updates
+    head: bytes
+    # Seconds since it expired, when it was looked up
+    staleness: float
+    # The whole stored response from a memory tier; None when it is in
+    # the disk tier
+    response: Optional[bytes] = None
+    # How long after expiry it may be served while revalidating in the
+    # background, or when revalidation fails
+    while_revalidate: int = 0
+    if_error: int = 0
+
+
+@dataclass
+class RequestLog:
+    """
+    What is known about the request being answered: time.monotonic()
+    timestamps of its phases (0 for phases it did not go through) and
+    its outcome.
+    """
+
+    # Connection accepted, or the previous response on it finished
+    accepted: float = 0.0
+    # First byte of the request received / request parsed
+    received: float = 0.0
+    parsed: float = 0.0
+    # DNS lookup started / answered
+    resolving: float = 0.0
+    resolved: float = 0.0
+    # New upstream connection started / established
+    connecting: float = 0.0
+    connected: float = 0.0
+    # Request written upstream / first and last response byte received
+    sent: float = 0.0
+    first_byte: float = 0.0
+    upstream_done: float = 0.0
+    # Last response byte written to the client
+    finished: float = 0.0
+    request_line: str = ""
+    status: int = 0
+    # How the cache answered: hit, stale, revalidated, miss, collapsed
+    cache: str = "-"
+    bytes_sent: int = 0
+
+
 @dataclass
 class Connection:
-    socket: socket.socket
+    # None for a background revalidation, which has no client
+    socket: Optional[socket.socket]
     address: tuple[str, int]
-    recv_buffer: bytes = b""
-    send_buffer: bytes = b""
+    # Parses requests out of the bytes received from the client
+    parser: RequestParser = field(default_factory=RequestParser)
+    # The raw request currently being answered
+    request: bytes = b""
+    # The client connection stays open after the current response
+    client_keep_alive: bool = False
+    # Bytes queued for the client, or for the upstream while the request
+    # is being sent
+    send_buffer: SendQueue = field(default_factory=SendQueue)
     state: ConnectionState = ConnectionState.RECV_REQUEST
     upstream_address: tuple[str, int] = None
     upstream_socket: Optional[socket.socket] = None
+    # Tracks where the upstream response ends
+    response_framer: Optional[ResponseFramer] = None
+    # Upstream response bytes held back until its head is complete
+    response_head: Optional[bytearray] = None
+    # The upstream connection came from the pool / may go back to it
+    upstream_reused: bool = False
+    upstream_keep_alive: bool = False
     target_port: int = 80
     target_host: str = ""
     cache_key: str = ""
-    cache_response: Optional[bytes] = None
+    # Headers of a cacheable request, for Vary
+    request_headers: Optional[Headers] = None
+    # Vary header names cache_key was built with, if any
+    vary: tuple[str, ...] = ()
+    # Seconds the response being collected stays fresh
+    cache_ttl: float = 0
+    # Response being collected for the cache on a miss; None when the
+    # response is not cacheable
+    cache_response: Optional[bytearray] = None
+    # Large responses are collected straight into the disk tier instead
+    cache_file: Optional[DiskCacheWriter] = None
+    # Disk cache hit being sent to the client with sendfile
+    send_file: Optional[BinaryIO] = None
+    send_file_offset: int = 0
+    send_file_remaining: int = 0
+    tunnel: Optional[Tunnel] = None
+    # Collapsed forwarding: a cache miss that found another miss for the
+    # same key in flight (its leader) is fed the leader's response
+    # instead of going upstream itself
+    leader: Optional["Connection"] = None
+    followers: list["Connection"] = field(default_factory=list)
+    # Expired copy of the response this request is revalidating
+    stale: Optional[StaleResponse] = None
+    # Phases and outcome of the current request, for metrics and the
+    # access log
+    log: RequestLog = field(default_factory=RequestLog)
+    # Requests received on this client connection so far
+    requests: int = 0
+    # Deadline of whatever the connection is waiting for, if anything
+    timer: Optional[Timer] = None
+
+
+@dataclass
+class WorkerContext:
+    """
+    Per-worker state shared by the event handlers.
+    """
+
+    config: ProxyConfig
+    # None under the asyncio engine, whose event loop owns the sockets
+    selector: Optional[selectors.BaseSelector]
+    # Client connections keyed by the client socket's file descriptor
+    connections: dict[int, Connection] = field(default_factory=dict)
+    # None when caching is disabled (cache_size == 0)
+    cache: Optional[ResponseCache | SharedResponseCache] = None
+    disk_cache: Optional[DiskCache] = None
+    resolver: Optional[DNSResolver] = None
+    pool: Optional[UpstreamPool] = None
+    # Leaders of in-flight cache misses keyed by cache key
+    collapsed: dict[str, Connection] = field(default_factory=dict)
+    # Cache keys being revalidated in the background
+    revalidating: set[str] = field(default_factory=set)
+    vary: VaryIndex = field(default_factory=VaryIndex)
+    metrics: WorkerMetrics = field(default_factory=WorkerMetrics)
+    # Cache tier counters as last added to metrics, by series
+    cache_stats: dict[str, int] = field(default_factory=dict)
+    access_log: Optional[AccessLog] = None
+    timers: TimerHeap = field(default_factory=TimerHeap)
+    # Set by DRAIN_SIGNAL: finish the requests in flight, then exit
+    draining: bool = False
+    # Whether DEBUG messages are logged; checked before formatting the
+    # per-chunk ones so that they cost nothing otherwise
+    debug: bool = False
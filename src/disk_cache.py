@@ -0,0 +1,260 @@
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Optional
+
+# File header: magic, expiry (wall clock), key length. The key follows,
+# then the raw response.
+HEADER = struct.Struct("<4sdI")
+MAGIC = b"HPC1"
+
+log = logging.getLogger(__name__)
+
+
+def _file_name(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class DiskCacheWriter:
+    """
+    A response being written to the disk tier. Bytes go to a temporary
+    file which only becomes visible under its final name on commit().
+    """
+
+    def __init__(self, cache: "DiskCache", key: str):
+        self._cache = cache
+        self.key = key
+        self._key_bytes = key.encode("utf-8")
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(HEADER.pack(MAGIC, 0.0, len(self._key_bytes)))
+        self._file.write(self._key_bytes)
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self, expires: float) -> None:
+        """
+        Stamp the expiry time and move the file into place.
+        """
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, expires, len(self._key_bytes)))
+        self._file.close()
+        self._cache._install(self.key, self._tmp_path, self.size)
+
+    def abort(self) -> None:
+        self._file.close()
+        try:
+            os.unlink(self._tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class DiskCache:
+    """
+    On-disk second cache tier for large or spilled responses.
+
+    Each response lives in its own file named after the SHA-256 of its
+    cache key, so any worker can find it without coordination. A compact
+    in-process index (file name -> size, in least-recently-used order)
+    holds the files this instance is responsible for and keeps them
+    under max_bytes.
+
+    Several workers sharing a directory each take a part of it: the
+    index is seeded with the existing files whose name falls to `part`
+    of `parts`, then grows with the files this worker writes. Files
+    written by the others are served but not adopted, so every file is
+    budgeted by one worker and the directory stays under the sum of
+    their max_bytes. Expired files are kept for `grace` seconds for
+    lookup_stale().
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        max_object_size: int,
+        grace: int = 0,
+        part: int = 0,
+        parts: int = 1,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self.grace = grace
+        self.part = part
+        self.parts = parts
+        self.tmp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._load_index()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name[:2], name)
+
+    def _load_index(self) -> None:
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or len(entry.name) != 2:
+                continue
+            for item in os.scandir(entry.path):
+                if int(item.name, 16) % self.parts != self.part:
+                    continue
+                stat = item.stat()
+                files.append((stat.st_mtime, item.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._index[name] = size
+            self.current_bytes += size
+
+    def _install(self, key: str, tmp_path: str, size: int) -> None:
+        name = _file_name(key)
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        self.current_bytes -= self._index.pop(name, 0)
+        file_size = os.path.getsize(path)
+        self._index[name] = file_size
+        self.current_bytes += file_size
+        while self.current_bytes > self.max_bytes and self._index:
+            victim, victim_size = self._index.popitem(last=False)
+            self.current_bytes -= victim_size
+            self.evictions += 1
+            try:
+                os.unlink(self._path(victim))
+            except FileNotFoundError:
+                pass
+
+    def begin(self, key: str) -> DiskCacheWriter:
+        """
+        Start writing a response for key; see DiskCacheWriter.
+        """
+        return DiskCacheWriter(self, key)
+
+    def put(self, key: str, response: bytes, expires: float) -> bool:
+        """
+        Store a complete response. Returns False if it is too large.
+        """
+        if len(response) > self.max_object_size:
+            return False
+        writer = self.begin(key)
+        try:
+            writer.write(response)
+            writer.commit(expires)
+        except OSError:
+            writer.abort()
+            raise
+        return True
+
+    def spill(self, key: str, entry) -> None:
+        """
+        ResponseCache on_evict hook: keep an evicted in-memory entry on
+        disk for the rest of its lifetime.
+        """
+        remaining = entry.expires - time.monotonic()
+        if remaining + self.grace <= 0:
+            return
+        try:
+            self.put(key, entry.response, time.time() + remaining)
+        except OSError as e:
+            log.warning("Error spilling %s to disk cache: %s", key, e)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(
+        self, key: str, now: Optional[float] = None
+    ) -> Optional[tuple[BinaryIO, int, int]]:
+        """
+        Return (open file, response offset, response length) for key, or
+        None on a miss. The caller owns and must close the file.
+        """
+        now = now if now is not None else time.time()
+        found = self._open(key, now, stale=False)
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return found[:3]
+
+    def lookup_stale(
+        self, key: str, now: Optional[float] = None
+    ) -> Optional[tuple[BinaryIO, int, int, float]]:
+        """
+        lookup() for an expired entry still within its grace period; the
+        seconds since it expired are returned as well.
+        """
+        now = now if now is not None else time.time()
+        found = self._open(key, now, stale=True)
+        if found is None:
+            return None
+        cache_file, offset, length, expires = found
+        return cache_file, offset, length, now - expires
+
+    def _open(
+        self, key: str, now: float, stale: bool
+    ) -> Optional[tuple[BinaryIO, int, int, float]]:
+        """
+        Open key's file if it is fresh, or with stale, if it has expired
+        within its grace period. Files past their grace period are
+        deleted.
+        """
+        name = _file_name(key)
+        try:
+            cache_file = open(self._path(name), "rb")
+        except FileNotFoundError:
+            return None
+        header = cache_file.read(HEADER.size)
+        key_bytes = key.encode("utf-8")
+        if len(header) == HEADER.size:
+            magic, expires, key_len = HEADER.unpack(header)
+            if magic == MAGIC and now >= expires + self.grace:
+                cache_file.close()
+                self.remove(key)
+                return None
+            if (
+                magic == MAGIC
+                and (now >= expires) == stale
+                and cache_file.read(key_len) == key_bytes
+            ):
+                offset = HEADER.size + key_len
+                length = os.fstat(cache_file.fileno()).st_size - offset
+                if name in self._index:
+                    self._index.move_to_end(name)
+                return cache_file, offset, length, expires
+        cache_file.close()
+        return None
+
+    def refresh(self, key: str, expires: float) -> bool:
+        """
+        Give key's file a new expiry time in place, e.g. after the origin
+        confirmed it is unchanged. Returns False if there is no such file.
+        """
+        try:
+            fd = os.open(self._path(_file_name(key)), os.O_WRONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            os.pwrite(fd, struct.pack("<d", expires), len(MAGIC))
+        finally:
+            os.close(fd)
+        return True
+
+    def remove(self, key: str) -> None:
+        name = _file_name(key)
+        self.current_bytes -= self._index.pop(name, 0)
+        try:
+            os.unlink(self._path(name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,199 @@
+import re
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from http_parser import Headers
+
+# URLs whose Vary header fields are remembered per worker
+MAX_VARY_ENTRIES = 10000
+
+_DIRECTIVE = re.compile(
+    r'\s*([^\s=,]+)\s*(?:=\s*("(?:[^"\\]|\\.)*"|[^\s,]*))?\s*(?:,|$)'
+)
+
+
+def parse_cache_control(value: Optional[str]) -> dict[str, Optional[str]]:
+    """
+    Parse a Cache-Control value into {directive: argument or None}, with
+    directive names lowercased and quotes removed from arguments.
+    """
+    directives = {}
+    for name, argument in _DIRECTIVE.findall(value or ""):
+        if argument.startswith('"'):
+            argument = argument[1:-1]
+        directives[name.lower()] = argument or None
+    return directives
+
+
+def _seconds(directives: dict, name: str) -> Optional[int]:
+    """
+    A delta-seconds directive argument, or None if absent or invalid.
+    """
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    """
+    Parse an HTTP date into a Unix timestamp; None if it is invalid.
+    """
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def request_cacheable(headers: Headers) -> bool:
+    """
+    Whether a response to a request may be looked up and stored in a
+    shared cache: not for authorized requests or ones asking no-store.
+    """
+    if "authorization" in headers:
+        return False
+    return "no-store" not in parse_cache_control(headers.get("cache-control"))
+
+
+def request_wants_validation(headers: Headers) -> bool:
+    """
+    Whether the client asks for a response fresh from the origin
+    (Cache-Control: no-cache or max-age=0, or Pragma: no-cache).
+    """
+    cache_control = headers.get("cache-control")
+    if cache_control is None:
+        pragma = parse_cache_control(headers.get("pragma"))
+        return "no-cache" in pragma
+    directives = parse_cache_control(cache_control)
+    return "no-cache" in directives or _seconds(directives, "max-age") == 0
+
+
+def response_ttl(
+    headers: Headers, default_ttl: int, now: Optional[float] = None
+) -> Optional[float]:
+    """
+    How long a response stays fresh from now, or None if a shared cache
+    must not store it.
+
+    The lifetime comes from s-maxage, else max-age, else Expires minus
+    Date, else default_ttl; the response's age (from Age and Date) is
+    subtracted. no-cache responses are stored but always revalidated.
+    """
+    directives = parse_cache_control(headers.get("cache-control"))
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0.0
+    now = now if now is not None else time.time()
+    date = parse_http_date(headers.get("date"))
+    lifetime = _seconds(directives, "s-maxage")
+    if lifetime is None:
+        lifetime = _seconds(directives, "max-age")
+    if lifetime is None and "expires" in headers:
+        # An invalid Expires (e.g. "0") means already expired
+        expires = parse_http_date(headers.get("expires"))
+        lifetime = 0 if expires is None else expires - (date or now)
+    if lifetime is None:
+        lifetime = default_ttl
+    try:
+        age = max(0, int(headers.get("age", "0")))
+    except ValueError:
+        age = 0
+    if date is not None:
+        age = max(age, now - date)
+    return max(0.0, lifetime - age)
+
+
+def stale_windows(
+    headers: Headers, while_revalidate: int, if_error: int
+) -> tuple[int, int]:
+    """
+    The (stale-while-revalidate, stale-if-error) windows for a stored
+    response: its own directives override the defaults given, and
+    must-revalidate / proxy-revalidate forbid serving it stale at all.
+    """
+    directives = parse_cache_control(headers.get("cache-control"))
+    if "must-revalidate" in directives or "proxy-revalidate" in directives:
+        return 0, 0
+    swr = _seconds(directives, "stale-while-revalidate")
+    sie = _seconds(directives, "stale-if-error")
+    return (
+        while_revalidate if swr is None else swr,
+        if_error if sie is None else sie,
+    )
+
+
+def vary_names(headers: Headers) -> Optional[tuple[str, ...]]:
+    """
+    The request header names a response varies on, lowercased and
+    sorted; None for "Vary: *", which no request can match.
+    """
+    names = set()
+    for value in headers.get_all("vary"):
+        for name in value.split(","):
+            name = name.strip().lower()
+            if name == "*":
+                return None
+            if name:
+                names.add(name)
+    return tuple(sorted(names))
+
+
+def variant_key(key: str, names: tuple[str, ...], headers: Headers) -> str:
+    """
+    Secondary cache key for the variant of key selected by the request
+    header values named in its Vary.
+    """
+    if not names:
+        return key
+    values = (
+        f"{name}={' '.join((headers.get(name) or '').split())}"
+        for name in names
+    )
+    return f"{key} vary({'; '.join(values)})"
+
+
+def primary_key(key: str) -> str:
+    """
+    The cache key a variant key was built from (request targets cannot
+    contain spaces).
+    """
+    return key.partition(" vary(")[0]
+
+
+class VaryIndex:
+    """
+    Per-worker record of the Vary header names of cached URLs.
+
+    Responses with Vary are only stored under secondary keys (see
+    variant_key), so a worker that does not know a URL varies simply
+    misses and learns it from the next response. The least recently
+    used URLs are forgotten beyond max_entries.
+    """
+
+    def __init__(self, max_entries: int = MAX_VARY_ENTRIES):
+        self.max_entries = max_entries
+        self._names: OrderedDict[str, tuple[str, ...]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def get(self, key: str) -> Optional[tuple[str, ...]]:
+        names = self._names.get(key)
+        if names is not None:
+            self._names.move_to_end(key)
+        return names
+
+    def set(self, key: str, names: tuple[str, ...]) -> None:
+        """
+        Remember names for key; an empty tuple forgets it.
+        """
+        self._names.pop(key, None)
+        if not names:
+            return
+        self._names[key] = names
+        while len(self._names) > self.max_entries:
+            self._names.popitem(last=False)
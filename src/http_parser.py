@@ -1,3 +1,9 @@
+import abc
+import re
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+
 def parse_http_request(request: bytes) -> dict:
     """
     Parse an HTTP request and return a dictionary of the request headers.
@@ -28,6 +34,609 @@ def parse_http_request(request: bytes) -> dict:
     return headers
 
 
+# Longest status line parse_status_code looks for
+MAX_STATUS_LINE = 256
+
+
+def absolute_url(url: str, host: str) -> str:
+    """
+    Return the absolute form of a request target.
+
+    Proxy requests normally carry an absolute URL already; origin-form
+    targets ("/path") are completed from the Host header.
+    """
+    if "://" in url:
+        return url
+    return f"http://{host}{url}"
+
+
+def build_cache_key(method: str, url: str, host: str) -> str:
+    """
+    Return the cache key for a request: method plus absolute URL.
+    """
+    return f"{method} {absolute_url(url, host)}"
+
+
+def parse_status_code(response: bytes) -> int:
+    """
+    Return the status code from the start of a raw HTTP response,
+    or 0 if the status line is incomplete or malformed.
+    """
+    end = response.find(b"\r\n", 0, MAX_STATUS_LINE)
+    if end < 0:
+        return 0
+    parts = bytes(response[:end]).split(b" ", 2)
+    if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+        return 0
+    try:
+        return int(parts[1])
+    except ValueError:
+        return 0
+
+
+# Hop-by-hop headers that describe the client<->proxy connection and must
+# not be forwarded upstream verbatim.
+HOP_BY_HOP_HEADERS = (b"connection", b"proxy-connection", b"keep-alive")
+
+
+def prepare_upstream_request(
+    request: bytes, keep_alive: bool = False
+) -> bytes:
+    """
+    Rewrite a client request for sending upstream.
+
+    Drops the client's hop-by-hop headers and adds our own Connection
+    header: by default the origin is asked to close the connection after
+    responding; with keep_alive it is asked to keep it open for reuse.
+    Anything after the header block is passed through unchanged.
+    """
+    head, sep, body = request.partition(b"\r\n\r\n")
+    if not sep:
+        return request
+    lines = head.split(b"\r\n")
+    kept = [lines[0]]
+    for line in lines[1:]:
+        name = line.split(b":", 1)[0].strip().lower()
+        if name not in HOP_BY_HOP_HEADERS:
+            kept.append(line)
+    if keep_alive:
+        kept.append(b"Connection: keep-alive")
+    else:
+        kept.append(b"Connection: close")
+    return b"\r\n".join(kept) + b"\r\n\r\n" + body
+
+
+def _connection_tokens(value: str) -> set[str]:
+    return {token.strip().lower() for token in value.split(",")}
+
+
+class Headers:
+    """
+    Case-insensitive multimap of header fields.
+
+    Fields keep their original spelling and order. get() combines
+    repeated fields with ", " as HTTP allows; get_all() returns them
+    separately.
+    """
+
+    def __init__(self):
+        self._fields: list[tuple[str, str]] = []
+        self._values: dict[str, list[str]] = {}
+
+    def add(self, name: str, value: str) -> None:
+        self._fields.append((name, value))
+        self._values.setdefault(name.lower(), []).append(value)
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        values = self._values.get(name.lower())
+        return ", ".join(values) if values else default
+
+    def get_all(self, name: str) -> list[str]:
+        return list(self._values.get(name.lower(), ()))
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self._values
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+
+def parse_header_lines(lines: list[bytes], strict: bool = True) -> Headers:
+    """
+    Parse "Name: value" lines into Headers. Lines without a colon, with
+    whitespace before the colon or folded onto the previous line raise
+    ValueError, or are skipped when not strict.
+    """
+    headers = Headers()
+    for line in lines:
+        if not line:
+            continue
+        name, sep, value = line.partition(b":")
+        if not sep or not name or name != name.strip() or line[:1] in b" \t":
+            if strict:
+                raise ValueError(f"malformed header line: {line!r}")
+            continue
+        headers.add(name.decode("latin-1"), value.strip().decode("latin-1"))
+    return headers
+
+
+class RequestError(ValueError):
+    """
+    A request the proxy refuses; `status` is the HTTP status to answer.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class Request:
+    """
+    A parsed request head and how its body is framed.
+    """
+
+    method: str
+    target: str
+    version: str
+    headers: Headers
+    head_size: int
+    content_length: int = 0
+    chunked: bool = False
+
+    @property
+    def keep_alive(self) -> bool:
+        """
+        True if the client connection may stay open after the response:
+        the default for HTTP/1.1 unless the client says "close", opt-in
+        for HTTP/1.0.
+        """
+        tokens = set()
+        for name in ("connection", "proxy-connection"):
+            tokens |= _connection_tokens(self.headers.get(name, ""))
+        if self.version == "HTTP/1.1":
+            return "close" not in tokens
+        return "keep-alive" in tokens
+
+
+# Largest request header block accepted by default
+MAX_REQUEST_HEAD = 64 * 1024
+
+# Largest request body accepted by default, chunk framing included
+MAX_REQUEST_BODY = 10 * 1024 * 1024
+
+
+class RequestParser:
+    """
+    Incremental HTTP/1.x request parser for one client connection.
+
+    Received bytes are appended to `buffer` with feed(). next_request()
+    returns (Request, raw request bytes) once a whole request, body
+    included, is buffered, and None until then. Scanning resumes where
+    the previous call stopped, so each byte is examined once however the
+    request is split across reads. Bytes after the request (pipelined
+    requests) stay buffered. Heads larger than max_head_size are refused
+    with 431, bodies larger than max_body_size with 413 (as soon as that
+    is known, so an oversized body is never buffered in full) and
+    malformed requests with 400 (see RequestError).
+    """
+
+    def __init__(
+        self,
+        max_head_size: int = MAX_REQUEST_HEAD,
+        max_body_size: int = MAX_REQUEST_BODY,
+    ):
+        self.max_head_size = max_head_size
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        # Offset the head terminator search resumes from
+        self._scanned = 0
+        # Head parsed, body still arriving
+        self._request: Optional[Request] = None
+        self._body: Optional[BodyFramer] = None
+        self._consumed = 0
+
+    def feed(self, data: bytes) -> None:
+        self.buffer += data
+
+    def take_buffered(self) -> bytes:
+        """
+        Return and forget everything buffered, e.g. the first bytes of a
+        CONNECT tunnel.
+        """
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self._scanned = 0
+        return data
+
+    def next_request(self) -> Optional[tuple[Request, bytes]]:
+        if self._request is None:
+            end = self.buffer.find(b"\r\n\r\n", max(0, self._scanned - 3))
+            if end < 0:
+                self._scanned = len(self.buffer)
+                if self._scanned > self.max_head_size:
+                    raise RequestError(431, "request header block too large")
+                return None
+            head_size = end + 4
+            if head_size > self.max_head_size:
+                raise RequestError(431, "request header block too large")
+            self._start_request(bytes(memoryview(self.buffer)[:head_size]))
+
+        if not self._body.complete:
+            try:
+                self._consumed += self._body.feed(self.buffer, self._consumed)
+            except ValueError as e:
+                raise RequestError(400, str(e)) from e
+            if self._body.received > self.max_body_size:
+                raise RequestError(413, "request body too large")
+            if not self._body.complete:
+                return None
+
+        request = self._request
+        consumed = self._consumed
+        raw = bytes(self.buffer[:consumed])
+        del self.buffer[:consumed]
+        self._request = None
+        self._body = None
+        self._scanned = 0
+        self._consumed = 0
+        return request, raw
+
+    def _start_request(self, head: bytes) -> None:
+        lines = head.split(b"\r\n")
+        parts = lines[0].split(b" ")
+        if len(parts) != 3 or not parts[2].startswith(b"HTTP/"):
+            raise RequestError(400, f"malformed request line: {lines[0]!r}")
+        method, target, version = (part.decode("latin-1") for part in parts)
+        try:
+            headers = parse_header_lines(lines[1:])
+        except ValueError as e:
+            raise RequestError(400, str(e)) from e
+        request = Request(method, target, version, headers, len(head))
+
+        body = BodyFramer()
+        lengths = set(headers.get_all("content-length"))
+        if "transfer-encoding" in headers:
+            coding = headers.get("transfer-encoding")
+            if lengths or coding.split(",")[-1].strip().lower() != "chunked":
+                # Ambiguous framing is how requests get smuggled
+                raise RequestError(400, "unsupported request body framing")
+            request.chunked = True
+            body.expect_chunked()
+        elif lengths:
+            length = lengths.pop()
+            if lengths or not (length.isascii() and length.isdigit()):
+                raise RequestError(400, "invalid Content-Length")
+            request.content_length = int(length)
+            if request.content_length > self.max_body_size:
+                raise RequestError(413, "request body too large")
+            body.expect_length(request.content_length)
+        else:
+            body.expect_length(0)
+
+        self._request = request
+        self._body = body
+        self._consumed = request.head_size
+
+
+def rewrite_response_head(head: bytes, connection: bytes = b"") -> bytes:
+    """
+    Drop hop-by-hop headers from a response header block and, if given,
+    add our own Connection header. Interim (1xx) responses at the start
+    of head pass through unchanged.
+    """
+    interim_end = head.rfind(b"\r\n\r\n", 0, len(head) - 4) + 4
+    lines = head[interim_end:-4].split(b"\r\n")
+    kept = [lines[0]]
+    for line in lines[1:]:
+        name = line.split(b":", 1)[0].strip().lower()
+        if name not in HOP_BY_HOP_HEADERS:
+            kept.append(line)
+    if connection:
+        kept.append(b"Connection: " + connection)
+    return head[:interim_end] + b"\r\n".join(kept) + b"\r\n\r\n"
+
+
+# Client validators replaced by ours when revalidating a stored response
+CONDITIONAL_HEADERS = (b"if-none-match", b"if-modified-since")
+
+# Fields a 304 cannot update in the stored response
+FRAMING_HEADERS = (b"content-length", b"transfer-encoding")
+
+
+def _field_name(line: bytes) -> bytes:
+    return line.split(b":", 1)[0].strip().lower()
+
+
+def _final_response_lines(head: bytes) -> list[bytes]:
+    """
+    Status line and header lines of the last response in head, skipping
+    any interim (1xx) responses before it.
+    """
+    interim_end = head.rfind(b"\r\n\r\n", 0, len(head) - 4)
+    start = interim_end + 4 if interim_end >= 0 else 0
+    return head[start:-4].split(b"\r\n")
+
+
+def parse_response_headers(head: bytes) -> Headers:
+    """
+    Header fields of the final response in a complete response head.
+    """
+    return parse_header_lines(_final_response_lines(head)[1:], strict=False)
+
+
+def conditional_request(request: bytes, stored_head: bytes) -> Optional[bytes]:
+    """
+    Turn a client request into a revalidation of a stored response: the
+    client's own If-None-Match / If-Modified-Since are replaced by ones
+    built from the stored ETag / Last-Modified. Returns None if the
+    stored response has neither validator.
+    """
+    stored = parse_response_headers(stored_head)
+    etag = stored.get("etag")
+    last_modified = stored.get("last-modified")
+    if etag is None and last_modified is None:
+        return None
+    head, _, body = request.partition(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    kept = [lines[0]]
+    for line in lines[1:]:
+        if _field_name(line) not in CONDITIONAL_HEADERS:
+            kept.append(line)
+    if etag is not None:
+        kept.append(b"If-None-Match: " + etag.encode("latin-1"))
+    if last_modified is not None:
+        kept.append(b"If-Modified-Since: " + last_modified.encode("latin-1"))
+    return b"\r\n".join(kept) + b"\r\n\r\n" + body
+
+
+def update_stored_head(stored_head: bytes, not_modified_head: bytes) -> bytes:
+    """
+    Apply a 304 response to a stored response head: its header fields
+    replace the stored fields of the same name, except hop-by-hop and
+    framing fields.
+    """
+    updates = [
+        line
+        for line in _final_response_lines(not_modified_head)[1:]
+        if line
+        and _field_name(line) not in HOP_BY_HOP_HEADERS + FRAMING_HEADERS
+    ]
+    replaced = {_field_name(line) for line in updates}
+    stored = _final_response_lines(stored_head)
+    kept = [stored[0]]
+    for line in stored[1:]:
+        if _field_name(line) not in replaced:
+            kept.append(line)
+    return b"\r\n".join(kept + updates) + b"\r\n\r\n"
+
+
+# Largest response header block ResponseFramer accepts
+MAX_RESPONSE_HEAD = 64 * 1024
+
+# Framer states
+_HEAD = "head"
+_BODY_LENGTH = "body-length"
+_BODY_CLOSE = "body-close"
+_CHUNK_SIZE = "chunk-size"
+_CHUNK_DATA = "chunk-data"
+_CHUNK_END = "chunk-end"
+_TRAILER = "trailer"
+
+# A chunk size: hex digits only, no sign, prefix or underscores
+_CHUNK_SIZE_DIGITS = re.compile(rb"[0-9A-Fa-f]+")
+
+
+class BodyFramer:
+    """
+    Find the end of an HTTP/1.x message body as its bytes stream past.
+
+    After choosing the framing with one of the expect_*() methods, feed()
+    takes bytes in arrival order and returns how many of them belong to
+    the body; `complete` is set once a Content-Length or chunked body has
+    ended. Close-delimited bodies complete at EOF (see finish). Malformed
+    framing raises ValueError.
+    """
+
+    def __init__(self):
+        self.complete = False
+        self.received = 0
+        self._state = _BODY_CLOSE
+        self._line = bytearray()
+        self._remaining = 0
+
+    def expect_length(self, length: int) -> None:
+        if length < 0:
+            raise ValueError("negative Content-Length")
+        self._remaining = length
+        self._state = _BODY_LENGTH
+        self.complete = not length
+
+    def expect_chunked(self) -> None:
+        self._state = _CHUNK_SIZE
+
+    def expect_close(self) -> None:
+        self._state = _BODY_CLOSE
+
+    @property
+    def delimited(self) -> bool:
+        """
+        True if the end of the message is marked without closing the
+        connection.
+        """
+        return self._state != _BODY_CLOSE
+
+    def feed(self, data: bytes, start: int = 0) -> int:
+        """
+        Consume data from offset start; returns how many bytes belong to
+        this message.
+        """
+        pos = start
+        end = len(data)
+        while pos < end and not self.complete:
+            if self._state == _BODY_CLOSE:
+                pos = end
+            elif self._state in (_BODY_LENGTH, _CHUNK_DATA):
+                take = min(self._remaining, end - pos)
+                pos += take
+                self._remaining -= take
+                if not self._remaining:
+                    if self._state == _BODY_LENGTH:
+                        self.complete = True
+                    else:
+                        self._state = _CHUNK_END
+            else:
+                pos = self._read_line(data, pos)
+        used = pos - start
+        self.received += used
+        return used
+
+    def finish(self) -> bool:
+        """
+        Note that the peer closed the connection. Returns True if the
+        message was complete, False if it was cut short.
+        """
+        if self._state == _BODY_CLOSE:
+            self.complete = True
+        return self.complete
+
+    def _read_line(self, data: bytes, pos: int) -> int:
+        newline = data.find(b"\n", pos)
+        if newline < 0:
+            self._line += data[pos:]
+            if len(self._line) > MAX_RESPONSE_HEAD:
+                raise ValueError("chunk framing line too long")
+            return len(data)
+        self._line += data[pos:newline]
+        line = bytes(self._line).rstrip(b"\r")
+        self._line = bytearray()
+        if self._state == _CHUNK_SIZE:
+            digits = line.split(b";", 1)[0].strip()
+            if not _CHUNK_SIZE_DIGITS.fullmatch(digits):
+                raise ValueError(f"malformed chunk size: {digits!r}")
+            size = int(digits, 16)
+            if size:
+                self._remaining = size
+                self._state = _CHUNK_DATA
+            else:
+                self._state = _TRAILER
+        elif self._state == _CHUNK_END:
+            self._state = _CHUNK_SIZE
+        elif not line:
+            # Empty line ends the trailer section
+            self.complete = True
+        return newline + 1
+
+
+class MessageFramer(BodyFramer, abc.ABC):
+    """
+    A BodyFramer for a whole message: the head comes first, and its
+    parsing (_read_head) chooses the body framing. `head_size` is the
+    number of bytes before the body once `headers_done` is set.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.headers_done = False
+        self.head_size = 0
+        self._state = _HEAD
+
+    def feed(self, data: bytes, start: int = 0) -> int:
+        pos = start
+        while self._state == _HEAD and pos < len(data):
+            pos = self._read_head(data, pos)
+        if self.headers_done and not self.head_size:
+            self.head_size = self.received + pos - start
+        self.received += pos - start
+        return pos - start + super().feed(data, pos)
+
+    @abc.abstractmethod
+    def _read_head(self, data: bytes, pos: int) -> int:
+        """
+        Consume head bytes from offset pos; returns the offset after
+        them. Once the head is complete, the body framing is chosen.
+        """
+
+
+class ResponseFramer(MessageFramer):
+    """
+    Find the end of an HTTP/1.x response, header block included.
+
+    The framing is taken from the response head once it has arrived
+    (`headers_done`; `head_size` is then the number of bytes before the
+    body, interim 1xx responses included). `keep_alive` tells whether the
+    origin allows another request on the connection afterwards.
+    """
+
+    def __init__(self, method: str = "GET"):
+        super().__init__()
+        self.method = method
+        self.status = 0
+        self.headers = Headers()
+        self.keep_alive = False
+        self._head = bytearray()
+
+    def _read_head(self, data: bytes, pos: int) -> int:
+        seen = len(self._head)
+        self._head += data[pos:]
+        end = self._head.find(b"\r\n\r\n", max(0, seen - 3))
+        if end < 0:
+            if len(self._head) > MAX_RESPONSE_HEAD:
+                raise ValueError("response header block too large")
+            return len(data)
+        head_end = end + 4
+        del self._head[head_end:]
+        self._start_body(bytes(self._head))
+        self._head = bytearray()
+        return pos + head_end - seen
+
+    def _start_body(self, head: bytes) -> None:
+        status_line = head.split(b"\r\n", 1)[0].decode("latin-1")
+        parts = status_line.split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ValueError(f"malformed status line: {status_line!r}")
+        version, code = parts[0], parts[1]
+        if len(code) != 3 or not code.isascii() or not code.isdigit():
+            raise ValueError(f"malformed status line: {status_line!r}")
+        status = int(code)
+        headers = parse_header_lines(head.split(b"\r\n")[1:], strict=False)
+        if 100 <= status < 200 and status != 101:
+            # Interim response; the real one follows
+            return
+        self.status = status
+        self.headers = headers
+        self.headers_done = True
+
+        tokens = _connection_tokens(headers.get("connection", ""))
+        if version == "HTTP/1.1":
+            self.keep_alive = "close" not in tokens
+        else:
+            self.keep_alive = "keep-alive" in tokens
+
+        coding = headers.get("transfer-encoding")
+        if self.method == "HEAD" or status in (204, 304):
+            self.expect_length(0)
+        elif status == 101:
+            self.expect_close()
+        elif coding is not None:
+            if coding.split(",")[-1].strip().lower() == "chunked":
+                self.expect_chunked()
+            else:
+                self.expect_close()
+        elif "content-length" in headers:
+            length = headers.get("content-length").split(",")[0].strip()
+            if not (length.isascii() and length.isdigit()):
+                raise ValueError(f"malformed Content-Length: {length!r}")
+            self.expect_length(int(length))
+        else:
+            self.expect_close()
+        if not self.delimited:
+            self.keep_alive = False
+
+
 def build_http_response(status_code: int, headers: dict, body: bytes) -> bytes:
     """
     Build an HTTP response and return it as a bytes object.
@@ -49,4 +658,10 @@ def status_code_to_reason(status_code: int) -> str:
         200: "OK",
         400: "Bad Request",
         404: "Not Found",
+        408: "Request Timeout",
+        413: "Content Too Large",
+        431: "Request Header Fields Too Large",
+        502: "Bad Gateway",
+        503: "Service Unavailable",
+        504: "Gateway Timeout",
     }[status_code]
@@ -0,0 +1,143 @@
+import collections
+import logging
+import os
+import sys
+import threading
+from typing import Callable
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+LOG_FORMAT = "%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s"
+
+# Items held for a writer before the oldest are dropped
+RING_SIZE = 16384
+
+# Seconds a writer thread waits between batches
+FLUSH_INTERVAL = 0.5
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundWriter:
+    """
+    Appends text to a file descriptor from a thread of its own, so that
+    the event loop never waits for log I/O.
+
+    Items are held in a bounded ring and formatted by the writer thread,
+    a batch at a time. If the writer falls behind, the oldest items are
+    dropped (and counted) rather than blocking or growing without bound.
+    A batch goes out in a single write, so processes appending to the
+    same file (opened O_APPEND) never interleave within a line.
+    """
+
+    def __init__(
+        self,
+        fd: int,
+        format: Callable[[object], str],
+        capacity: int = RING_SIZE,
+        interval: float = FLUSH_INTERVAL,
+        report_errors: bool = True,
+    ):
+        self.fd = fd
+        self.format = format
+        self.interval = interval
+        # Whether write errors are logged (not by the log's own writer)
+        self.report_errors = report_errors
+        self.dropped = 0
+        self._ring: collections.deque = collections.deque(maxlen=capacity)
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, item) -> None:
+        ring = self._ring
+        if len(ring) == ring.maxlen:
+            self.dropped += 1
+        ring.append(item)
+
+    def flush(self) -> None:
+        """
+        Write out everything submitted so far, on the calling thread.
+        """
+        with self._flush_lock:
+            lines = []
+            while True:
+                try:
+                    item = self._ring.popleft()
+                except IndexError:
+                    break
+                lines.append(self.format(item))
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(
+                    f"{dropped} lines dropped, the writer fell behind\n"
+                )
+            if not lines:
+                return
+            data = "".join(lines).encode(errors="replace")
+            try:
+                while data:
+                    written = os.write(self.fd, data)
+                    data = data[written:]
+            except OSError as e:
+                if self.report_errors:
+                    log.warning("Error writing log: %s", e)
+
+    def close(self) -> None:
+        self._stopping.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            self.flush()
+
+
+class RingHandler(logging.Handler):
+    """
+    A logging handler that leaves formatting and writing its records to
+    a BackgroundWriter.
+    """
+
+    def __init__(self, fd: int):
+        super().__init__()
+        self.writer = BackgroundWriter(
+            fd, self._format_line, report_errors=False
+        )
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.writer.submit(record)
+
+    def flush(self) -> None:
+        self.writer.flush()
+
+    def close(self) -> None:
+        self.writer.close()
+        super().close()
+
+    def _format_line(self, record: logging.LogRecord) -> str:
+        try:
+            return self.format(record) + "\n"
+        except Exception as e:
+            return f"Unformattable log record {record.msg!r}: {e}\n"
+
+
+def configure_logging(level: str) -> RingHandler:
+    """
+    Send this process's log records at `level` and above to stderr
+    through a RingHandler, which the caller closes on exit. Handlers
+    inherited over a fork are dropped along with whatever they had not
+    written yet: their writer threads did not survive the fork, and the
+    parent writes those records itself.
+    """
+    handler = RingHandler(sys.stderr.fileno())
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    for inherited in root.handlers[:]:
+        root.removeHandler(inherited)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
@@ -0,0 +1,237 @@
+import bisect
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+# (name, labels, type, help) of every counter and gauge. Gauges a worker
+# moves up and down are summed across workers like counters.
+SERIES = (
+    ("proxy_connections_total", "", "counter", "Client connections accepted"),
+    ("proxy_active_connections", "", "gauge", "Open client connections"),
+    (
+        "proxy_connections_shed_total",
+        "",
+        "counter",
+        "Client connections turned away with a 503 past max_connections",
+    ),
+    ("proxy_requests_total", "", "counter", "Client requests received"),
+    (
+        "proxy_timeouts_total",
+        'phase="request"',
+        "counter",
+        "Connections given up on after waiting too long",
+    ),
+    ("proxy_timeouts_total", 'phase="idle"', "counter", ""),
+    ("proxy_timeouts_total", 'phase="upstream"', "counter", ""),
+    ("proxy_timeouts_total", 'phase="tunnel"', "counter", ""),
+    (
+        "proxy_error_responses_total",
+        "",
+        "counter",
+        "Error responses sent by the proxy itself",
+    ),
+    (
+        "proxy_client_bytes_total",
+        'direction="received"',
+        "counter",
+        "Bytes exchanged with HTTP clients",
+    ),
+    ("proxy_client_bytes_total", 'direction="sent"', "counter", ""),
+    ("proxy_tunnels_total", "", "counter", "CONNECT tunnels opened"),
+    ("proxy_active_tunnels", "", "gauge", "Open CONNECT tunnels"),
+    (
+        "proxy_tunnel_bytes_total",
+        'direction="upstream"',
+        "counter",
+        "Bytes relayed through closed tunnels",
+    ),
+    ("proxy_tunnel_bytes_total", 'direction="client"', "counter", ""),
+    (
+        "proxy_cache_hits_total",
+        'tier="memory"',
+        "counter",
+        "Cache lookups answered by a tier",
+    ),
+    ("proxy_cache_hits_total", 'tier="disk"', "counter", ""),
+    (
+        "proxy_cache_misses_total",
+        'tier="memory"',
+        "counter",
+        "Cache lookups a tier could not answer",
+    ),
+    ("proxy_cache_misses_total", 'tier="disk"', "counter", ""),
+    (
+        "proxy_cache_evictions_total",
+        'tier="memory"',
+        "counter",
+        "Entries evicted to make room",
+    ),
+    ("proxy_cache_evictions_total", 'tier="disk"', "counter", ""),
+)
+
+# (name, help) of every latency histogram, observed in seconds
+HISTOGRAMS = (
+    (
+        "proxy_upstream_connect_seconds",
+        "Time to establish a new upstream connection",
+    ),
+    (
+        "proxy_upstream_ttfb_seconds",
+        "Time from a request to the first byte of the upstream response",
+    ),
+)
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Histogram sums are kept in microseconds so every slot is an integer
+SUM_SCALE = 1_000_000
+# Slots per histogram: one per bucket, +Inf, sum and count
+HISTOGRAM_SLOTS = len(BUCKETS) + 3
+SLOT_SIZE = 8
+WORKER_SLOTS = len(SERIES) + len(HISTOGRAMS) * HISTOGRAM_SLOTS
+WORKER_SIZE = WORKER_SLOTS * SLOT_SIZE
+
+
+def _series_key(name: str, labels: str) -> str:
+    return f"{name}{{{labels}}}" if labels else name
+
+
+# Slot of each series, keyed like the rendered sample ("name{labels}")
+SERIES_SLOTS = {
+    _series_key(name, labels): slot
+    for slot, (name, labels, _, _) in enumerate(SERIES)
+}
+HISTOGRAM_BASES = {
+    name: len(SERIES) + i * HISTOGRAM_SLOTS
+    for i, (name, _) in enumerate(HISTOGRAMS)
+}
+
+
+class WorkerMetrics:
+    """
+    One worker's counters, gauges and histograms: a block of signed
+    64-bit slots that only this worker writes. The block is a slice of a
+    MetricsRegion, or private memory when the worker runs on its own.
+    """
+
+    def __init__(self, buffer: Optional[memoryview] = None):
+        if buffer is None:
+            buffer = memoryview(bytearray(WORKER_SIZE))
+        self._slots = buffer.cast("q")
+
+    def add(self, key: str, amount: int = 1) -> None:
+        """
+        Add amount (negative for a gauge going down) to a series, named
+        as in SERIES_SLOTS.
+        """
+        self._slots[SERIES_SLOTS[key]] += amount
+
+    def set(self, key: str, value: int) -> None:
+        self._slots[SERIES_SLOTS[key]] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        base = HISTOGRAM_BASES[name]
+        slots = self._slots
+        slots[base + bisect.bisect_left(BUCKETS, seconds)] += 1
+        slots[base + len(BUCKETS) + 1] += int(seconds * SUM_SCALE)
+        slots[base + len(BUCKETS) + 2] += 1
+
+    def values(self) -> list[int]:
+        return self._slots.tolist()
+
+    def release(self) -> None:
+        self._slots.release()
+
+
+class MetricsRegion:
+    """
+    Shared memory segment holding every worker's WorkerMetrics block.
+
+    The master creates it before forking and renders the sum over all
+    workers; the workers only write their own block, so no locks are
+    needed.
+    """
+
+    def __init__(self, shm: SharedMemory, workers: int):
+        self._shm = shm
+        self.workers = workers
+
+    @classmethod
+    def create(cls, workers: int) -> "MetricsRegion":
+        shm = SharedMemory(create=True, size=workers * WORKER_SIZE)
+        return cls(shm, workers)
+
+    def worker(self, id: int) -> WorkerMetrics:
+        start = id * WORKER_SIZE
+        end = start + WORKER_SIZE
+        return WorkerMetrics(self._shm.buf[start:end])
+
+    def reset_gauges(self, id: int) -> None:
+        """
+        Zero the gauges in worker `id`'s block, which a worker that
+        exited with connections open leaves behind. Counters are kept, so
+        that the totals never go down.
+        """
+        block = self.worker(id)
+        for name, labels, kind, _ in SERIES:
+            if kind == "gauge":
+                block.set(_series_key(name, labels), 0)
+        block.release()
+
+    def totals(self) -> list[int]:
+        """
+        Every slot summed over all workers.
+        """
+        totals = [0] * WORKER_SLOTS
+        for id in range(self.workers):
+            block = self.worker(id)
+            for slot, value in enumerate(block.values()):
+                totals[slot] += value
+            block.release()
+        return totals
+
+    def render(self) -> str:
+        """
+        The totals in the Prometheus text exposition format.
+        """
+        totals = self.totals()
+        lines = []
+        for slot, (name, labels, kind, help) in enumerate(SERIES):
+            if help:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{_series_key(name, labels)} {totals[slot]}")
+        for name, help in HISTOGRAMS:
+            base = HISTOGRAM_BASES[name]
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for i, bound in enumerate(BUCKETS + (float("inf"),)):
+                cumulative += totals[base + i]
+                le = "+Inf" if i == len(BUCKETS) else repr(bound)
+                lines.append(f'{name}_bucket{{le="{le}"}} {cumulative}')
+            total = totals[base + len(BUCKETS) + 1] / SUM_SCALE
+            lines.append(f"{name}_sum {total}")
+            lines.append(f"{name}_count {totals[base + len(BUCKETS) + 2]}")
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """
+        Free the segment. Only the process that created it calls this.
+        """
+        self._shm.unlink()
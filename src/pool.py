@@ -0,0 +1,119 @@
+import socket
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+def _is_alive(sock: socket.socket) -> bool:
+    """
+    Return True if an idle socket still looks usable: the origin has
+    neither closed it nor sent anything unsolicited.
+    """
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    # Either b"" (EOF) or unexpected bytes that would corrupt the next
+    # response; the connection cannot be reused in both cases.
+    return False
+
+
+class UpstreamPool:
+    """
+    Per-worker pool of idle keep-alive upstream connections.
+
+    Connections are keyed by the (host, port) the client asked for, so a
+    pooled connection is found before any DNS lookup. At most
+    max_idle_per_host connections are kept per key; the most recently
+    used one is handed out first, and connections idle for longer than
+    idle_timeout are closed by prune(). Before reuse, a connection is
+    checked with a non-blocking MSG_PEEK read so that sockets the origin
+    has closed in the meantime are discarded.
+
+    Pooled sockets are not registered with the selector; the caller
+    unregisters a socket before releasing it. The asyncio engine pools
+    its upstream protocols instead, with an is_alive check of its own;
+    anything with a close() method can be pooled.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host: int,
+        idle_timeout: float,
+        is_alive: Optional[Callable] = None,
+    ):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.is_alive = is_alive or _is_alive
+        self.reused = 0
+        self.discarded = 0
+        # (host, port) -> deque of (socket, idle since), oldest first
+        self._idle: dict[tuple[str, int], deque] = {}
+
+    def __len__(self) -> int:
+        return sum(len(idle) for idle in self._idle.values())
+
+    def acquire(
+        self, address: tuple[str, int], now: Optional[float] = None
+    ) -> Optional[socket.socket]:
+        """
+        Return a live idle connection to address, or None.
+        """
+        idle = self._idle.get(address)
+        if not idle:
+            return None
+        now = now if now is not None else time.monotonic()
+        while idle:
+            sock, since = idle.pop()
+            if now - since < self.idle_timeout and self.is_alive(sock):
+                self.reused += 1
+                if not idle:
+                    del self._idle[address]
+                return sock
+            self.discarded += 1
+            sock.close()
+        del self._idle[address]
+        return None
+
+    def release(
+        self,
+        address: tuple[str, int],
+        sock: socket.socket,
+        now: Optional[float] = None,
+    ) -> None:
+        """
+        Park an idle connection for reuse, closing the oldest one for
+        address if that exceeds max_idle_per_host.
+        """
+        if self.max_idle_per_host <= 0:
+            sock.close()
+            return
+        now = now if now is not None else time.monotonic()
+        idle = self._idle.setdefault(address, deque())
+        idle.append((sock, now))
+        while len(idle) > self.max_idle_per_host:
+            oldest, _ = idle.popleft()
+            self.discarded += 1
+            oldest.close()
+
+    def prune(self, now: Optional[float] = None) -> None:
+        """
+        Close connections that have been idle longer than idle_timeout.
+        """
+        now = now if now is not None else time.monotonic()
+        for address in list(self._idle):
+            idle = self._idle[address]
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                sock, _ = idle.popleft()
+                self.discarded += 1
+                sock.close()
+            if not idle:
+                del self._idle[address]
+
+    def close(self) -> None:
+        for idle in self._idle.values():
+            for sock, _ in idle:
+                sock.close()
+        self._idle.clear()
@@ -0,0 +1,58 @@
+import cProfile
+import logging
+import os
+import signal
+import time
+from typing import Optional
+
+# Signal that starts and stops profiling a worker
+PROFILE_SIGNAL = signal.SIGUSR2
+
+log = logging.getLogger(__name__)
+
+
+class WorkerProfiler:
+    """
+    cProfile for a running worker, toggled by PROFILE_SIGNAL.
+
+    The first signal starts profiling the event loop; the next one stops
+    it and writes the stats (readable with pstats or snakeviz) to
+    `directory`. Nothing is hooked in between, so an idle profiler costs
+    nothing.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self._profile: Optional[cProfile.Profile] = None
+
+    @property
+    def active(self) -> bool:
+        return self._profile is not None
+
+    def install(self) -> None:
+        signal.signal(PROFILE_SIGNAL, self.toggle)
+
+    def toggle(self, signum=None, frame=None) -> Optional[str]:
+        """
+        Start profiling, or stop and return the path the stats went to.
+        """
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            log.info("%s: profiling started", self.name)
+            return None
+        self._profile.disable()
+        profile, self._profile = self._profile, None
+        path = os.path.join(
+            self.directory,
+            f"{self.name}-{os.getpid()}-"
+            f"{time.strftime('%Y%m%d-%H%M%S')}.prof",
+        )
+        try:
+            profile.dump_stats(path)
+        except OSError as e:
+            log.error("%s: error writing profile: %s", self.name, e)
+            return None
+        log.info("%s: profile written to %s", self.name, path)
+        return path
@@ -0,0 +1,189 @@
+import abc
+import fcntl
+import logging
+import os
+import socket
+import sys
+
+RELAY_MODES = ("splice", "buffer")
+
+log = logging.getLogger(__name__)
+
+# Bytes a relay holds before its source stops being read
+RELAY_CAPACITY = 256 * 1024
+
+SPLICE_AVAILABLE = sys.platform.startswith("linux") and hasattr(os, "splice")
+SPLICE_FLAGS = (
+    os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if SPLICE_AVAILABLE else 0
+)
+
+
+class Relay(abc.ABC):
+    """
+    One direction of a tunnel: bytes read from a source socket wait here
+    until the destination socket accepts them.
+    """
+
+    capacity: int = RELAY_CAPACITY
+    pending: int = 0
+    # Bytes delivered to the destination so far
+    transferred: int = 0
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.capacity
+
+    @abc.abstractmethod
+    def feed(self, data: bytes) -> None:
+        """
+        Queue bytes produced by the proxy itself (e.g. a status line).
+        """
+
+    @abc.abstractmethod
+    def fill(self, src: socket.socket) -> bool:
+        """
+        Read what src has available. Returns False once src hits EOF.
+        """
+
+    @abc.abstractmethod
+    def drain(self, dst: socket.socket) -> int:
+        """
+        Write pending bytes to dst without blocking; returns bytes sent.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class BufferRelay(Relay):
+    """
+    Relay through a preallocated bytearray using recv_into and memoryview
+    slices, so no per-chunk bytes objects are created.
+    """
+
+    def __init__(self, capacity: int = RELAY_CAPACITY):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    @property
+    def pending(self) -> int:
+        return self._end - self._start
+
+    def _make_room(self) -> None:
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == self.capacity and self._start:
+            start, end = self._start, self._end
+            self._view[: end - start] = self._view[start:end]
+            self._start, self._end = 0, end - start
+
+    def feed(self, data: bytes) -> None:
+        self._make_room()
+        start, end = self._end, self._end + len(data)
+        if end > self.capacity:
+            raise BufferError("relay buffer full")
+        self._view[start:end] = data
+        self._end = end
+
+    def fill(self, src: socket.socket) -> bool:
+        self._make_room()
+        if self._end == self.capacity:
+            return True
+        end = self._end
+        try:
+            received = src.recv_into(self._view[end:])
+        except BlockingIOError:
+            return True
+        if not received:
+            return False
+        self._end += received
+        return True
+
+    def drain(self, dst: socket.socket) -> int:
+        if not self.pending:
+            return 0
+        try:
+            start, end = self._start, self._end
+            sent = dst.send(self._view[start:end])
+        except BlockingIOError:
+            return 0
+        self._start += sent
+        self.transferred += sent
+        return sent
+
+    def close(self) -> None:
+        self._view.release()
+
+
+class SpliceRelay(Relay):
+    """
+    Relay through a kernel pipe with splice(2): payload moves socket to
+    pipe to socket without ever being copied into the process.
+    """
+
+    def __init__(self, capacity: int = RELAY_CAPACITY):
+        self._read_fd, self._write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            self.capacity = fcntl.fcntl(
+                self._write_fd, fcntl.F_SETPIPE_SZ, capacity
+            )
+        except OSError:
+            # Above /proc/sys/fs/pipe-max-size; keep the default size
+            self.capacity = fcntl.fcntl(self._write_fd, fcntl.F_GETPIPE_SZ)
+        self.pending = 0
+
+    def feed(self, data: bytes) -> None:
+        written = os.write(self._write_fd, data)
+        if written != len(data):
+            raise BufferError("relay pipe full")
+        self.pending += written
+
+    def fill(self, src: socket.socket) -> bool:
+        room = self.capacity - self.pending
+        if room <= 0:
+            return True
+        try:
+            moved = os.splice(
+                src.fileno(), self._write_fd, room, flags=SPLICE_FLAGS
+            )
+        except BlockingIOError:
+            return True
+        if not moved:
+            return False
+        self.pending += moved
+        return True
+
+    def drain(self, dst: socket.socket) -> int:
+        if not self.pending:
+            return 0
+        try:
+            moved = os.splice(
+                self._read_fd, dst.fileno(), self.pending, flags=SPLICE_FLAGS
+            )
+        except BlockingIOError:
+            return 0
+        self.pending -= moved
+        self.transferred += moved
+        return moved
+
+    def close(self) -> None:
+        if self._read_fd >= 0:
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+            self._read_fd = self._write_fd = -1
+
+
+def make_relay(mode: str) -> Relay:
+    """
+    Build a relay for the configured mode. "splice" falls back to the
+    buffer relay where splice(2) is unavailable or a pipe cannot be made.
+    """
+    if mode == "splice" and SPLICE_AVAILABLE:
+        try:
+            return SpliceRelay()
+        except OSError as e:
+            log.warning("splice relay unavailable, using buffer relay: %s", e)
+    return BufferRelay()
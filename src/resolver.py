@@ -0,0 +1,149 @@
+import ipaddress
+import queue
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+# How long a name that does not exist is remembered
+NEGATIVE_TTL = 30
+# Resolution threads per worker
+RESOLVER_THREADS = 4
+# Entries kept before expired ones are purged
+MAX_ENTRIES = 10000
+
+# Called with (address, None) on success or (None, error) on failure
+ResolveCallback = Callable[[Optional[str], Optional[OSError]], None]
+
+
+class DNSResolver:
+    """
+    Per-worker DNS cache with resolution off the event loop.
+
+    Lookups that miss the cache run getaddrinfo in a small thread pool.
+    Finished lookups are queued and a byte is written to a socketpair
+    whose read end (wakeup_socket) sits in the worker's selector; the
+    worker then calls process_completions() on the loop thread, which
+    updates the cache and runs the callbacks. Names that do not exist
+    are cached for NEGATIVE_TTL seconds.
+    """
+
+    def __init__(
+        self,
+        ttl: int,
+        negative_ttl: int = NEGATIVE_TTL,
+        threads: int = RESOLVER_THREADS,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        # host -> (address or None for a nonexistent name, expires)
+        self._cache: dict[str, tuple[Optional[str], float]] = {}
+        # host -> callbacks waiting on an in-flight lookup
+        self._waiting: dict[str, list[ResolveCallback]] = {}
+        self._completed: queue.SimpleQueue = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="dns"
+        )
+        self.wakeup_socket, self._wakeup_writer = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.wakeup_socket.close()
+        self._wakeup_writer.close()
+
+    def resolve(self, host: str, callback: ResolveCallback) -> None:
+        """
+        Resolve host to an IPv4 address and pass the result to callback.
+
+        IP literals and cache hits call back immediately; otherwise the
+        callback runs from a later process_completions() call.
+        """
+        if _is_ip_address(host):
+            callback(host, None)
+            return
+
+        cached = self._cache.get(host)
+        if cached is not None:
+            address, expires = cached
+            if time.monotonic() < expires:
+                self.hits += 1
+                if address is None:
+                    callback(None, _nonexistent(host))
+                else:
+                    callback(address, None)
+                return
+            del self._cache[host]
+
+        self.misses += 1
+        if host in self._waiting:
+            self._waiting[host].append(callback)
+            return
+        self._waiting[host] = [callback]
+        self._executor.submit(self._lookup, host)
+
+    def _lookup(self, host: str) -> None:
+        """
+        Runs in a resolver thread.
+        """
+        try:
+            infos = socket.getaddrinfo(
+                host, None, socket.AF_INET, socket.SOCK_STREAM
+            )
+            result = (host, infos[0][4][0], None)
+        except OSError as e:
+            result = (host, None, e)
+        self._completed.put(result)
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            # Already signalled, or closing down
+            pass
+
+    def process_completions(self) -> None:
+        """
+        Cache finished lookups and run their callbacks. Call from the
+        event loop when wakeup_socket is readable.
+        """
+        try:
+            while self.wakeup_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while True:
+            try:
+                host, address, error = self._completed.get_nowait()
+            except queue.Empty:
+                break
+            now = time.monotonic()
+            if len(self._cache) >= MAX_ENTRIES:
+                self._purge(now)
+            if address is not None:
+                self._cache[host] = (address, now + self.ttl)
+            elif isinstance(error, socket.gaierror) and error.errno in (
+                socket.EAI_NONAME,
+                getattr(socket, "EAI_NODATA", socket.EAI_NONAME),
+            ):
+                self._cache[host] = (None, now + self.negative_ttl)
+            for callback in self._waiting.pop(host, []):
+                callback(address, error)
+
+    def _purge(self, now: float) -> None:
+        for host in [h for h, (_, exp) in self._cache.items() if exp <= now]:
+            del self._cache[host]
+
+
+def _is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.IPv4Address(host)
+        return True
+    except ValueError:
+        return False
+
+
+def _nonexistent(host: str) -> socket.gaierror:
+    return socket.gaierror(socket.EAI_NONAME, f"Name not known: {host}")
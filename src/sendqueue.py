@@ -0,0 +1,55 @@
+import socket
+from collections import deque
+from itertools import islice
+
+# Most chunks handed to one sendmsg call; well under IOV_MAX (1024 on
+# Linux, macOS)
+MAX_IOVECS = 64
+
+
+class SendQueue:
+    """
+    Bytes waiting to be written to a socket, kept as the chunks they were
+    queued in and written with sendmsg scatter-gather. Neither queueing
+    nor a partial send copies the bytes still pending; a partly sent
+    chunk is kept as a memoryview of its remainder.
+
+    Queued chunks must not change afterwards (bytes, or buffers nobody
+    writes to any more).
+    """
+
+    __slots__ = ("_chunks", "_size")
+
+    def __init__(self, data: bytes = b""):
+        self._chunks: deque = deque()
+        self._size = 0
+        self.append(data)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, data: bytes) -> None:
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def send(self, sock: socket.socket) -> int:
+        """
+        Write as much as the socket takes now; returns the bytes written.
+        Raises BlockingIOError if it takes none.
+        """
+        chunks = self._chunks
+        if len(chunks) == 1:
+            sent = sock.send(chunks[0])
+        else:
+            sent = sock.sendmsg(islice(chunks, MAX_IOVECS))
+        self._size -= sent
+        remaining = sent
+        while remaining:
+            chunk = chunks[0]
+            if len(chunk) > remaining:
+                chunks[0] = memoryview(chunk)[remaining:]
+                break
+            remaining -= len(chunk)
+            chunks.popleft()
+        return sent
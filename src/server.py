@@ -1,23 +1,65 @@
-from datastructures import ProxyConfig
-import multiprocessing
-from worker import worker
+import logging
+import signal
+import sys
+from admin import start_admin_server
+from logwriter import configure_logging
+from metrics import MetricsRegion
+from profiling import PROFILE_SIGNAL
+from supervisor import Supervisor, create_shared_cache, load_config
+
+log = logging.getLogger(__name__)
 
 
 def main():
-    config = ProxyConfig.from_env()
-    print(config)
-    # Create worker processes that will each create their own socket
-    # with SO_REUSEPORT
-    workers = []
-    for i in range(config.num_workers):
-        worker_process = multiprocessing.Process(
-            target=worker, args=(i, config)
+    config = load_config()
+    log_handler = configure_logging(config.log_level)
+    log.info("%s", config)
+
+    # The shared cache is created before forking so that every worker
+    # attaches to the same segment
+    shared_cache = create_shared_cache(config)
+    # Each worker writes its counters to its own block of this segment,
+    # with room for a second generation of workers during a reload
+    metrics = MetricsRegion.create(config.num_workers * 2)
+    supervisor = Supervisor(config, metrics, shared_cache)
+    admin = None
+
+    # Exit through the finally block below on SIGTERM so the shared
+    # memory segments are released
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        # Workers each create their own socket with SO_REUSEPORT
+        supervisor.start()
+
+        # Profiling the proxy means profiling its workers: pass the
+        # signal on to each of them
+        signal.signal(
+            PROFILE_SIGNAL,
+            lambda signum, frame: supervisor.signal_workers(signum),
+        )
+        signal.signal(
+            signal.SIGHUP, lambda signum, frame: supervisor.request_reload()
         )
-        worker_process.start()
-        workers.append(worker_process)
 
-    for worker_process in workers:
-        worker_process.join()
+        if config.admin_port:
+            try:
+                admin = start_admin_server(
+                    config.admin_address, config.admin_port, metrics
+                )
+            except OSError as e:
+                # The proxy itself keeps running without metrics
+                log.error("Error starting admin endpoint: %s", e)
+
+        supervisor.run()
+    finally:
+        supervisor.stop()
+        if admin is not None:
+            admin.shutdown()
+            admin.server_close()
+        metrics.close()
+        metrics.unlink()
+        log_handler.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,357 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import struct
+import time
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterator, Optional
+
+# Stripe header: next logical write position, then the pid of the
+# process holding the stripe's lock (0 while it is free)
+STRIPE_HEADER = struct.Struct("<Qq")
+POSITION = struct.Struct("<Q")
+HOLDER = struct.Struct("<q")
+HOLDER_OFFSET = POSITION.size
+# Index slot: key hash, logical record position, record length, expiry
+SLOT = struct.Struct("<QQId")
+# Record header in the data ring: key length, response length
+RECORD = struct.Struct("<II")
+
+DEFAULT_STRIPES = 16
+# Slots probed per lookup before giving up / picking a victim
+PROBE_LIMIT = 8
+# Expected average object size, used to size the index
+AVERAGE_OBJECT_SIZE = 4096
+# Failed attempts in a row at a stripe's lock before checking whether
+# its holder died
+TAKEOVER_AFTER = 8
+
+log = logging.getLogger(__name__)
+
+
+def _key_hash(key: str) -> int:
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    # 0 is never a valid hash so that zeroed memory reads as empty
+    return int.from_bytes(digest, "little") or 1
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedResponseCache:
+    """
+    Response cache in a shared memory segment used by every worker.
+
+    The segment is split into stripes, each guarded by its own lock and
+    holding an open-addressed index plus a log-structured data ring.
+    Responses are appended to the ring of their key's stripe; when the
+    ring wraps, the oldest records are overwritten, so eviction is FIFO
+    per stripe. A slot is only trusted while the record it points at has
+    not been overwritten (its logical position is within one ring length
+    of the write position) and the stored key matches. Expired entries
+    stay readable through get_stale() for `grace` seconds.
+
+    Locks are never waited on, so that a worker's event loop does not
+    stall: a lookup on a busy stripe is a miss and a store is skipped. A
+    process killed while holding a stripe's lock would leave it locked
+    for good, so the holder's pid is kept in the stripe header while it
+    holds the lock, and after TAKEOVER_AFTER failed attempts a process
+    takes over a lock whose holder has exited. The pid is written just
+    after the lock is taken and cleared just before it is released, so
+    a dead pid is only ever seen while that process holds the lock; a
+    holder killed between those steps leaves the stripe locked. A write
+    cut short never corrupts the stripe: the record is written before
+    the write position moves past it, and the slot pointing at it last.
+
+    Create it once in the master with create() before forking workers;
+    the workers use the inherited (or, with the spawn start method,
+    re-attached) segment and locks.
+    """
+
+    def __init__(
+        self,
+        shm: SharedMemory,
+        locks: list,
+        guard,
+        slots_per_stripe: int,
+        ttl: int,
+        max_object_size: int,
+        grace: int = 0,
+    ):
+        self._shm = shm
+        self._locks = locks
+        # Serializes taking over the locks of dead holders
+        self._guard = guard
+        self.stripes = len(locks)
+        # Failed attempts in a row at each stripe's lock
+        self._contended = [0] * self.stripes
+        self.slots_per_stripe = slots_per_stripe
+        self.ttl = ttl
+        self.grace = grace
+        self.stripe_size = shm.size // self.stripes
+        self.data_size = (
+            self.stripe_size
+            - STRIPE_HEADER.size
+            - slots_per_stripe * SLOT.size
+        )
+        # A record must fit comfortably in one stripe's ring
+        self.max_object_size = min(max_object_size, self.data_size // 4)
+        self.max_bytes = self.data_size * self.stripes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def create(
+        cls,
+        size: int,
+        ttl: int,
+        max_object_size: int,
+        stripes: int = DEFAULT_STRIPES,
+        grace: int = 0,
+    ) -> "SharedResponseCache":
+        """
+        Allocate a new zeroed segment of `size` bytes and its locks.
+        """
+        stripe_size = size // stripes
+        slots = max(64, stripe_size // AVERAGE_OBJECT_SIZE)
+        if stripe_size <= STRIPE_HEADER.size + slots * SLOT.size:
+            raise ValueError("cache_size too small for a shared cache")
+        shm = SharedMemory(create=True, size=stripe_size * stripes)
+        locks = [multiprocessing.Lock() for _ in range(stripes)]
+        guard = multiprocessing.Lock()
+        return cls(shm, locks, guard, slots, ttl, max_object_size, grace)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self) -> None:
+        self._shm.close()
+
+    def unlink(self) -> None:
+        """
+        Free the segment. Only the process that created it calls this.
+        """
+        self._shm.unlink()
+
+    @contextmanager
+    def _locked(self, key_hash: int) -> Iterator[bool]:
+        """
+        Hold the lock of key_hash's stripe, or yield False if it is busy.
+        """
+        stripe = key_hash % self.stripes
+        lock = self._locks[stripe]
+        holder = stripe * self.stripe_size + HOLDER_OFFSET
+        if lock.acquire(False):
+            HOLDER.pack_into(self._shm.buf, holder, os.getpid())
+        else:
+            self._contended[stripe] += 1
+            patient = self._contended[stripe] < TAKEOVER_AFTER
+            if patient or not self._take_over(stripe):
+                yield False
+                return
+        self._contended[stripe] = 0
+        try:
+            yield True
+        finally:
+            HOLDER.pack_into(self._shm.buf, holder, 0)
+            lock.release()
+
+    def _take_over(self, stripe: int) -> bool:
+        """
+        Claim the lock of a stripe whose holder exited without releasing
+        it. Returns False if the holder is still running or unknown.
+        """
+        if not self._guard.acquire(False):
+            return False
+        try:
+            buf = self._shm.buf
+            holder = stripe * self.stripe_size + HOLDER_OFFSET
+            (pid,) = HOLDER.unpack_from(buf, holder)
+            if not pid or _alive(pid):
+                return False
+            log.warning(
+                "Process %d exited holding shared cache stripe %d, "
+                "taking its lock over",
+                pid,
+                stripe,
+            )
+            # Claimed under the guard, so no other process takes it too
+            HOLDER.pack_into(buf, holder, os.getpid())
+            return True
+        finally:
+            self._guard.release()
+
+    def _stripe_base(self, key_hash: int) -> int:
+        return (key_hash % self.stripes) * self.stripe_size
+
+    def _slot_offset(self, base: int, index: int) -> int:
+        return base + STRIPE_HEADER.size + index * SLOT.size
+
+    def _data_offset(self, base: int) -> int:
+        return base + STRIPE_HEADER.size + self.slots_per_stripe * SLOT.size
+
+    def _probe(self, key_hash: int):
+        """
+        Yield the slot offsets a key may occupy, in probe order.
+        """
+        base = self._stripe_base(key_hash)
+        start = (key_hash // self.stripes) % self.slots_per_stripe
+        for i in range(PROBE_LIMIT):
+            index = (start + i) % self.slots_per_stripe
+            yield self._slot_offset(base, index)
+
+    def _read_record(
+        self, base: int, position: int, length: int, write_pos: int
+    ) -> Optional[tuple[bytes, memoryview]]:
+        """
+        Return (key, response view) for the record at a logical position,
+        or None if it has been overwritten since.
+        """
+        if length == 0 or write_pos > position + self.data_size:
+            return None
+        buf = self._shm.buf
+        offset = self._data_offset(base) + position % self.data_size
+        key_len, value_len = RECORD.unpack_from(buf, offset)
+        key_start = offset + RECORD.size
+        value_start = key_start + key_len
+        value_end = value_start + value_len
+        return bytes(buf[key_start:value_start]), buf[value_start:value_end]
+
+    def get(self, key: str, now: Optional[float] = None) -> Optional[bytes]:
+        """
+        Return the cached response for key, or None on a miss.
+        """
+        now = now if now is not None else time.time()
+        found = self._find(key, now, stale=False)
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return found[0]
+
+    def get_stale(
+        self, key: str, now: Optional[float] = None
+    ) -> Optional[tuple[bytes, float]]:
+        """
+        Return (response, seconds since it expired) for an expired entry
+        still within its grace period, or None.
+        """
+        now = now if now is not None else time.time()
+        found = self._find(key, now, stale=True)
+        if found is None:
+            return None
+        return found[0], now - found[1]
+
+    def _find(
+        self, key: str, now: float, stale: bool
+    ) -> Optional[tuple[bytes, float]]:
+        """
+        Return (response, expiry) for key if it is fresh, or with stale,
+        if it has expired within its grace period. Entries past their
+        grace period are cleared.
+        """
+        key_hash = _key_hash(key)
+        key_bytes = key.encode("utf-8")
+        base = self._stripe_base(key_hash)
+        buf = self._shm.buf
+        with self._locked(key_hash) as locked:
+            if not locked:
+                return None
+            (write_pos,) = POSITION.unpack_from(buf, base)
+            for slot in self._probe(key_hash):
+                slot_hash, position, length, expires = SLOT.unpack_from(
+                    buf, slot
+                )
+                if slot_hash != key_hash:
+                    continue
+                record = self._read_record(base, position, length, write_pos)
+                if record is None or record[0] != key_bytes:
+                    continue
+                if now >= expires + self.grace:
+                    SLOT.pack_into(buf, slot, 0, 0, 0, 0.0)
+                    break
+                if (now >= expires) != stale:
+                    break
+                return bytes(record[1]), expires
+        return None
+
+    def put(
+        self,
+        key: str,
+        response: bytes,
+        now: Optional[float] = None,
+        ttl: Optional[float] = None,
+    ) -> bool:
+        """
+        Store response under key, fresh for ttl seconds (default: the
+        cache's ttl). Returns False if it is too large to cache, or its
+        stripe stayed locked.
+        """
+        if len(response) > self.max_object_size:
+            return False
+        now = now if now is not None else time.time()
+        ttl = ttl if ttl is not None else self.ttl
+        key_hash = _key_hash(key)
+        key_bytes = key.encode("utf-8")
+        length = RECORD.size + len(key_bytes) + len(response)
+        base = self._stripe_base(key_hash)
+        buf = self._shm.buf
+        with self._locked(key_hash) as locked:
+            if not locked:
+                return False
+            (write_pos,) = POSITION.unpack_from(buf, base)
+            # Records never straddle the end of the ring
+            if write_pos % self.data_size + length > self.data_size:
+                write_pos += self.data_size - write_pos % self.data_size
+            position = write_pos
+            offset = self._data_offset(base) + position % self.data_size
+            RECORD.pack_into(buf, offset, len(key_bytes), len(response))
+            key_start = offset + RECORD.size
+            value_start = key_start + len(key_bytes)
+            value_end = offset + length
+            buf[key_start:value_start] = key_bytes
+            buf[value_start:value_end] = response
+            write_pos = position + length
+            POSITION.pack_into(buf, base, write_pos)
+
+            # Reuse this key's slot, else a dead one, else the oldest
+            victim = None
+            victim_position = None
+            for slot in self._probe(key_hash):
+                slot_hash, slot_position, slot_length, _ = SLOT.unpack_from(
+                    buf, slot
+                )
+                if slot_hash == key_hash or slot_length == 0:
+                    victim = slot
+                    break
+                if write_pos > slot_position + self.data_size:
+                    victim = slot
+                    break
+                if victim_position is None or slot_position < victim_position:
+                    victim, victim_position = slot, slot_position
+            else:
+                self.evictions += 1
+            SLOT.pack_into(buf, victim, key_hash, position, length, now + ttl)
+        return True
+
+    def remove(self, key: str) -> None:
+        key_hash = _key_hash(key)
+        buf = self._shm.buf
+        with self._locked(key_hash) as locked:
+            if not locked:
+                return
+            for slot in self._probe(key_hash):
+                if SLOT.unpack_from(buf, slot)[0] == key_hash:
+                    SLOT.pack_into(buf, slot, 0, 0, 0, 0.0)
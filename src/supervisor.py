@@ -0,0 +1,378 @@
+import dataclasses
+import logging
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import time
+from dataclasses import dataclass
+from multiprocessing.connection import wait
+from typing import Iterator, Optional
+from affinity import affinity_cpus
+from asyncio_worker import asyncio_worker
+from datastructures import ProxyConfig
+from metrics import MetricsRegion
+from shared_cache import SharedResponseCache
+from worker import DRAIN_SIGNAL, worker
+
+# Seconds between checks on the workers when nothing else is due
+SUPERVISE_INTERVAL = 1.0
+
+# Delay before respawning a worker that died; it doubles with every
+# death in a row, up to RESPAWN_MAX_DELAY
+RESPAWN_DELAY = 0.5
+RESPAWN_MAX_DELAY = 30.0
+# A worker that ran at least this long before dying is respawned at once
+STABLE_AFTER = 30.0
+
+# Seconds new workers have to start listening on reload; the old ones
+# are only drained once at least one new worker is up
+READY_TIMEOUT = 10.0
+# Seconds past drain_timeout before a draining worker is terminated
+DRAIN_GRACE = 5.0
+
+# Settings the running master cannot change on reload
+FIXED_SETTINGS = ("num_workers", "admin_address", "admin_port")
+
+log = logging.getLogger(__name__)
+
+
+def read_env_file(path: str) -> dict[str, str]:
+    """
+    KEY=VALUE lines of a file; blank lines and lines starting with #
+    are skipped.
+    """
+    env = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, sep, value = line.partition("=")
+            if not sep:
+                raise ValueError(f"{path}:{number}: expected KEY=VALUE")
+            env[key.strip()] = value.strip()
+    return env
+
+
+def load_config() -> ProxyConfig:
+    """
+    ProxyConfig from the environment, overridden by the settings in
+    CONFIG_FILE if it is set. A reload reads the file again; the
+    environment is the one the server started with.
+    """
+    env = dict(os.environ)
+    path = env.get("CONFIG_FILE")
+    if path:
+        env.update(read_env_file(path))
+    return ProxyConfig.from_env(env)
+
+
+def create_shared_cache(
+    config: ProxyConfig,
+) -> Optional[SharedResponseCache]:
+    """
+    The cache segment shared by the workers of `config`, if it uses one.
+    """
+    if config.cache_backend != "shared" or config.cache_size <= 0:
+        return None
+    return SharedResponseCache.create(
+        config.cache_size,
+        config.cache_ttl,
+        config.cache_max_object_size,
+        grace=config.cache_grace,
+    )
+
+
+def shared_cache_settings(config: ProxyConfig) -> tuple:
+    """
+    What a shared cache segment is created with: workers of configs
+    that agree on these can share one.
+    """
+    return (
+        config.cache_backend,
+        config.cache_size,
+        config.cache_ttl,
+        config.cache_max_object_size,
+        config.cache_grace,
+    )
+
+
+@dataclass
+class WorkerProcess:
+    """
+    A worker process as seen from the master.
+    """
+
+    # Position among the num_workers workers, kept by its replacements
+    slot: int
+    # Its block in the MetricsRegion
+    id: int
+    process: multiprocessing.Process
+    ready: multiprocessing.synchronize.Event
+    started: float
+    shared_cache: Optional[SharedResponseCache]
+    # When a draining worker is terminated if it has not exited
+    drain_deadline: float = 0.0
+
+
+class Supervisor:
+    """
+    Keeps config.num_workers workers running: a worker that dies is
+    respawned after a delay that grows while it keeps dying, and a
+    reload starts a new generation of workers with the new configuration
+    before draining the old one.
+
+    The MetricsRegion holds two blocks per slot so that the workers of
+    two generations can run side by side; a reload waits for the drain
+    of the one before it to finish.
+    """
+
+    def __init__(
+        self,
+        config: ProxyConfig,
+        metrics: MetricsRegion,
+        shared_cache: Optional[SharedResponseCache] = None,
+    ):
+        self.config = config
+        self.metrics = metrics
+        self.shared_cache = shared_cache
+        self.generation = 0
+        # Current workers by slot, and the previous generation's
+        self.workers: dict[int, WorkerProcess] = {}
+        self.draining: list[WorkerProcess] = []
+        # Deaths in a row and when to respawn, by slot
+        self.failures: dict[int, int] = {}
+        self.respawn_at: dict[int, float] = {}
+        # Shared caches of earlier configurations, released once no
+        # worker uses them
+        self.retired_caches: list[SharedResponseCache] = []
+        self.reload_requested = False
+        self.stopping = False
+
+    def start(self) -> None:
+        for slot in range(self.config.num_workers):
+            self.workers[slot] = self.spawn(slot)
+
+    def processes(self) -> Iterator[WorkerProcess]:
+        yield from self.workers.values()
+        yield from self.draining
+
+    def spawn(self, slot: int) -> WorkerProcess:
+        config = self.config
+        id = (self.generation % 2) * config.num_workers + slot
+        self.metrics.reset_gauges(id)
+        engine = asyncio_worker if config.engine == "asyncio" else worker
+        ready = multiprocessing.Event()
+        # Replacements of a worker go back to its CPU
+        cpus = affinity_cpus(config.cpu_affinity)
+        cpu = cpus[slot % len(cpus)] if cpus else None
+        process = multiprocessing.Process(
+            target=engine,
+            args=(id, config, self.shared_cache, self.metrics, ready, cpu),
+        )
+        process.start()
+        return WorkerProcess(
+            slot=slot,
+            id=id,
+            process=process,
+            ready=ready,
+            started=time.monotonic(),
+            shared_cache=self.shared_cache,
+        )
+
+    def signal_workers(self, signum: int) -> None:
+        for worker_process in self.workers.values():
+            if worker_process.process.is_alive():
+                os.kill(worker_process.process.pid, signum)
+
+    def request_reload(self) -> None:
+        """
+        Reload at the next pass of run(); safe to call from a signal
+        handler.
+        """
+        self.reload_requested = True
+
+    def run(self) -> None:
+        """
+        Supervise the workers until stop() is called.
+        """
+        while not self.stopping:
+            if self.reload_requested and not self.draining:
+                self.reload_requested = False
+                try:
+                    config = load_config()
+                except (OSError, ValueError) as e:
+                    log.error("Not reloading: %s", e)
+                else:
+                    self.reload(config)
+            now = time.monotonic()
+            self.respawn_due(now)
+            self.stop_overdue(now)
+            timeout = SUPERVISE_INTERVAL
+            if self.respawn_at:
+                timeout = min(timeout, min(self.respawn_at.values()) - now)
+            wait(
+                [w.process.sentinel for w in self.processes()],
+                max(timeout, 0),
+            )
+            self.reap()
+
+    def reap(self) -> None:
+        """
+        Collect the workers that exited, scheduling the respawn of
+        current ones.
+        """
+        now = time.monotonic()
+        for slot, worker_process in list(self.workers.items()):
+            process = worker_process.process
+            if process.exitcode is None:
+                continue
+            process.join()
+            self.metrics.reset_gauges(worker_process.id)
+            del self.workers[slot]
+            failures = 0
+            if now - worker_process.started < STABLE_AFTER:
+                failures = self.failures.get(slot, 0) + 1
+            self.failures[slot] = failures
+            delay = 0.0
+            if failures:
+                delay = min(
+                    RESPAWN_DELAY * 2 ** (failures - 1), RESPAWN_MAX_DELAY
+                )
+            log.warning(
+                "Worker %d exited with code %s, respawning in %.1fs",
+                worker_process.id,
+                process.exitcode,
+                delay,
+            )
+            self.respawn_at[slot] = now + delay
+        for worker_process in self.draining[:]:
+            process = worker_process.process
+            if process.exitcode is None:
+                continue
+            process.join()
+            self.metrics.reset_gauges(worker_process.id)
+            self.draining.remove(worker_process)
+            log.info("Worker %d drained", worker_process.id)
+        self.release_retired_caches()
+
+    def respawn_due(self, now: float) -> None:
+        for slot, at in list(self.respawn_at.items()):
+            if at <= now:
+                del self.respawn_at[slot]
+                self.workers[slot] = self.spawn(slot)
+
+    def stop_overdue(self, now: float) -> None:
+        """
+        Terminate draining workers that are past their drain deadline.
+        """
+        for worker_process in self.draining:
+            if now >= worker_process.drain_deadline:
+                log.warning(
+                    "Worker %d did not drain in time, terminating",
+                    worker_process.id,
+                )
+                worker_process.process.terminate()
+                worker_process.drain_deadline = float("inf")
+
+    def reload(self, config: ProxyConfig) -> bool:
+        """
+        Replace the workers with ones running `config`: start them, wait
+        until they are listening, then drain the old ones. Returns False
+        (keeping the old workers) if the new shared cache cannot be
+        created or none of the new workers came up.
+        """
+        changes = {}
+        for name in FIXED_SETTINGS:
+            if getattr(config, name) != getattr(self.config, name):
+                log.warning(
+                    "%s cannot change on reload, keeping %s",
+                    name,
+                    getattr(self.config, name),
+                )
+                changes[name] = getattr(self.config, name)
+        if changes:
+            config = dataclasses.replace(config, **changes)
+        old_config, old_cache = self.config, self.shared_cache
+        new_cache = old_cache
+        if shared_cache_settings(config) != shared_cache_settings(old_config):
+            # Settings can pass validation and still fail to allocate
+            try:
+                new_cache = create_shared_cache(config)
+            except (OSError, ValueError) as e:
+                log.error("Not reloading: %s", e)
+                return False
+        old_workers = list(self.workers.values())
+        self.config, self.shared_cache = config, new_cache
+        self.generation += 1
+        self.failures.clear()
+        self.respawn_at.clear()
+        self.workers = {}
+        self.start()
+
+        deadline = time.monotonic() + READY_TIMEOUT
+        started = [
+            w
+            for w in self.workers.values()
+            if w.ready.wait(max(deadline - time.monotonic(), 0))
+        ]
+        if not started:
+            log.error("No new worker started, keeping the old ones")
+            for worker_process in self.workers.values():
+                worker_process.process.terminate()
+                worker_process.process.join()
+                self.metrics.reset_gauges(worker_process.id)
+            if self.shared_cache is not old_cache:
+                self.retired_caches.append(self.shared_cache)
+            self.config, self.shared_cache = old_config, old_cache
+            self.generation -= 1
+            self.workers = {w.slot: w for w in old_workers}
+            self.release_retired_caches()
+            return False
+
+        if self.shared_cache is not old_cache and old_cache is not None:
+            self.retired_caches.append(old_cache)
+        drain_deadline = (
+            time.monotonic() + old_config.drain_timeout + DRAIN_GRACE
+        )
+        for worker_process in old_workers:
+            if worker_process.process.is_alive():
+                worker_process.drain_deadline = drain_deadline
+                os.kill(worker_process.process.pid, DRAIN_SIGNAL)
+                self.draining.append(worker_process)
+            else:
+                worker_process.process.join()
+                self.metrics.reset_gauges(worker_process.id)
+        logging.getLogger().setLevel(config.log_level)
+        log.info(
+            "Reloaded: %d of %d new workers started",
+            len(started),
+            config.num_workers,
+        )
+        return True
+
+    def release_retired_caches(self) -> None:
+        in_use = {id(w.shared_cache) for w in self.processes()}
+        for cache in self.retired_caches[:]:
+            if cache is None or id(cache) not in in_use:
+                self.retired_caches.remove(cache)
+                if cache is not None:
+                    cache.close()
+                    cache.unlink()
+
+    def stop(self) -> None:
+        """
+        Terminate every worker and release the shared caches.
+        """
+        self.stopping = True
+        for worker_process in self.processes():
+            if worker_process.process.is_alive():
+                worker_process.process.terminate()
+        for worker_process in self.processes():
+            worker_process.process.join()
+        self.workers = {}
+        self.draining = []
+        if self.shared_cache is not None:
+            self.retired_caches.append(self.shared_cache)
+            self.shared_cache = None
+        self.release_retired_caches()
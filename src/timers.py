@@ -0,0 +1,114 @@
+import heapq
+import itertools
+from typing import Callable, Optional
+
+# Dead entries tolerated before the heap is rebuilt without them
+COMPACT_MIN = 256
+
+
+class Timer:
+    """
+    A callback a TimerHeap runs once its deadline (time.monotonic()) has
+    passed. The same timer can be armed again after it fired or was
+    cancelled.
+    """
+
+    __slots__ = ("callback", "deadline", "_entry")
+
+    def __init__(self, callback: Callable[[], None]):
+        self.callback = callback
+        # None while not armed
+        self.deadline: Optional[float] = None
+        # This timer's entry in the heap, which may be due earlier than
+        # deadline
+        self._entry: Optional[list] = None
+
+    @property
+    def armed(self) -> bool:
+        return self.deadline is not None
+
+
+class TimerHeap:
+    """
+    Deadlines of an event loop: a binary heap of [deadline, sequence,
+    timer] entries.
+
+    Pushing a deadline back, which happens on every event of an active
+    connection, only updates the timer; its entry is re-queued for the
+    new deadline once the old one comes up. Cancelled entries are
+    dropped as they reach the top, or all at once when they make up
+    most of the heap.
+    """
+
+    def __init__(self):
+        self._heap: list[list] = []
+        self._sequence = itertools.count()
+        self._dead = 0
+
+    def __len__(self) -> int:
+        return len(self._heap) - self._dead
+
+    def arm(self, timer: Timer, deadline: float) -> None:
+        """
+        (Re)arm timer to fire at deadline.
+        """
+        timer.deadline = deadline
+        entry = timer._entry
+        if entry is not None:
+            if entry[0] <= deadline:
+                return
+            self._kill(entry)
+        self._push(timer, deadline)
+
+    def cancel(self, timer: Timer) -> None:
+        timer.deadline = None
+        if timer._entry is not None:
+            self._kill(timer._entry)
+            timer._entry = None
+            if self._dead > COMPACT_MIN and self._dead * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if e[2] is not None]
+                heapq.heapify(self._heap)
+                self._dead = 0
+
+    def timeout(self, now: float) -> Optional[float]:
+        """
+        Seconds until the first entry is due (0 if it is overdue), or
+        None if nothing is armed.
+        """
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self._dead -= 1
+        if not heap:
+            return None
+        return max(heap[0][0] - now, 0.0)
+
+    def run(self, now: float) -> int:
+        """
+        Fire the timers due by now; returns how many fired.
+        """
+        heap = self._heap
+        fired = 0
+        while heap and heap[0][0] <= now:
+            _, _, timer = heapq.heappop(heap)
+            if timer is None:
+                self._dead -= 1
+                continue
+            timer._entry = None
+            if timer.deadline > now:
+                # Pushed back since this entry was queued
+                self._push(timer, timer.deadline)
+                continue
+            timer.deadline = None
+            fired += 1
+            timer.callback()
+        return fired
+
+    def _push(self, timer: Timer, deadline: float) -> None:
+        entry = [deadline, next(self._sequence), timer]
+        timer._entry = entry
+        heapq.heappush(self._heap, entry)
+
+    def _kill(self, entry: list) -> None:
+        entry[2] = None
+        self._dead += 1
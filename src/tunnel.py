@@ -1,5 +1,13 @@
+import logging
 import socket
-import select
+import selectors
+from datastructures import Connection, ConnectionState, Tunnel
+from relay import make_relay
+from upstream import check_upstream_connected, connect_upstream
+
+ESTABLISHED_RESPONSE = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+
+log = logging.getLogger(__name__)
 
 
 def parse_host_port(host_string: str) -> tuple[str, int]:
@@ -18,101 +26,130 @@ def parse_host_port(host_string: str) -> tuple[str, int]:
     return (host_string, 80)
 
 
-def handle_https_tunnel(client_socket: socket.socket, target_url: str):
+def open_tunnel(
+    conn: Connection, target_url: str, pending: bytes, relay_mode: str
+) -> None:
+    """
+    Set up a CONNECT tunnel for conn towards target_url.
+
+    The caller resolves conn.upstream_address and then calls
+    connect_tunnel. `pending` holds any bytes the client sent after the
+    CONNECT request headers. relay_mode selects how bytes are moved once
+    the tunnel is up (see relay.py).
     """
-    Handle HTTPS tunneling for CONNECT requests.
+    conn.upstream_address = parse_host_port(target_url)
+    log.debug("Tunneling to %s:%s", *conn.upstream_address)
+    conn.tunnel = Tunnel(
+        to_upstream=make_relay(relay_mode), to_client=make_relay(relay_mode)
+    )
+    if pending:
+        conn.tunnel.to_upstream.feed(pending)
 
-    This establishes a bidirectional TCP tunnel between the client
-    and the upstream server, allowing encrypted HTTPS traffic to pass
-    through without inspection.
 
-    Args:
-        client_socket: The client's socket connection
-        target_url: The target host:port from the CONNECT request
+def connect_tunnel(conn: Connection, address: tuple[str, int]) -> None:
     """
-    hostname, port = parse_host_port(target_url)
-    print(f"Tunneling to {hostname}:{port}")
+    Start the tunnel's upstream connect to a resolved address.
 
-    upstream_socket = None
+    The connect is non-blocking; the 200 response is queued for the
+    client once it completes (see pump_tunnel).
+    """
+    conn.upstream_socket = connect_upstream(address)
+    conn.state = ConnectionState.TUNNEL
+
+
+def tunnel_interest(conn: Connection) -> tuple[int, int]:
+    """
+    Return the selector events wanted for the (client, upstream) sockets.
+    """
+    tunnel = conn.tunnel
+    if not tunnel.connected:
+        return 0, selectors.EVENT_WRITE
+
+    client_events = 0
+    upstream_events = 0
+    # Reading from a side pauses while the relay towards its peer is
+    # full, so a fast sender cannot outrun a slow receiver.
+    if not tunnel.client_eof and not tunnel.to_upstream.full:
+        client_events |= selectors.EVENT_READ
+    if tunnel.to_client.pending:
+        client_events |= selectors.EVENT_WRITE
+    if not tunnel.upstream_eof and not tunnel.to_client.full:
+        upstream_events |= selectors.EVENT_READ
+    if tunnel.to_upstream.pending:
+        upstream_events |= selectors.EVENT_WRITE
+    return client_events, upstream_events
+
+
+def tunnel_finished(conn: Connection) -> bool:
+    """
+    Return True once both directions have closed and drained.
+    """
+    tunnel = conn.tunnel
+    return (
+        tunnel.client_eof
+        and tunnel.upstream_eof
+        and not tunnel.to_client.pending
+        and not tunnel.to_upstream.pending
+    )
 
-    try:
-        # Connect to the upstream server
-        upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        upstream_socket.connect((hostname, port))
 
-        # Send success response to client
-        success_response = b"HTTP/1.1 200 Connection Established\r\n\r\n"
-        client_socket.send(success_response)
-        print("Sent 200 Connection Established to client")
+def close_tunnel(conn: Connection) -> None:
+    """
+    Release the relays of conn's tunnel, if it has one.
+    """
+    if conn.tunnel is not None:
+        conn.tunnel.to_upstream.close()
+        conn.tunnel.to_client.close()
+        conn.tunnel = None
 
-        # Configure sockets for tunneling
-        client_socket.setblocking(True)
-        upstream_socket.setblocking(True)
-        client_socket.settimeout(0.5)
-        upstream_socket.settimeout(0.5)
 
-        print("Starting bidirectional tunnel...")
+def pump_tunnel(conn: Connection, sock: socket.socket, mask: int) -> None:
+    """
+    Move bytes for a readiness event on either end of a tunnel.
 
-        # Bidirectional tunneling loop
-        try:
-            while True:
-                # Check which sockets are ready to read
-                readable, _, exceptional = select.select(
-                    [client_socket, upstream_socket],
-                    [],
-                    [client_socket, upstream_socket],
-                    60.0,
-                )
-
-                if exceptional:
-                    print("Exceptional condition on socket")
-                    break
-
-                if not readable:
-                    # Timeout - continue to check for data
-                    continue
-
-                for sock in readable:
-                    try:
-                        data = sock.recv(8192)
-                        if not data:
-                            # Connection closed - normal end
-                            print("Tunnel closed normally")
-                            return  # Exit tunnel loop
-
-                        # Forward data to the other socket
-                        if sock is client_socket:
-                            # Client -> Upstream
-                            upstream_socket.sendall(data)
-                            msg = (
-                                f"Forwarded {len(data)} "
-                                "bytes client->upstream"
-                            )
-                            print(msg)
-                        else:
-                            # Upstream -> Client
-                            client_socket.sendall(data)
-                            msg = (
-                                f"Forwarded {len(data)} "
-                                "bytes upstream->client"
-                            )
-                            print(msg)
-                    except socket.timeout:
-                        # Timeout is normal, continue
-                        continue
-                    except Exception as e:
-                        print(f"Error forwarding: {e}")
-                        return  # Exit on error
-        except KeyboardInterrupt:
-            print("Tunnel interrupted")
-        except Exception as e:
-            print(f"Tunnel error: {e}")
-
-    except Exception as e:
-        print(f"Error in CONNECT tunnel: {e}")
-    finally:
-        if upstream_socket:
-            try:
-                upstream_socket.close()
-            except Exception:
-                pass
+    Errors (resets, refused connects) propagate to the caller, which
+    tears the tunnel down.
+    """
+    tunnel = conn.tunnel
+    if not tunnel.connected:
+        check_upstream_connected(conn.upstream_socket)
+        tunnel.connected = True
+        tunnel.to_client.feed(ESTABLISHED_RESPONSE)
+        log.debug("Tunnel established")
+        tunnel.to_client.drain(conn.socket)
+        return
+
+    from_client = sock is conn.socket
+    peer = conn.upstream_socket if from_client else conn.socket
+    inbound = tunnel.to_upstream if from_client else tunnel.to_client
+    outbound = tunnel.to_client if from_client else tunnel.to_upstream
+
+    if mask & selectors.EVENT_READ:
+        was_empty = not inbound.pending
+        if not inbound.fill(sock):
+            if from_client:
+                tunnel.client_eof = True
+            else:
+                tunnel.upstream_eof = True
+        elif was_empty and inbound.pending:
+            # Write straight through instead of waiting a loop turn
+            inbound.drain(peer)
+
+    if mask & selectors.EVENT_WRITE:
+        outbound.drain(sock)
+
+    # Propagate half-closes once everything before the EOF is delivered
+    if (
+        tunnel.client_eof
+        and not tunnel.to_upstream.pending
+        and not tunnel.upstream_shut
+    ):
+        conn.upstream_socket.shutdown(socket.SHUT_WR)
+        tunnel.upstream_shut = True
+    if (
+        tunnel.upstream_eof
+        and not tunnel.to_client.pending
+        and not tunnel.client_shut
+    ):
+        conn.socket.shutdown(socket.SHUT_WR)
+        tunnel.client_shut = True
@@ -1,15 +1,37 @@
+import errno
 import socket
 
 
 def connect_upstream(upstream_address: tuple[str, int]) -> socket.socket:
     """
-    Connect to an upstream address and return a socket.
+    Start a non-blocking connect to an upstream address and return the
+    socket. The connect completes in the background; the socket becomes
+    writable once it is established (see check_upstream_connected).
     """
     upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    upstream_socket.connect(upstream_address)
+    upstream_socket.setblocking(False)
+    err = upstream_socket.connect_ex(upstream_address)
+    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        upstream_socket.close()
+        raise OSError(
+            err,
+            f"connect to {upstream_address}: "
+            f"{errno.errorcode.get(err, err)}",
+        )
     return upstream_socket  # type: ignore
 
 
+def check_upstream_connected(upstream_socket: socket.socket) -> None:
+    """
+    Raise OSError if a non-blocking connect on upstream_socket failed.
+    """
+    err = upstream_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if err:
+        raise OSError(
+            err, f"upstream connect failed: {errno.errorcode.get(err, err)}"
+        )
+
+
 def send_request(upstream_socket: socket.socket, request: bytes) -> bytes:
     """
     Send a request to an upstream socket and return the response.
@@ -1,253 +1,1638 @@
+import logging
+import multiprocessing.synchronize
+import os
+import signal
 import socket
 import selectors
-from datastructures import Connection, ConnectionState, ProxyConfig
-from http_parser import parse_http_request
-from upstream import connect_upstream
-from tunnel import handle_https_tunnel, parse_host_port
+import time
+from typing import BinaryIO, Callable, Optional
+from datastructures import (
+    Connection,
+    ConnectionState,
+    ProxyConfig,
+    RequestLog,
+    StaleResponse,
+    WorkerContext,
+)
+from cache import ResponseCache
+from disk_cache import DiskCache
+from admission import make_admission
+from affinity import pin_to_cpu, set_incoming_cpu
+from metrics import MetricsRegion
+from accesslog import AccessLog
+from logwriter import configure_logging
+from profiling import WorkerProfiler
+from freshness import (
+    primary_key,
+    request_cacheable,
+    request_wants_validation,
+    response_ttl,
+    stale_windows,
+    variant_key,
+    vary_names,
+)
+from pool import UpstreamPool
+from resolver import DNSResolver
+from sendqueue import SendQueue
+from timers import Timer
+from shared_cache import SharedResponseCache
+from http_parser import (
+    MAX_RESPONSE_HEAD,
+    Request,
+    RequestError,
+    RequestParser,
+    ResponseFramer,
+    build_cache_key,
+    build_http_response,
+    conditional_request,
+    parse_response_headers,
+    prepare_upstream_request,
+    rewrite_response_head,
+    update_stored_head,
+)
+from upstream import check_upstream_connected, connect_upstream
+from tunnel import (
+    close_tunnel,
+    connect_tunnel,
+    open_tunnel,
+    parse_host_port,
+    pump_tunnel,
+    tunnel_finished,
+    tunnel_interest,
+)
 
+# Largest slice of a disk cache file handed to one sendfile call
+SENDFILE_CHUNK = 1024 * 1024
 
-def handle_accept(
-    listen_sock: socket.socket,
+# Response bytes buffered per connection before upstream reads pause
+RESPONSE_BUFFER_SIZE = 64 * 1024
+
+# Requests that may be resent when a pooled connection turns out stale
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE")
+
+# Unread client bytes discarded before closing after a response
+DISCARD_LIMIT = 256 * 1024
+
+# Answer to connections past max_connections, built once: sending it
+# costs a single write to a socket that is never registered
+OVERLOAD_RESPONSE = build_http_response(
+    503,
+    {"Content-Length": "0", "Connection": "close", "Retry-After": "1"},
+    b"",
+)
+
+# Seconds between copies of the cache counters into the metrics
+METRICS_INTERVAL = 1.0
+
+# Signal telling a worker to stop accepting, finish the requests it has
+# in flight and exit (sent by the master on reload)
+DRAIN_SIGNAL = signal.SIGUSR1
+
+log = logging.getLogger(__name__)
+
+
+def update_interest(
     selector: selectors.DefaultSelector,
-    connections: dict[int, Connection],
+    sock: socket.socket,
+    events: int,
+    conn: Connection,
 ) -> None:
+    """
+    Make the selector watch sock for exactly `events` (0 means not at all).
+    A missing socket (a background revalidation's client) is ignored.
+    """
+    if sock is None:
+        return
     try:
-        client_sock, addr = listen_sock.accept()
+        key = selector.get_key(sock)
+    except KeyError:
+        key = None
+    if not events:
+        if key is not None:
+            selector.unregister(sock)
+    elif key is None:
+        selector.register(sock, events, conn)
+    elif key.events != events:
+        selector.modify(sock, events, conn)
+
+
+def close_connection(
+    conn: Connection,
+    ctx: WorkerContext,
+) -> None:
+    """
+    Unregister and close both sides of a connection.
+    """
+    if conn.leader is not None:
+        conn.leader.followers.remove(conn)
+        conn.leader = None
+    hand_over_followers(conn, ctx)
+    if conn.socket is None:
+        ctx.revalidating.discard(conn.cache_key)
+    conn.state = ConnectionState.CLOSED
+    if conn.timer is not None:
+        ctx.timers.cancel(conn.timer)
+        conn.timer = None
+    for sock in (conn.upstream_socket, conn.socket):
+        if sock is None:
+            continue
+        try:
+            fd = sock.fileno()
+            update_interest(ctx.selector, sock, 0, conn)
+            sock.close()
+            if sock is conn.socket and fd in ctx.connections:
+                del ctx.connections[fd]
+                ctx.metrics.add("proxy_active_connections", -1)
+        except Exception as e:
+            log.warning("Error closing connection: %s", e)
+    conn.upstream_socket = None
+    end_tunnel(conn, ctx)
+    if conn.cache_file is not None:
+        conn.cache_file.abort()
+        conn.cache_file = None
+    if conn.send_file is not None:
+        conn.send_file.close()
+        conn.send_file = None
+
+
+def shed_connection(client_sock: socket.socket, ctx: WorkerContext) -> None:
+    """
+    Turn away a connection the worker has no room for with
+    OVERLOAD_RESPONSE, without registering it.
+    """
+    ctx.metrics.add("proxy_connections_shed_total")
+    try:
+        client_sock.setblocking(False)
+        client_sock.send(OVERLOAD_RESPONSE)
+        client_sock.shutdown(socket.SHUT_WR)
+        discard_unread(client_sock)
+    except OSError:
+        pass
+    client_sock.close()
+
+
+def handle_accept(
+    listen_sock: socket.socket,
+    ctx: WorkerContext,
+) -> int:
+    """
+    Accept the connections waiting on listen_sock, up to accept_batch of
+    them; the rest are accepted on the next pass of the loop. Once
+    max_connections clients are open, new ones are shed. Returns how
+    many connections were taken off the socket.
+    """
+    for accepted in range(ctx.config.accept_batch):
+        try:
+            client_sock, addr = listen_sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return accepted
+        except OSError as e:
+            # Out of file descriptors, for one: leave the rest queued
+            log.error("Error accepting connection: %s", e)
+            return accepted
+        if len(ctx.connections) >= ctx.config.max_connections:
+            shed_connection(client_sock, ctx)
+            continue
         client_sock.setblocking(False)
-        connection = Connection(socket=client_sock, address=addr)
-        connections[client_sock.fileno()] = connection
-        selector.register(client_sock, selectors.EVENT_READ, connection)
+        connection = Connection(
+            socket=client_sock,
+            address=addr,
+            parser=RequestParser(
+                ctx.config.max_header_size, ctx.config.max_body_size
+            ),
+            log=RequestLog(accepted=time.monotonic()),
+        )
+        ctx.connections[client_sock.fileno()] = connection
+        ctx.selector.register(client_sock, selectors.EVENT_READ, connection)
+        ctx.metrics.add("proxy_connections_total")
+        ctx.metrics.add("proxy_active_connections")
+        set_timeout(connection, ctx, ctx.config.client_header_timeout)
+    return ctx.config.accept_batch
+
+
+def start_draining(listen_sock: socket.socket, ctx: WorkerContext) -> None:
+    """
+    Stop accepting and close the keep-alive connections idle between
+    requests. The others are closed as soon as their current response
+    has been sent.
+    """
+    ctx.selector.unregister(listen_sock)
+    # Closing the socket resets connections still queued on it, so take
+    # them first: another worker is already listening for new ones
+    while handle_accept(listen_sock, ctx) == ctx.config.accept_batch:
+        pass
+    listen_sock.close()
+    for conn in list(ctx.connections.values()):
+        if (
+            conn.state == ConnectionState.RECV_REQUEST
+            and conn.requests
+            and not conn.log.received
+        ):
+            close_connection(conn, ctx)
+
+
+def set_timeout(conn: Connection, ctx: WorkerContext, seconds: int) -> None:
+    """
+    Call handle_timeout on conn `seconds` from now unless the timeout is
+    set again or cleared first; 0 clears it.
+    """
+    if not seconds:
+        clear_timeout(conn, ctx)
+        return
+    if conn.timer is None:
+        conn.timer = Timer(lambda: handle_timeout(conn, ctx))
+    ctx.timers.arm(conn.timer, time.monotonic() + seconds)
+
+
+def clear_timeout(conn: Connection, ctx: WorkerContext) -> None:
+    if conn.timer is not None:
+        ctx.timers.cancel(conn.timer)
+
+
+def handle_timeout(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    conn waited too long for what its state is waiting for: a client
+    that has not sent a complete request gets a 408 (or is just closed
+    if it sent nothing), an origin that has not started its response is
+    abandoned with a 504, and an idle tunnel is closed.
+    """
+    try:
+        if conn.state == ConnectionState.RECV_REQUEST:
+            if conn.log.received:
+                ctx.metrics.add('proxy_timeouts_total{phase="request"}')
+                log.info("Client timed out sending a request")
+                respond_with_error(conn, ctx, 408)
+            else:
+                ctx.metrics.add('proxy_timeouts_total{phase="idle"}')
+                close_connection(conn, ctx)
+        elif conn.state == ConnectionState.TUNNEL and conn.tunnel.connected:
+            ctx.metrics.add('proxy_timeouts_total{phase="tunnel"}')
+            log.info("Closing idle tunnel")
+            close_connection(conn, ctx)
+        elif conn.state != ConnectionState.SEND_CLIENT:
+            ctx.metrics.add('proxy_timeouts_total{phase="upstream"}')
+            hostname, port = conn.upstream_address
+            log.warning("Timed out waiting for %s:%s", hostname, port)
+            if conn.upstream_socket is not None:
+                update_interest(ctx.selector, conn.upstream_socket, 0, conn)
+                conn.upstream_socket.close()
+                conn.upstream_socket = None
+            end_tunnel(conn, ctx)
+            respond_with_error(conn, ctx, 504)
     except Exception as e:
-        print(f"Error accepting connection: {e}")
-        raise e
+        log.warning("Error handling timeout: %s", e)
+        close_connection(conn, ctx)
 
 
-def handle_connection(
-    key: selectors.SelectorKey,
+def resolve_upstream(
+    conn: Connection,
+    ctx: WorkerContext,
+    connect: Callable[[Connection, WorkerContext, tuple[str, int]], None],
+) -> None:
+    """
+    Resolve conn.upstream_address without blocking the event loop, then
+    call connect with the resolved (address, port).
+
+    The client socket is parked during the lookup. Lookup and connect
+    failures are answered with a 502.
+    """
+    hostname, port = conn.upstream_address
+    conn.state = ConnectionState.RESOLVING
+    conn.log.resolving = time.monotonic()
+    update_interest(ctx.selector, conn.socket, 0, conn)
+
+    def resolved(address: Optional[str], error: Optional[OSError]) -> None:
+        if conn.state != ConnectionState.RESOLVING:
+            # Closed while the lookup was running
+            return
+        conn.log.resolved = time.monotonic()
+        try:
+            if error is not None:
+                raise error
+            connect(conn, ctx, (address, port))
+        except OSError as e:
+            log.warning("Error connecting to %s:%s: %s", hostname, port, e)
+            end_tunnel(conn, ctx)
+            respond_with_error(conn, ctx, 502)
+        except Exception as e:
+            log.warning("Error connecting to %s:%s: %s", hostname, port, e)
+            close_connection(conn, ctx)
+
+    if ctx.resolver is None:
+        resolved(hostname, None)
+    else:
+        ctx.resolver.resolve(hostname, resolved)
+
+
+def start_upstream(
+    conn: Connection, ctx: WorkerContext, address: tuple[str, int]
+) -> None:
+    """
+    Open a new upstream connection to a resolved address and send the
+    request on it.
+    """
+    conn.upstream_reused = False
+    conn.log.connecting = time.monotonic()
+    conn.log.connected = 0.0
+    send_upstream(conn, ctx, connect_upstream(address))
+
+
+def send_upstream(
+    conn: Connection, ctx: WorkerContext, upstream_socket: socket.socket
+) -> None:
+    """
+    Begin a non-blocking upstream exchange for a parsed client request.
+
+    The client socket is parked while the request is written upstream; it
+    is re-registered for writing once response bytes are available.
+    """
+    conn.upstream_socket = upstream_socket
+    conn.send_buffer = SendQueue(
+        prepare_upstream_request(conn.request, conn.upstream_keep_alive)
+    )
+    conn.state = ConnectionState.SEND_UPSTREAM
+    update_interest(ctx.selector, conn.socket, 0, conn)
+    update_interest(
+        ctx.selector, conn.upstream_socket, selectors.EVENT_WRITE, conn
+    )
+
+
+def release_upstream(
+    conn: Connection, ctx: WorkerContext, reusable: bool
+) -> None:
+    """
+    Detach the upstream connection once the response has ended, parking
+    it in the pool if it is reusable and the origin keeps it open.
+    """
+    sock = conn.upstream_socket
+    conn.log.upstream_done = time.monotonic()
+    update_interest(ctx.selector, sock, 0, conn)
+    if (
+        reusable
+        and ctx.pool is not None
+        and conn.upstream_keep_alive
+        and conn.response_framer.keep_alive
+    ):
+        ctx.pool.release(conn.upstream_address, sock)
+    else:
+        sock.close()
+    conn.upstream_socket = None
+
+
+def retry_stale_upstream(conn: Connection, ctx: WorkerContext) -> bool:
+    """
+    An origin may close a pooled connection just as it is reused. If that
+    happened before any response byte arrived, resend an idempotent
+    request once on a fresh connection. Returns True if a retry started.
+    """
+    if (
+        not conn.upstream_reused
+        or conn.response_framer.received
+        or conn.response_framer.method not in IDEMPOTENT_METHODS
+    ):
+        return False
+    log.info("Pooled upstream connection was closed, retrying")
+    update_interest(ctx.selector, conn.upstream_socket, 0, conn)
+    conn.upstream_socket.close()
+    conn.upstream_socket = None
+    conn.upstream_reused = False
+    resolve_upstream(conn, ctx, start_upstream)
+    return True
+
+
+def respond_with_error(
+    conn: Connection, ctx: WorkerContext, status_code: int
+) -> None:
+    """
+    Queue a minimal error response for the client and close afterwards.
+    Clients following conn get the same response. A failed revalidation
+    serves the stale copy instead while stale-if-error allows.
+    """
+    if status_code >= 500 and serve_stale_on_error(conn, ctx):
+        return
+    for follower in leave_collapsed(conn, ctx):
+        respond_with_error(follower, ctx, status_code)
+    if conn.socket is None:
+        # A background revalidation has nobody to answer
+        close_connection(conn, ctx)
+        return
+    ctx.metrics.add("proxy_error_responses_total")
+    conn.log.status = status_code
+    conn.send_buffer = SendQueue(
+        build_http_response(
+            status_code, {"Content-Length": "0", "Connection": "close"}, b""
+        )
+    )
+    conn.client_keep_alive = False
+    conn.state = ConnectionState.SEND_CLIENT
+    update_interest(ctx.selector, conn.socket, selectors.EVENT_WRITE, conn)
+
+
+def apply_tunnel_interest(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    Register both ends of a tunnel for the events it currently needs.
+    """
+    client_events, upstream_events = tunnel_interest(conn)
+    update_interest(ctx.selector, conn.socket, client_events, conn)
+    update_interest(ctx.selector, conn.upstream_socket, upstream_events, conn)
+
+
+def start_tunnel(
+    conn: Connection, ctx: WorkerContext, address: tuple[str, int]
+) -> None:
+    """
+    Connect a tunnel opened by open_tunnel to its resolved upstream.
+    """
+    conn.log.connecting = time.monotonic()
+    connect_tunnel(conn, address)
+    apply_tunnel_interest(conn, ctx)
+
+
+def handle_tunnel(
+    conn: Connection,
+    sock: socket.socket,
     mask: int,
-    selector: selectors.DefaultSelector,
-    connections: dict[int, Connection],
+    ctx: WorkerContext,
 ) -> None:
-    conn = key.data
+    """
+    Relay a readiness event on either end of a CONNECT tunnel.
+    """
     try:
-        if conn.state == ConnectionState.RECV_REQUEST:
-            # Read data from the client
-            data = conn.socket.recv(4096)
+        pump_tunnel(conn, sock, mask)
+    except OSError as e:
+        if not conn.tunnel.connected:
+            log.warning("Error connecting tunnel: %s", e)
+            update_interest(ctx.selector, conn.upstream_socket, 0, conn)
+            conn.upstream_socket.close()
+            conn.upstream_socket = None
+            end_tunnel(conn, ctx)
+            respond_with_error(conn, ctx, 502)
+            return
+        log.info("Tunnel error: %s", e)
+        close_connection(conn, ctx)
+        return
+    if conn.tunnel.connected:
+        observe_connect(conn, ctx)
+        set_timeout(conn, ctx, ctx.config.tunnel_idle_timeout)
+
+    if tunnel_finished(conn):
+        log.debug("Tunnel closed")
+        close_connection(conn, ctx)
+    else:
+        apply_tunnel_interest(conn, ctx)
+
+
+def end_tunnel(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    close_tunnel, accounting for the tunnel in the metrics and, once it
+    was established, the access log.
+    """
+    tunnel = conn.tunnel
+    if tunnel is None:
+        return
+    if ctx.access_log is not None and tunnel.connected:
+        conn.log.status = 200
+        conn.log.bytes_sent = tunnel.to_client.transferred
+        conn.log.finished = time.monotonic()
+        ctx.access_log.write(conn.address, conn.log)
+    ctx.metrics.add("proxy_active_tunnels", -1)
+    ctx.metrics.add(
+        'proxy_tunnel_bytes_total{direction="upstream"}',
+        tunnel.to_upstream.transferred,
+    )
+    ctx.metrics.add(
+        'proxy_tunnel_bytes_total{direction="client"}',
+        tunnel.to_client.transferred,
+    )
+    close_tunnel(conn)
+
+
+def observe_connect(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    The upstream connection of conn is established; the first call after
+    a new connection was started records how long that took.
+    """
+    log = conn.log
+    if not log.connecting or log.connected:
+        return
+    log.connected = time.monotonic()
+    ctx.metrics.observe(
+        "proxy_upstream_connect_seconds", log.connected - log.connecting
+    )
+
+
+def take_request(conn: Connection, ctx: WorkerContext) -> bool:
+    """
+    Dispatch the next complete request buffered in conn.parser; pipelined
+    bytes after it stay buffered. Returns False if the request is still
+    incomplete.
+    """
+    try:
+        parsed = conn.parser.next_request()
+    except RequestError as e:
+        log.info("Rejecting request: %s", e)
+        clear_timeout(conn, ctx)
+        respond_with_error(conn, ctx, e.status)
+        return True
+    if parsed is None:
+        return False
+    request, conn.request = parsed
+    process_request(conn, ctx, request)
+    return True
+
+
+def start_next_request(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    Reset a persistent client connection for its next request, answering
+    one that was already pipelined behind the last straight away.
+    """
+    conn.state = ConnectionState.RECV_REQUEST
+    conn.request = b""
+    conn.client_keep_alive = False
+    conn.upstream_address = None
+    conn.upstream_reused = False
+    conn.upstream_keep_alive = False
+    conn.response_framer = None
+    conn.response_head = None
+    conn.cache_key = ""
+    conn.request_headers = None
+    conn.vary = ()
+    conn.cache_ttl = 0
+    conn.cache_response = None
+    conn.stale = None
+    conn.log = RequestLog(accepted=time.monotonic())
+    update_interest(ctx.selector, conn.socket, selectors.EVENT_READ, conn)
+    set_timeout(conn, ctx, ctx.config.keep_alive_timeout)
+    take_request(conn, ctx)
+
+
+def discard_unread(sock: socket.socket) -> None:
+    """
+    Read and drop whatever the client has sent but we have not consumed.
+
+    Closing a socket with unread input makes the kernel send a reset,
+    which can destroy a response (e.g. a 431) the client has not read
+    yet.
+    """
+    discarded = 0
+    try:
+        while discarded < DISCARD_LIMIT:
+            data = sock.recv(65536)
             if not data:
-                # Client closed connection
-                conn.state = ConnectionState.CLOSED
-            else:
-                conn.recv_buffer += data
-                print(f"Received {len(data)} bytes from client")
+                return
+            discarded += len(data)
+    except OSError:
+        pass
 
-                # Check if we have a complete HTTP request
-                if b"\r\n\r\n" not in conn.recv_buffer:
-                    # Keep receiving
-                    return
 
-                # Parse HTTP request
-                http_request = parse_http_request(conn.recv_buffer)
+def finish_response(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    The response has been sent in full: wait for the client's next
+    request or close.
+    """
+    conn.log.finished = time.monotonic()
+    if ctx.access_log is not None and conn.socket is not None:
+        ctx.access_log.write(conn.address, conn.log)
+    if conn.client_keep_alive and not ctx.draining:
+        start_next_request(conn, ctx)
+    else:
+        if conn.socket is not None:
+            discard_unread(conn.socket)
+        conn.state = ConnectionState.CLOSED
 
-                if not http_request or "Host" not in http_request:
-                    print("Invalid HTTP request or missing Host header")
-                    conn.state = ConnectionState.CLOSED
-                    return
 
-                method = http_request.get("method")
-                url = http_request.get("url")
-                print(f"Parsed request: {method} {url}")
-                print(f"Host: {http_request.get('Host')}")
-
-                # Handle CONNECT requests (HTTPS tunneling)
-                if method == "CONNECT":
-                    print("Handling CONNECT request for HTTPS tunneling")
-                    # Delegate to tunnel module
-                    handle_https_tunnel(conn.socket, url)
-                    conn.state = ConnectionState.CLOSED
-                    return
+def process_request(
+    conn: Connection, ctx: WorkerContext, request: Request
+) -> None:
+    """
+    Dispatch a complete client request; its raw bytes are in conn.request.
+    """
+    method = request.method
+    url = request.target
+    host_string = request.headers.get("host")
+    log.debug("Parsed request: %s %s (Host: %s)", method, url, host_string)
+    ctx.metrics.add("proxy_requests_total")
+    conn.requests += 1
+    clear_timeout(conn, ctx)
+    conn.log.parsed = time.monotonic()
+    conn.log.received = conn.log.received or conn.log.parsed
+    conn.log.request_line = f"{method} {url}"
+    if not host_string:
+        log.info("No Host header found")
+        respond_with_error(conn, ctx, 400)
+        return
+    conn.client_keep_alive = request.keep_alive and not ctx.draining
 
-                # Parse host and port from Host header
-                host_string = http_request.get("Host", "")
-                if not host_string:
-                    print("No Host header found")
-                    conn.state = ConnectionState.CLOSED
-                    return
+    # Handle CONNECT requests (HTTPS tunneling)
+    if method == "CONNECT":
+        log.debug("Handling CONNECT request for HTTPS tunneling")
+        # Anything after the request already belongs to the tunnel
+        pending = conn.parser.take_buffered()
+        open_tunnel(conn, url, pending, ctx.config.tunnel_relay)
+        ctx.metrics.add("proxy_tunnels_total")
+        ctx.metrics.add("proxy_active_tunnels")
+        set_timeout(conn, ctx, ctx.config.upstream_timeout)
+        resolve_upstream(conn, ctx, start_tunnel)
+        return
 
-                hostname, port = parse_host_port(host_string)
-                print(f"Connecting to {hostname}:{port}")
+    conn.upstream_address = parse_host_port(host_string)
+    caching = ctx.cache is not None or ctx.disk_cache is not None
+    if method == "GET" and caching and request_cacheable(request.headers):
+        key = build_cache_key(method, url, host_string)
+        conn.request_headers = request.headers
+        conn.vary = ctx.vary.get(key) or ()
+        conn.cache_key = variant_key(key, conn.vary, request.headers)
+        # A client asking for validation gets (and refreshes the cache
+        # with) a response fresh from the origin
+        stale = None
+        if not request_wants_validation(request.headers):
+            if serve_from_cache(conn, ctx):
+                return
+            stale = find_stale(conn, ctx)
+            if (
+                stale is not None
+                and stale.staleness < stale.while_revalidate
+                and serve_stale(conn, ctx, stale)
+            ):
+                revalidate_in_background(conn, ctx, stale)
+                return
+            if join_collapsed(conn, ctx):
+                return
+        conn.log.cache = "miss"
+        conn.cache_response = bytearray()
+        ctx.collapsed[conn.cache_key] = conn
+        if stale is not None:
+            conn.stale = stale
+            conn.request = (
+                conditional_request(conn.request, stale.head) or conn.request
+            )
+    forward_request(conn, ctx, method)
 
-                # Connect to upstream server (blocking for now)
-                try:
-                    conn.upstream_address = (hostname, port)
-                    conn.upstream_socket = connect_upstream(
-                        conn.upstream_address
-                    )
 
-                    # Send request to upstream (blocking)
-                    sent = conn.upstream_socket.send(conn.recv_buffer)
-                    print(f"Sent {sent} bytes to upstream")
+def forward_request(conn: Connection, ctx: WorkerContext, method: str) -> None:
+    """
+    Send conn's request to its upstream, on a pooled connection if there
+    is one.
+    """
+    hostname, port = conn.upstream_address
+    conn.response_framer = ResponseFramer(method)
+    conn.response_head = bytearray()
+    conn.upstream_keep_alive = ctx.pool is not None
+    set_timeout(conn, ctx, ctx.config.upstream_timeout)
+    pooled = None
+    if conn.upstream_keep_alive:
+        pooled = ctx.pool.acquire(conn.upstream_address)
+    if pooled is not None:
+        log.debug("Reusing connection to %s:%s", hostname, port)
+        conn.upstream_reused = True
+        send_upstream(conn, ctx, pooled)
+    else:
+        log.debug("Connecting to %s:%s", hostname, port)
+        resolve_upstream(conn, ctx, start_upstream)
 
-                    # Receive response from upstream (blocking)
-                    response = b""
-                    while True:
-                        data = conn.upstream_socket.recv(4096)
-                        if not data:
-                            break
-                        response += data
-                        # Simple check for complete HTTP response
-                        if b"\r\n\r\n" in response:
-                            # Check if we have the body too
-                            # For now, assume we got it all
-                            break
 
-                    print(f"Received {len(response)} bytes from upstream")
+def serve_from_cache(conn: Connection, ctx: WorkerContext) -> bool:
+    """
+    Answer conn from the memory tier, else the disk tier. Returns False
+    on a miss.
+    """
+    cached = ctx.cache.get(conn.cache_key) if ctx.cache is not None else None
+    if cached is not None:
+        queue_cached_response(conn, cached)
+    else:
+        if ctx.disk_cache is None:
+            return False
+        hit = ctx.disk_cache.lookup(conn.cache_key)
+        if hit is None:
+            return False
+        queue_cached_file(conn, *hit)
+    log.debug("Cache hit: %s", conn.cache_key)
+    conn.log.cache = "hit"
+    send_queued(conn, ctx)
+    return True
 
-                    # Send response back to client
-                    conn.socket.send(response)
-                    print(f"Sent {len(response)} bytes to client")
 
-                    # Close upstream connection
-                    conn.upstream_socket.close()
+def queue_cached_response(conn: Connection, data: bytes) -> None:
+    """
+    Queue a response as stored in the cache (head without hop-by-hop
+    headers, then the body) for the client. Stored entries are queued
+    without copying; a bytearray is a response still being collected,
+    which could not grow while a view of it is queued, so it is copied.
+    """
+    head_end = data.find(b"\r\n\r\n") + 4
+    conn.send_buffer = SendQueue(
+        cached_response_head(conn, bytes(data[:head_end]))
+    )
+    if isinstance(data, bytearray):
+        conn.send_buffer.append(data[head_end:])
+    else:
+        conn.send_buffer.append(memoryview(data)[head_end:])
 
-                except Exception as e:
-                    print(f"Error proxying request: {e}")
 
-                # Close client connection
-                conn.state = ConnectionState.CLOSED
+def read_cached_head(cache_file: BinaryIO, offset: int, length: int) -> bytes:
+    """
+    Read the head of a response stored in a disk tier file.
+    """
+    head = os.pread(
+        cache_file.fileno(), min(length, MAX_RESPONSE_HEAD), offset
+    )
+    head_end = head.find(b"\r\n\r\n") + 4
+    return head[:head_end]
 
-        elif conn.state == ConnectionState.RECV_UPSTREAM:
-            print("Receiving upstream")
-            data = conn.upstream_socket.recv(4096)
-            if not data:
-                conn.state = ConnectionState.CLOSED
-            else:
-                conn.recv_buffer += data
-                print(f"Received {len(data)} bytes from upstream")
-                conn.state = ConnectionState.SEND_CLIENT
-        elif conn.state == ConnectionState.SEND_UPSTREAM:
-            print("Sending upstream")
-            data = conn.upstream_socket.send(conn.send_buffer)
+
+def queue_cached_file(
+    conn: Connection, cache_file: BinaryIO, offset: int, length: int
+) -> None:
+    """
+    queue_cached_response for a disk tier file. Only the head is read
+    into memory; the body goes out by sendfile.
+    """
+    head = read_cached_head(cache_file, offset, length)
+    conn.send_buffer = SendQueue(cached_response_head(conn, head))
+    conn.send_file = cache_file
+    conn.send_file_offset = offset + len(head)
+    conn.send_file_remaining = length - len(head)
+
+
+def send_queued(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    Send a response that has been queued in full.
+    """
+    conn.state = ConnectionState.SEND_CLIENT
+    update_interest(ctx.selector, conn.socket, selectors.EVENT_WRITE, conn)
+
+
+def find_stale(
+    conn: Connection, ctx: WorkerContext
+) -> Optional[StaleResponse]:
+    """
+    Look up an expired copy of conn's response that the cache tiers still
+    keep, memory tier first.
+    """
+    stale = None
+    if ctx.cache is not None:
+        found = ctx.cache.get_stale(conn.cache_key)
+        if found is not None:
+            response, staleness = found
+            head_end = response.find(b"\r\n\r\n") + 4
+            stale = StaleResponse(response[:head_end], staleness, response)
+    if stale is None and ctx.disk_cache is not None:
+        found = ctx.disk_cache.lookup_stale(conn.cache_key)
+        if found is not None:
+            cache_file, offset, length, staleness = found
+            with cache_file:
+                head = read_cached_head(cache_file, offset, length)
+            stale = StaleResponse(head, staleness)
+    if stale is not None:
+        stale.while_revalidate, stale.if_error = stale_windows(
+            parse_response_headers(stale.head),
+            ctx.config.cache_stale_while_revalidate,
+            ctx.config.cache_stale_if_error,
+        )
+    return stale
+
+
+def serve_stale(
+    conn: Connection, ctx: WorkerContext, stale: StaleResponse
+) -> bool:
+    """
+    Answer conn with an expired copy of its response. Returns False if a
+    disk tier copy has gone in the meantime.
+    """
+    if stale.response is not None:
+        queue_cached_response(conn, stale.response)
+    else:
+        hit = ctx.disk_cache.lookup_stale(conn.cache_key)
+        if hit is None:
+            return False
+        queue_cached_file(conn, *hit[:3])
+    log.debug("Serving stale: %s", conn.cache_key)
+    conn.log.cache = "stale"
+    send_queued(conn, ctx)
+    return True
+
+
+def revalidate_in_background(
+    conn: Connection, ctx: WorkerContext, stale: StaleResponse
+) -> None:
+    """
+    Refresh the stale entry conn was answered with using a request of the
+    worker's own: a Connection without a client socket, whose response
+    only updates the cache. Nothing is started if the key is already
+    being fetched.
+    """
+    key = conn.cache_key
+    if key in ctx.revalidating or key in ctx.collapsed:
+        return
+    log.debug("Revalidating in background: %s", key)
+    ctx.revalidating.add(key)
+    background = Connection(
+        socket=None,
+        address=conn.address,
+        request=conditional_request(conn.request, stale.head) or conn.request,
+        upstream_address=conn.upstream_address,
+        cache_key=key,
+        request_headers=conn.request_headers,
+        vary=conn.vary,
+        cache_response=bytearray(),
+        stale=stale,
+        log=RequestLog(parsed=time.monotonic()),
+    )
+    forward_request(background, ctx, "GET")
+
+
+def serve_stale_on_error(conn: Connection, ctx: WorkerContext) -> bool:
+    """
+    Answer conn and its followers with the stale copy being revalidated
+    instead of an error, if it expired less than stale_if_error seconds
+    ago. Returns False if the error is to be sent.
+    """
+    stale = conn.stale
+    if (
+        conn.socket is None
+        or stale is None
+        or stale.staleness >= stale.if_error
+    ):
+        return False
+    conn.stale = None
+    for client in [conn] + leave_collapsed(conn, ctx):
+        if not serve_stale(client, ctx, stale):
+            respond_with_error(client, ctx, 502)
+    return True
+
+
+def refresh_stale(conn: Connection, ctx: WorkerContext, head: bytes) -> None:
+    """
+    The origin answered a revalidation with 304: store the stale copy as
+    fresh again, with the 304's headers in a memory tier copy, and answer
+    conn and its followers from it.
+    """
+    stale = conn.stale
+    conn.stale = None
+    log.debug("Revalidated: %s", conn.cache_key)
+    clients = leave_collapsed(conn, ctx)
+    if conn.socket is not None:
+        clients.insert(0, conn)
+    refreshed_head = update_stored_head(stale.head, head)
+    ttl = response_ttl(
+        parse_response_headers(refreshed_head), ctx.config.cache_ttl
+    )
+    if stale.response is not None:
+        stored_head_size = len(stale.head)
+        refreshed = refreshed_head + stale.response[stored_head_size:]
+        ctx.cache.put(conn.cache_key, refreshed, ttl=ttl or 0)
+        for client in clients:
+            client.log.cache = "revalidated"
+            queue_cached_response(client, refreshed)
+            send_queued(client, ctx)
+        return
+    ctx.disk_cache.refresh(conn.cache_key, time.time() + (ttl or 0))
+    for client in clients:
+        # With a lifetime of 0 the refreshed copy has expired already
+        if not serve_from_cache(client, ctx) and not serve_stale(
+            client, ctx, stale
+        ):
+            respond_with_error(client, ctx, 502)
+        client.log.cache = "revalidated"
+
+
+def answer_revalidation(
+    conn: Connection, ctx: WorkerContext, head: bytes
+) -> bool:
+    """
+    Called with the response head to a request that had a stale copy. A
+    304 refreshes the copy and a server error may be answered with it;
+    either way the upstream response itself is dropped and True is
+    returned. Other responses are forwarded as usual.
+    """
+    framer = conn.response_framer
+    if framer.status == 304:
+        refresh_stale(conn, ctx, head)
+    elif framer.status < 500 or not serve_stale_on_error(conn, ctx):
+        conn.stale = None
+        return False
+    conn.cache_response = None
+    if not framer.complete:
+        release_upstream(conn, ctx, reusable=False)
+    return True
+
+
+def join_collapsed(conn: Connection, ctx: WorkerContext) -> bool:
+    """
+    Attach a cache miss to a miss for the same key that is already being
+    fetched, so that only one request goes upstream. A late follower is
+    caught up from the response the leader is collecting for the cache;
+    once that is no longer possible (uncacheable, spilled to disk),
+    returns False and conn goes upstream itself.
+    """
+    leader = ctx.collapsed.get(conn.cache_key)
+    if leader is None:
+        return False
+    if leader.response_head is None:
+        if leader.cache_response is None:
+            return False
+        queue_cached_response(conn, leader.cache_response)
+    log.debug("Collapsed into in-flight request: %s", conn.cache_key)
+    conn.log.cache = "collapsed"
+    conn.leader = leader
+    leader.followers.append(conn)
+    conn.state = ConnectionState.RECV_UPSTREAM
+    apply_response_interest(conn, ctx)
+    return True
+
+
+def leave_collapsed(conn: Connection, ctx: WorkerContext) -> list:
+    """
+    Stop new misses from following conn and detach the followers it has,
+    returning them.
+    """
+    if ctx.collapsed.get(conn.cache_key) is conn:
+        del ctx.collapsed[conn.cache_key]
+    followers = conn.followers
+    conn.followers = []
+    for follower in followers:
+        follower.leader = None
+    return followers
+
+
+def hand_over_followers(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    conn is closing while clients still follow it. If the response head
+    has not reached them, the first follower sends its own request
+    upstream; otherwise it takes over conn's upstream connection mid-
+    response. Either way the other followers follow it instead.
+    """
+    followers = leave_collapsed(conn, ctx)
+    if not followers:
+        return
+    leader = followers[0]
+    leader.followers = followers[1:]
+    for follower in leader.followers:
+        follower.leader = leader
+    ctx.collapsed.setdefault(leader.cache_key, leader)
+    if conn.response_head is not None:
+        log.debug("Leader closed, refetching: %s", leader.cache_key)
+        leader.cache_response = bytearray()
+        forward_request(leader, ctx, conn.response_framer.method)
+        return
+    log.debug("Leader closed, handing over upstream: %s", leader.cache_key)
+    update_interest(ctx.selector, conn.upstream_socket, 0, conn)
+    leader.upstream_socket = conn.upstream_socket
+    leader.upstream_address = conn.upstream_address
+    leader.upstream_reused = conn.upstream_reused
+    leader.upstream_keep_alive = conn.upstream_keep_alive
+    leader.response_framer = conn.response_framer
+    leader.cache_response = conn.cache_response
+    leader.cache_file = conn.cache_file
+    conn.upstream_socket = None
+    conn.cache_response = None
+    conn.cache_file = None
+    apply_response_interest(leader, ctx)
+
+
+def client_response_head(
+    conn: Connection, head: bytes, framer: ResponseFramer
+) -> bytes:
+    """
+    Rewrite a response head for the client. The client connection only
+    stays open if the end of the response is marked by its framing
+    rather than by closing the connection.
+    """
+    conn.client_keep_alive = conn.client_keep_alive and framer.delimited
+    conn.log.status = framer.status
+    connection = b"keep-alive" if conn.client_keep_alive else b"close"
+    return rewrite_response_head(head, connection)
+
+
+def cached_response_head(conn: Connection, head: bytes) -> bytes:
+    """
+    client_response_head for a response head stored in the cache.
+    """
+    framer = ResponseFramer()
+    framer.feed(head)
+    return client_response_head(conn, head, framer)
+
+
+def forward_response_head(conn: Connection, ctx: WorkerContext) -> bytes:
+    """
+    Called once the upstream response head is complete. Returns the bytes
+    received so far rewritten for the client; the cache gets the head
+    without hop-by-hop headers.
+    """
+    framer = conn.response_framer
+    head_size = framer.head_size
+    head = bytes(conn.response_head[:head_size])
+    body = bytes(conn.response_head[head_size:])
+    conn.response_head = None
+    if conn.stale is not None and answer_revalidation(conn, ctx, head):
+        return b""
+    if conn.cache_response is not None:
+        apply_cache_policy(conn, ctx, framer)
+    collect_response(conn, ctx, rewrite_response_head(head) + body)
+    for follower in conn.followers:
+        follower.send_buffer.append(
+            client_response_head(follower, head, framer)
+        )
+        follower.send_buffer.append(body)
+    return client_response_head(conn, head, framer) + body
+
+
+def apply_cache_policy(
+    conn: Connection, ctx: WorkerContext, framer: ResponseFramer
+) -> None:
+    """
+    Decide from its head whether conn's response is cached and for how
+    long. A response that varies on other request headers than conn's
+    key was built with moves conn to the right variant key, along with
+    the followers that asked for the same variant; the others go
+    upstream for their own.
+    """
+    ttl = None
+    if framer.status == 200:
+        ttl = response_ttl(framer.headers, ctx.config.cache_ttl)
+    names = vary_names(framer.headers)
+    if ttl is None or names is None:
+        conn.cache_response = None
+        return
+    conn.cache_ttl = ttl
+    if names == conn.vary:
+        return
+    key = primary_key(conn.cache_key)
+    ctx.vary.set(key, names)
+    if ctx.collapsed.get(conn.cache_key) is conn:
+        del ctx.collapsed[conn.cache_key]
+    if conn.socket is None:
+        ctx.revalidating.discard(conn.cache_key)
+    conn.cache_key = variant_key(key, names, conn.request_headers)
+    conn.vary = names
+    ctx.collapsed.setdefault(conn.cache_key, conn)
+    if conn.socket is None:
+        ctx.revalidating.add(conn.cache_key)
+    followers = conn.followers
+    conn.followers = []
+    for follower in followers:
+        follower.cache_key = variant_key(key, names, follower.request_headers)
+        follower.vary = names
+        if follower.cache_key == conn.cache_key:
+            conn.followers.append(follower)
+            continue
+        log.debug("Response varies, refetching: %s", follower.cache_key)
+        follower.leader = None
+        if join_collapsed(follower, ctx):
+            continue
+        follower.cache_response = bytearray()
+        ctx.collapsed[follower.cache_key] = follower
+        forward_request(follower, ctx, "GET")
+
+
+def collect_response(
+    conn: Connection, ctx: WorkerContext, data: bytes
+) -> None:
+    """
+    Append upstream bytes to the response being collected for the cache,
+    if it is cacheable (see forward_response_head). Responses that
+    outgrow the memory tier continue into a disk tier file.
+    """
+    if conn.cache_file is not None:
+        conn.cache_file.write(data)
+        if conn.cache_file.size > ctx.disk_cache.max_object_size:
+            conn.cache_file.abort()
+            conn.cache_file = None
+        return
+    if conn.cache_response is None:
+        return
+    conn.cache_response += data
+    memory_limit = ctx.cache.max_object_size if ctx.cache is not None else 0
+    if len(conn.cache_response) > memory_limit:
+        if ctx.disk_cache is not None:
+            conn.cache_file = ctx.disk_cache.begin(conn.cache_key)
+            conn.cache_file.write(conn.cache_response)
+        conn.cache_response = None
+
+
+def store_response(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    Store a fully received upstream response in the cache.
+    """
+    if conn.cache_file is not None:
+        conn.cache_file.commit(time.time() + conn.cache_ttl)
+        log.debug(
+            "Cached %d bytes on disk: %s",
+            conn.cache_file.size,
+            conn.cache_key,
+        )
+        conn.cache_file = None
+    elif conn.cache_response is not None:
+        ctx.cache.put(
+            conn.cache_key, bytes(conn.cache_response), ttl=conn.cache_ttl
+        )
+        log.debug(
+            "Cached %d bytes: %s", len(conn.cache_response), conn.cache_key
+        )
+        conn.cache_response = None
+
+
+def discard_response(conn: Connection) -> None:
+    """
+    Drop a partially collected response instead of caching it.
+    """
+    if conn.cache_file is not None:
+        conn.cache_file.abort()
+        conn.cache_file = None
+    conn.cache_response = None
+
+
+def send_to_client(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    Write pending response bytes, then any disk cache file, to the client.
+    """
+    if conn.send_buffer:
+        sent = conn.send_buffer.send(conn.socket)
+        if ctx.debug:
+            log.debug("Sent %d bytes to client", sent)
+    elif conn.send_file is not None:
+        # The body goes file -> socket inside the kernel
+        sent = os.sendfile(
+            conn.socket.fileno(),
+            conn.send_file.fileno(),
+            conn.send_file_offset,
+            min(conn.send_file_remaining, SENDFILE_CHUNK),
+        )
+        conn.send_file_offset += sent
+        conn.send_file_remaining -= sent
+        if not sent or not conn.send_file_remaining:
+            conn.send_file.close()
+            conn.send_file = None
+    else:
+        return
+    conn.log.bytes_sent += sent
+    ctx.metrics.add('proxy_client_bytes_total{direction="sent"}', sent)
+
+
+def response_pending(conn: Connection) -> bool:
+    return bool(conn.send_buffer) or conn.send_file is not None
+
+
+def response_buffered(conn: Connection) -> int:
+    """
+    Bytes not yet sent to the slowest of conn's client and its followers.
+    """
+    return max(
+        [len(conn.send_buffer)] + [len(f.send_buffer) for f in conn.followers]
+    )
+
+
+def apply_response_interest(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    Register both sockets for the events a streaming response needs: the
+    client while bytes are pending for it, the upstream while the
+    response buffers of the client and its followers have room.
+    """
+    client_events = selectors.EVENT_WRITE if response_pending(conn) else 0
+    update_interest(ctx.selector, conn.socket, client_events, conn)
+    if conn.upstream_socket is not None:
+        upstream_events = (
+            selectors.EVENT_READ
+            if response_buffered(conn) < RESPONSE_BUFFER_SIZE
+            else 0
+        )
+        update_interest(
+            ctx.selector, conn.upstream_socket, upstream_events, conn
+        )
+    leader = conn.leader
+    if leader is not None and leader.state == ConnectionState.RECV_UPSTREAM:
+        # A follower that drained may let its leader read again
+        apply_response_interest(leader, ctx)
+
+
+def stream_to_client(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    Write what the client will take now, without waiting for the
+    selector, then wait for whatever the response still needs. Once the
+    upstream side is done (SEND_CLIENT) and everything is sent, the
+    response is finished.
+    """
+    if response_pending(conn):
+        try:
+            send_to_client(conn, ctx)
+        except BlockingIOError:
+            pass
+    upstream_done = conn.state == ConnectionState.SEND_CLIENT
+    if upstream_done and not response_pending(conn):
+        finish_response(conn, ctx)
+    else:
+        apply_response_interest(conn, ctx)
+
+
+def stream_to_followers(conn: Connection, ctx: WorkerContext) -> None:
+    """
+    stream_to_client for each client following conn. Once conn's upstream
+    side is done the followers finish their responses on their own.
+    """
+    followers = conn.followers
+    if conn.state == ConnectionState.SEND_CLIENT:
+        followers = leave_collapsed(conn, ctx)
+        for follower in followers:
+            follower.state = ConnectionState.SEND_CLIENT
+    for follower in list(followers):
+        try:
+            stream_to_client(follower, ctx)
+        except Exception as e:
+            log.warning("Error handling connection: %s", e)
+            close_connection(follower, ctx)
+            continue
+        if follower.state == ConnectionState.CLOSED:
+            log.debug("Closing connection")
+            close_connection(follower, ctx)
+
+
+def handle_connection(
+    key: selectors.SelectorKey,
+    mask: int,
+    ctx: WorkerContext,
+) -> None:
+    """
+    Handle readiness events on the client side of a connection.
+    """
+    conn = key.data
+    if conn.state == ConnectionState.TUNNEL:
+        handle_tunnel(conn, conn.socket, mask, ctx)
+        return
+    try:
+        if conn.state == ConnectionState.RECV_REQUEST:
+            # Read data from the client
+            data = conn.socket.recv(4096)
             if not data:
+                # Client closed connection
                 conn.state = ConnectionState.CLOSED
             else:
-                conn.send_buffer = conn.send_buffer[data:]
-                print(f"Sent {data} bytes to upstream")
+                if not conn.log.received:
+                    conn.log.received = time.monotonic()
+                    set_timeout(conn, ctx, ctx.config.client_header_timeout)
+                conn.parser.feed(data)
+                if ctx.debug:
+                    log.debug("Received %d bytes from client", len(data))
+                ctx.metrics.add(
+                    'proxy_client_bytes_total{direction="received"}',
+                    len(data),
+                )
+                # Keeps receiving until the request is complete
+                take_request(conn, ctx)
+
+        elif conn.state in (
+            ConnectionState.RECV_UPSTREAM,
+            ConnectionState.SEND_CLIENT,
+        ):
+            stream_to_client(conn, ctx)
+
+        if conn.state == ConnectionState.CLOSED:
+            log.debug("Closing connection")
+            close_connection(conn, ctx)
+
+    except Exception as e:
+        log.warning("Error handling connection: %s", e)
+        close_connection(conn, ctx)
+
+
+def handle_upstream_connection(
+    key: selectors.SelectorKey,
+    mask: int,
+    ctx: WorkerContext,
+) -> None:
+    """
+    Handle readiness events on the upstream side of a connection.
+    """
+    conn = key.data
+    if conn.state == ConnectionState.TUNNEL:
+        handle_tunnel(conn, conn.upstream_socket, mask, ctx)
+        return
+    try:
+        if conn.state == ConnectionState.SEND_UPSTREAM:
+            check_upstream_connected(conn.upstream_socket)
+            observe_connect(conn, ctx)
+            sent = conn.send_buffer.send(conn.upstream_socket)
+            if ctx.debug:
+                log.debug("Sent %d bytes to upstream", sent)
+            if not conn.send_buffer:
+                conn.log.sent = time.monotonic()
                 conn.state = ConnectionState.RECV_UPSTREAM
-        elif conn.state == ConnectionState.SEND_CLIENT:
-            print("Sending client")
-            data = conn.socket.send(conn.send_buffer)
+                update_interest(
+                    ctx.selector,
+                    conn.upstream_socket,
+                    selectors.EVENT_READ,
+                    conn,
+                )
+        elif conn.state == ConnectionState.RECV_UPSTREAM:
+            room = RESPONSE_BUFFER_SIZE - response_buffered(conn)
+            if room <= 0:
+                # A follower caught up since this event was reported
+                apply_response_interest(conn, ctx)
+                return
+            data = conn.upstream_socket.recv(room)
             if not data:
-                conn.state = ConnectionState.CLOSED
+                # Origin closed the connection
+                if retry_stale_upstream(conn, ctx):
+                    return
+                release_upstream(conn, ctx, reusable=False)
+                if conn.response_head is not None:
+                    # Nothing has reached the client yet
+                    log.warning("Upstream closed before responding")
+                    respond_with_error(conn, ctx, 502)
+                    return
+                if conn.response_framer.finish():
+                    store_response(conn, ctx)
+                else:
+                    log.warning("Upstream response was cut short")
+                    discard_response(conn)
+                    for client in [conn] + conn.followers:
+                        client.client_keep_alive = False
             else:
-                conn.send_buffer = conn.send_buffer[data:]
-                print(f"Sent {data} bytes to client")
-                conn.state = ConnectionState.RECV_UPSTREAM
+                if not conn.response_framer.received:
+                    clear_timeout(conn, ctx)
+                    conn.log.first_byte = time.monotonic()
+                    ctx.metrics.observe(
+                        "proxy_upstream_ttfb_seconds",
+                        conn.log.first_byte - conn.log.parsed,
+                    )
+                try:
+                    used = conn.response_framer.feed(data)
+                except ValueError as e:
+                    if conn.response_head is None:
+                        # Mid-body: closing is all that is left
+                        raise
+                    log.warning("Malformed upstream response: %s", e)
+                    release_upstream(conn, ctx, reusable=False)
+                    respond_with_error(conn, ctx, 502)
+                    return
+                if used < len(data):
+                    log.info("Ignoring bytes after the upstream response")
+                chunk = data[:used]
+                if ctx.debug:
+                    log.debug("Received %d bytes from upstream", used)
+                if conn.response_head is not None:
+                    # Hold bytes back until the head can be rewritten
+                    conn.response_head += chunk
+                    chunk = b""
+                    if conn.response_framer.headers_done:
+                        chunk = forward_response_head(conn, ctx)
+                else:
+                    collect_response(conn, ctx, chunk)
+                    for follower in conn.followers:
+                        follower.send_buffer.append(chunk)
+                if conn.socket is not None:
+                    conn.send_buffer.append(chunk)
+                if conn.response_framer.complete:
+                    store_response(conn, ctx)
+                    release_upstream(conn, ctx, reusable=used == len(data))
+            if conn.upstream_socket is None:
+                conn.state = ConnectionState.SEND_CLIENT
+            stream_to_followers(conn, ctx)
+            stream_to_client(conn, ctx)
 
         if conn.state == ConnectionState.CLOSED:
-            print("Closing connection")
-            try:
-                fd = conn.socket.fileno()
-                selector.unregister(conn.socket)
-                conn.socket.close()
-                if fd in connections:
-                    del connections[fd]
-            except Exception as e:
-                print(f"Error closing connection: {e}")
+            log.debug("Closing connection")
+            close_connection(conn, ctx)
 
+    except OSError as e:
+        log.warning("Error handling upstream connection: %s", e)
+        if retry_stale_upstream(conn, ctx):
+            return
+        if conn.state == ConnectionState.SEND_UPSTREAM:
+            # Nothing has reached the client yet; tell it what happened
+            update_interest(ctx.selector, conn.upstream_socket, 0, conn)
+            conn.upstream_socket.close()
+            conn.upstream_socket = None
+            respond_with_error(conn, ctx, 502)
+        else:
+            close_connection(conn, ctx)
     except Exception as e:
-        print(f"Error handling connection: {e}")
-        try:
-            selector.unregister(conn.socket)
-            conn.socket.close()
-            if conn.socket.fileno() in connections:
-                del connections[conn.socket.fileno()]
-        except Exception:
-            pass
+        log.warning("Error handling upstream connection: %s", e)
+        close_connection(conn, ctx)
+
+
+def publish_cache_stats(ctx: WorkerContext) -> None:
+    """
+    Add what the cache tiers' own counters gained since the last call to
+    the worker's metrics. The tiers count from 0 in every process, while
+    a respawned worker's block keeps its predecessor's totals.
+    """
+    tiers = [("memory", ctx.cache), ("disk", ctx.disk_cache)]
+    for name, tier in tiers:
+        if tier is None:
+            continue
+        labels = f'{{tier="{name}"}}'
+        for key, value in (
+            (f"proxy_cache_hits_total{labels}", tier.hits),
+            (f"proxy_cache_misses_total{labels}", tier.misses),
+            (f"proxy_cache_evictions_total{labels}", tier.evictions),
+        ):
+            ctx.metrics.add(key, value - ctx.cache_stats.get(key, 0))
+            ctx.cache_stats[key] = value
 
 
-def worker(id: int, config: ProxyConfig):
+def log_cache_stats(id: int, ctx: WorkerContext) -> None:
+    """
+    Print the hit ratio of each cache tier, to compare cache policies.
+    With the shared backend, the memory tier counts this worker's
+    lookups only.
+    """
+    tiers = [("memory", ctx.cache), ("disk", ctx.disk_cache)]
+    for name, tier in tiers:
+        if tier is None:
+            continue
+        log.info(
+            "Worker %d %s cache: hit ratio %.3f "
+            "(%d hits, %d misses, %d evictions)",
+            id,
+            name,
+            tier.hit_ratio,
+            tier.hits,
+            tier.misses,
+            tier.evictions,
+        )
+    admission = getattr(ctx.cache, "admission", None)
+    if admission is not None:
+        log.info(
+            "Worker %d admission: %d admitted, %d rejected",
+            id,
+            admission.admitted,
+            admission.rejected,
+        )
+
+
+def open_listen_socket(
+    config: ProxyConfig, cpu: Optional[int] = None
+) -> socket.socket:
+    """
+    The worker's own non-blocking listening socket, preferred by the
+    kernel for connections processed on `cpu` if one is given.
+    """
     # Each worker creates its own socket with SO_REUSEPORT
     # This allows multiple processes to bind to the same address/port
     # and the kernel will load balance connections across them
     listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if cpu is not None:
+        set_incoming_cpu(listen_sock, cpu)
     listen_sock.bind((config.listen_address, config.listen_port))
     listen_sock.listen(config.max_connections)
     listen_sock.setblocking(False)
+    return listen_sock
 
+
+def create_context(
+    id: int,
+    config: ProxyConfig,
+    selector: Optional[selectors.BaseSelector],
+    shared_cache: Optional[SharedResponseCache],
+    metrics: Optional[MetricsRegion],
+    is_alive: Optional[Callable] = None,
+) -> WorkerContext:
+    """
+    The state of worker `id`: its cache tiers, DNS resolver, upstream
+    pool (checking idle connections with is_alive, if given), metrics
+    and access log. Shared by both engines.
+    """
+    ctx = WorkerContext(
+        config=config,
+        selector=selector,
+        debug=log.isEnabledFor(logging.DEBUG),
+    )
+    if metrics is not None:
+        ctx.metrics = metrics.worker(id)
+    ctx.resolver = DNSResolver(config.dns_cache_ttl)
+    if config.upstream_max_idle_per_host > 0:
+        ctx.pool = UpstreamPool(
+            config.upstream_max_idle_per_host,
+            config.upstream_idle_timeout,
+            is_alive,
+        )
+    if config.disk_cache_dir:
+        # Each worker keeps its share of the directory under its share
+        # of the budget
+        ctx.disk_cache = DiskCache(
+            config.disk_cache_dir,
+            config.disk_cache_size // config.num_workers,
+            config.disk_cache_max_object_size,
+            config.cache_grace,
+            part=id % config.num_workers,
+            parts=config.num_workers,
+        )
+    if shared_cache is not None:
+        ctx.cache = shared_cache
+    elif config.cache_size > 0:
+        ctx.cache = ResponseCache(
+            config.cache_size,
+            config.cache_ttl,
+            config.cache_max_object_size,
+            on_evict=ctx.disk_cache.spill if ctx.disk_cache else None,
+            grace=config.cache_grace,
+            admission=make_admission(config.cache_policy, config.cache_size),
+        )
+    if config.access_log:
+        ctx.access_log = AccessLog(config.access_log)
+    return ctx
+
+
+def worker(
+    id: int,
+    config: ProxyConfig,
+    shared_cache: Optional[SharedResponseCache] = None,
+    metrics: Optional[MetricsRegion] = None,
+    ready: Optional[multiprocessing.synchronize.Event] = None,
+    cpu: Optional[int] = None,
+):
+    """
+    Run worker `id` until it is interrupted, or until it has drained
+    after DRAIN_SIGNAL. `ready` is set once it is listening. Given a
+    `cpu`, the worker stays on it and asks for the connections the
+    kernel processes there.
+    """
+    log_handler = configure_logging(config.log_level)
+    if cpu is not None and not pin_to_cpu(cpu):
+        cpu = None
+    listen_sock = open_listen_socket(config, cpu)
     selector = selectors.DefaultSelector()
     selector.register(listen_sock, selectors.EVENT_READ)
-    connections = {}
+    ctx = create_context(id, config, selector, shared_cache, metrics)
+    selector.register(ctx.resolver.wakeup_socket, selectors.EVENT_READ)
+    WorkerProfiler(config.profile_dir, f"worker-{id}").install()
+
+    def drain(signum, frame):
+        ctx.draining = True
 
-    print(
-        f"Worker {id} started and listening on "
-        f"{config.listen_address}:{config.listen_port}"
+    signal.signal(DRAIN_SIGNAL, drain)
+    log.info(
+        "Worker %d started and listening on %s:%d",
+        id,
+        config.listen_address,
+        config.listen_port,
     )
+    if ready is not None:
+        ready.set()
 
+    next_publish = 0.0
+    drain_deadline = None
     try:
         while True:
-            events = selector.select(timeout=1)
+            if ctx.draining and drain_deadline is None:
+                log.info("Worker %d draining", id)
+                drain_deadline = time.monotonic() + config.drain_timeout
+                start_draining(listen_sock, ctx)
+            if drain_deadline is not None and (
+                not ctx.connections or time.monotonic() >= drain_deadline
+            ):
+                if ctx.connections:
+                    log.warning(
+                        "Worker %d exiting with %d connections open",
+                        id,
+                        len(ctx.connections),
+                    )
+                log_cache_stats(id, ctx)
+                break
+            timeout = ctx.timers.timeout(time.monotonic())
+            events = selector.select(
+                timeout=1 if timeout is None else min(timeout, 1)
+            )
+            if ctx.pool is not None:
+                ctx.pool.prune()
+            now = time.monotonic()
+            if now >= next_publish:
+                publish_cache_stats(ctx)
+                next_publish = now + METRICS_INTERVAL
             for key, mask in events:
                 conn = key.data
-                if conn is None:
-                    # This is the listen socket
-                    handle_accept(listen_sock, selector, connections)
-                else:
+                if key.fileobj is listen_sock:
+                    handle_accept(listen_sock, ctx)
+                elif key.fileobj is ctx.resolver.wakeup_socket:
+                    # DNS lookups finished in the resolver threads
+                    ctx.resolver.process_completions()
+                elif conn.state == ConnectionState.CLOSED:
+                    # Closed by an earlier event in this batch
+                    continue
+                elif key.fileobj is conn.socket:
                     # This is a client connection
-                    handle_connection(key, mask, selector, connections)
+                    handle_connection(key, mask, ctx)
+                else:
+                    # This is the upstream side of a client connection
+                    handle_upstream_connection(key, mask, ctx)
+            ctx.timers.run(time.monotonic())
     except KeyboardInterrupt:
-        print(f"Worker {id} shutting down...")
+        log.info("Worker %d shutting down...", id)
+        log_cache_stats(id, ctx)
     except Exception as e:
-        print(f"Error in worker {id}: {e}")
+        log.exception("Error in worker %d: %s", id, e)
     finally:
         listen_sock.close()
-        for conn in connections.values():
-            conn.socket.close()
-        selector.close()
-
-
-def handle_upstream_connection(
-    key: selectors.SelectorKey,
-    mask: int,
-    selector: selectors.DefaultSelector,
-    connections: dict[int, Connection],
-) -> None:
-    try:
-        conn = key.data
-        if conn.state == ConnectionState.RECV_UPSTREAM:
-            data = conn.socket.recv(4096)
-            if not data:
-                conn.state = ConnectionState.CLOSED
-            else:
-                conn.recv_buffer += data
-                print(f"Received {len(data)} bytes from upstream")
-                conn.state = ConnectionState.SEND_CLIENT
-        elif conn.state == ConnectionState.SEND_UPSTREAM:
-            data = conn.socket.send(conn.send_buffer)
-            if not data:
-                conn.state = ConnectionState.CLOSED
-            else:
-                conn.send_buffer = conn.send_buffer[data:]
-                print(f"Sent {data} bytes to upstream")
-                conn.state = ConnectionState.RECV_UPSTREAM
-        elif conn.state == ConnectionState.SEND_CLIENT:
-            data = conn.socket.send(conn.send_buffer)
-            if not data:
-                conn.state = ConnectionState.CLOSED
-            else:
-                conn.send_buffer = conn.send_buffer[data:]
-                print(f"Sent {data} bytes to client")
-                conn.state = ConnectionState.RECV_UPSTREAM
-    except Exception as e:
-        print(f"Error handling upstream connection: {e}")
-        try:
-            selector.unregister(conn.socket)
+        for conn in ctx.connections.values():
+            if conn.upstream_socket is not None:
+                conn.upstream_socket.close()
             conn.socket.close()
-            if conn.socket.fileno() in connections:
-                del connections[conn.socket.fileno()]
-        except Exception:
-            pass
-    finally:
-        conn.socket.close()
+        ctx.resolver.close()
+        if ctx.pool is not None:
+            ctx.pool.close()
+        if ctx.access_log is not None:
+            ctx.access_log.close()
         selector.close()
+        log_handler.close()
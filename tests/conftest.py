@@ -0,0 +1,54 @@
+import pytest
+import socket
+import time
+import multiprocessing
+import sys
+import os
+from contextlib import contextmanager
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from asyncio_worker import asyncio_worker
+from datastructures import ProxyConfig
+from worker import worker
+
+
+def free_port():
+    """Return a TCP port on localhost that nothing is listening on"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@contextmanager
+def running_worker(metrics=None, **config_overrides):
+    """
+    Run a single worker in a child process and yield its listen port
+    """
+    port = free_port()
+    config = ProxyConfig(listen_port=port, num_workers=1, **config_overrides)
+    engine = asyncio_worker if config.engine == "asyncio" else worker
+    process = multiprocessing.Process(
+        target=engine, args=(0, config, None, metrics)
+    )
+    process.start()
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    try:
+        yield port
+    finally:
+        process.terminate()
+        process.join(timeout=5)
+
+
+@pytest.fixture(scope="module")
+def proxy_port():
+    with running_worker() as port:
+        yield port
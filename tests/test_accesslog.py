@@ -0,0 +1,132 @@
+import pytest
+import pstats
+import time
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from accesslog import AccessLog, format_access_line
+from datastructures import RequestLog
+from profiling import WorkerProfiler
+
+
+def complete_log():
+    """A request that went through every phase, 1ms each"""
+    return RequestLog(
+        accepted=100.000,
+        received=100.001,
+        parsed=100.002,
+        resolving=100.002,
+        resolved=100.003,
+        connecting=100.003,
+        connected=100.004,
+        sent=100.005,
+        first_byte=100.006,
+        upstream_done=100.007,
+        finished=100.008,
+        request_line="GET http://example.com/",
+        status=200,
+        cache="miss",
+        bytes_sent=1234,
+    )
+
+
+class TestFormatAccessLine:
+    """Test access log lines"""
+
+    def test_all_phases(self):
+        """Test every phase of a proxied request is reported"""
+        line = format_access_line(("127.0.0.1", 5000), complete_log())
+
+        assert line.startswith("127.0.0.1:5000 [")
+        assert line.endswith("\n")
+        assert '"GET http://example.com/" 200 1234 cache=miss' in line
+        assert "total=7.000" in line
+        for phase in ("wait", "parse", "dns", "connect", "send", "ttfb",
+                      "transfer", "write"):
+            assert f" {phase}=1.000" in line
+
+    def test_missing_phases(self):
+        """Test phases a cache hit skips are shown as -"""
+        log = RequestLog(
+            accepted=100.000,
+            received=100.001,
+            parsed=100.002,
+            finished=100.004,
+            request_line="GET http://example.com/",
+            status=200,
+            cache="hit",
+        )
+        line = format_access_line(("127.0.0.1", 5000), log)
+
+        assert "dns=- connect=- send=- ttfb=- transfer=-" in line
+        # Writing the hit starts once it was parsed
+        assert "write=2.000" in line
+        assert "total=3.000" in line
+
+    def test_reused_connection(self):
+        """Test a pooled upstream connection sends from parse time"""
+        log = complete_log()
+        log.resolving = log.resolved = 0.0
+        log.connecting = log.connected = 0.0
+        line = format_access_line(("127.0.0.1", 5000), log)
+
+        assert "dns=- connect=- send=3.000" in line
+
+
+class TestAccessLogFile:
+    """Test writing the access log"""
+
+    def test_lines_appended(self, tmp_path):
+        """Test lines are appended on flush and on close"""
+        path = tmp_path / "access.log"
+        log = AccessLog(str(path))
+        log.write(("127.0.0.1", 5000), complete_log())
+        log.flush()
+        assert path.read_text().count("\n") == 1
+
+        log.write(("127.0.0.1", 5001), complete_log())
+        log.close()
+        lines = path.read_text().splitlines()
+        assert [line.split()[0] for line in lines] == [
+            "127.0.0.1:5000", "127.0.0.1:5001"
+        ]
+
+    @pytest.mark.timeout(5)
+    def test_written_in_background(self, tmp_path):
+        """Test lines reach the file without being flushed"""
+        path = tmp_path / "access.log"
+        log = AccessLog(str(path))
+        log.write(("127.0.0.1", 5000), complete_log())
+        while not path.read_text():
+            time.sleep(0.05)
+        log.close()
+
+        assert path.read_text().count("\n") == 1
+
+
+class TestWorkerProfiler:
+    """Test the on-demand profiler"""
+
+    def test_toggle_writes_stats(self, tmp_path):
+        """Test a profiling window ends in a pstats file"""
+        profiler = WorkerProfiler(str(tmp_path), "worker-0")
+        assert profiler.toggle() is None
+        assert profiler.active
+        sum(range(1000))
+        path = profiler.toggle()
+
+        assert not profiler.active
+        assert os.path.dirname(path) == str(tmp_path)
+        assert os.path.basename(path).startswith("worker-0-")
+        assert pstats.Stats(path).total_calls > 0
+
+    def test_unwritable_directory(self, tmp_path):
+        """Test a failed dump is reported rather than raised"""
+        profiler = WorkerProfiler(str(tmp_path / "missing"), "worker-0")
+        profiler.toggle()
+
+        assert profiler.toggle() is None
+        assert not profiler.active
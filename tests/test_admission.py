@@ -0,0 +1,68 @@
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from admission import MAX_COUNT, FrequencySketch, TinyLFU, make_admission
+
+
+class TestFrequencySketch:
+    """Test the count-min frequency sketch"""
+
+    def test_counts_accesses(self):
+        sketch = FrequencySketch(1024)
+        for _ in range(3):
+            sketch.increment("GET http://a/")
+        sketch.increment("GET http://b/")
+
+        assert sketch.estimate("GET http://a/") == 3
+        assert sketch.estimate("GET http://b/") == 1
+        assert sketch.estimate("GET http://c/") == 0
+
+    def test_counters_saturate(self):
+        sketch = FrequencySketch(1024)
+        for _ in range(MAX_COUNT + 10):
+            sketch.increment("GET http://a/")
+
+        assert sketch.estimate("GET http://a/") == MAX_COUNT
+
+    def test_aging_halves_counts(self):
+        """Test counts are halved after sample_size increments"""
+        sketch = FrequencySketch(16)
+        for _ in range(8):
+            sketch.increment("GET http://a/")
+        for i in range(sketch.sample_size - 8):
+            sketch.increment(f"GET http://other/{i}")
+
+        assert sketch.resets == 1
+        assert sketch.estimate("GET http://a/") <= 4
+
+    def test_width_rounded_to_power_of_two(self):
+        assert FrequencySketch(1000).width == 1024
+        assert FrequencySketch(1).width == 16
+
+
+class TestTinyLFU:
+    """Test admission decisions"""
+
+    def test_admits_more_popular_candidate(self):
+        admission = TinyLFU(64)
+        for _ in range(2):
+            admission.record("GET http://new/")
+        admission.record("GET http://old/")
+
+        assert admission.admit("GET http://new/", ["GET http://old/"])
+        assert not admission.admit("GET http://old/", ["GET http://new/"])
+        assert (admission.admitted, admission.rejected) == (1, 1)
+
+    def test_ties_favour_the_victim(self):
+        admission = TinyLFU(64)
+        admission.record("GET http://new/")
+        admission.record("GET http://old/")
+
+        assert not admission.admit("GET http://new/", ["GET http://old/"])
+
+    def test_make_admission(self):
+        assert make_admission("lru", 1024) is None
+        assert isinstance(make_admission("tinylfu", 1024), TinyLFU)
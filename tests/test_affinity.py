@@ -0,0 +1,88 @@
+import pytest
+import os
+import socket
+import sys
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from affinity import SO_INCOMING_CPU, affinity_cpus, parse_cpu_list
+from datastructures import ProxyConfig
+from metrics import MetricsRegion
+from supervisor import Supervisor
+from tests.conftest import free_port
+
+linux_only = pytest.mark.skipif(
+    not hasattr(os, "sched_setaffinity"), reason="needs sched_setaffinity"
+)
+
+
+class TestCpuList:
+    """Test cpu_affinity settings are turned into CPU numbers"""
+
+    def test_parse(self):
+        """Test single CPUs and ranges keep their order"""
+        assert parse_cpu_list("0") == [0]
+        assert parse_cpu_list("4-6, 1") == [4, 5, 6, 1]
+
+    @pytest.mark.parametrize("text", ["", "a", "3-1", "-1", "0,,1"])
+    def test_invalid(self, text):
+        """Test malformed lists are rejected"""
+        with pytest.raises(ValueError):
+            parse_cpu_list(text)
+
+    @linux_only
+    def test_auto(self):
+        """Test auto takes the CPUs this process may run on"""
+        assert affinity_cpus("auto") == sorted(os.sched_getaffinity(0))
+        assert affinity_cpus("") == []
+
+    @linux_only
+    def test_config(self):
+        """Test CPU_AFFINITY is read and validated"""
+        config = ProxyConfig.from_env({"CPU_AFFINITY": " Auto "})
+        assert config.cpu_affinity == "auto"
+        assert ProxyConfig().cpu_affinity == ""
+        with pytest.raises(ValueError):
+            ProxyConfig(cpu_affinity="0-")
+
+
+@linux_only
+class TestPinning:
+    """Test workers are kept on their CPU and listen for its connections"""
+
+    def test_incoming_cpu_set(self):
+        """Test the listening socket carries SO_INCOMING_CPU"""
+        from worker import open_listen_socket
+
+        config = ProxyConfig(listen_port=free_port())
+        sock = open_listen_socket(config, cpu=0)
+        try:
+            assert sock.getsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU) == 0
+        finally:
+            sock.close()
+
+    @pytest.mark.timeout(20)
+    @pytest.mark.parametrize("engine", ["selectors", "asyncio"])
+    def test_workers_pinned(self, engine):
+        """Test each worker runs on the CPU of its slot"""
+        cpus = sorted(os.sched_getaffinity(0))
+        config = ProxyConfig(
+            listen_port=free_port(),
+            num_workers=2,
+            engine=engine,
+            cpu_affinity="auto",
+        )
+        metrics = MetricsRegion.create(config.num_workers * 2)
+        supervisor = Supervisor(config, metrics)
+        supervisor.start()
+        try:
+            for slot, worker_process in supervisor.workers.items():
+                assert worker_process.ready.wait(10)
+                assert os.sched_getaffinity(worker_process.process.pid) == {
+                    cpus[slot % len(cpus)]
+                }
+        finally:
+            supervisor.stop()
+            metrics.close()
+            metrics.unlink()
@@ -0,0 +1,155 @@
+import pytest
+import socket
+import sys
+import os
+import time
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import tests.test_tunnel as selector_tunnel_tests
+import tests.test_worker as selector_tests
+from tests.conftest import running_worker
+from tests.test_tunnel import echo_port  # noqa: F401
+from tests.test_worker import OriginHandler, fetch, origin  # noqa: F401
+from tests.test_worker import get_request
+
+
+@pytest.fixture(scope="module")
+def proxy_port():
+    with running_worker(engine="asyncio") as port:
+        yield port
+
+
+@pytest.fixture(scope="module", autouse=True)
+def fresh_origin_counters():
+    """The selectors engine tests fetch the same paths"""
+    for seen in (
+        OriginHandler.requests_seen,
+        OriginHandler.peers_seen,
+        OriginHandler.validators_seen,
+    ):
+        seen.clear()
+    yield
+    for seen in (
+        OriginHandler.requests_seen,
+        OriginHandler.peers_seen,
+        OriginHandler.validators_seen,
+    ):
+        seen.clear()
+
+
+class TestUpstreamProxying(selector_tests.TestUpstreamProxying):
+    """Test the upstream path of the asyncio engine"""
+
+
+class TestResponseCaching(selector_tests.TestResponseCaching):
+    """Test the asyncio engine serves repeat GETs from the cache"""
+
+
+class TestCacheControl(selector_tests.TestCacheControl):
+    """Test the asyncio engine honours Cache-Control and Vary"""
+
+    @pytest.mark.timeout(10)
+    def test_max_age_overrides_default_ttl(self, origin):  # noqa: F811
+        """Test a response's max-age keeps it fresh past cache_ttl"""
+        with running_worker(
+            engine="asyncio", cache_backend="local", cache_ttl=0
+        ) as port:
+            fetch(port, origin, "/cc/max-age/60")
+            fetch(port, origin, "/cc/max-age/60")
+
+        assert OriginHandler.requests_seen["cc/max-age/60"] == 1
+
+
+class TestClientKeepAlive(selector_tests.TestClientKeepAlive):
+    """Test persistent and pipelined clients of the asyncio engine"""
+
+
+class TestMalformedRequests(selector_tests.TestMalformedRequests):
+    """Test the asyncio engine answers requests the parser refuses"""
+
+    engine = "asyncio"
+
+
+class TestTunnel(selector_tunnel_tests.TestEventLoopTunnel):
+    """Test CONNECT tunnels relayed by the asyncio engine's protocols"""
+
+    engine = "asyncio"
+
+
+class TestAsyncioEngine:
+    """Test what only the asyncio engine's own code paths cover"""
+
+    @pytest.mark.timeout(10)
+    def test_disk_cache_hit_sent_with_sendfile(
+        self, origin, tmp_path  # noqa: F811
+    ):
+        """Test a disk tier hit is sent by loop.sendfile"""
+        with running_worker(
+            engine="asyncio",
+            cache_backend="local",
+            cache_max_object_size=1000,
+            disk_cache_dir=str(tmp_path),
+        ) as port:
+            first = fetch(port, origin, "/aio-disk/size/500000")
+            second = fetch(port, origin, "/aio-disk/size/500000")
+
+        assert first == second
+        assert len(first.partition(b"\r\n\r\n")[2]) == 500000
+        assert OriginHandler.requests_seen["aio-disk/size/500000"] == 1
+
+    @pytest.mark.timeout(10)
+    def test_disconnect_discards_disk_write(
+        self, origin, tmp_path  # noqa: F811
+    ):
+        """Test a client leaving mid-response removes the partial file"""
+        with running_worker(
+            engine="asyncio",
+            cache_backend="local",
+            cache_max_object_size=1000,
+            disk_cache_dir=str(tmp_path),
+        ) as port:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.sendall(get_request(origin, "/aio-abort/trickle/400000"))
+            # The head, then the first part spilled to disk
+            assert sock.recv(65536).startswith(b"HTTP/1.1 200")
+            time.sleep(0.3)
+            assert os.listdir(tmp_path / "tmp")
+            sock.close()
+            time.sleep(0.3)
+            assert os.listdir(tmp_path / "tmp") == []
+
+
+    @pytest.mark.timeout(15)
+    def test_reading_paused_while_answering(self, origin):  # noqa: F811
+        """Test pipelined bytes are left unread until a request is done"""
+        with running_worker(engine="asyncio") as port:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 65536)
+            sock.sendall(get_request(origin, "/aio-paused/slow"))
+            time.sleep(0.3)
+            sock.setblocking(False)
+            sent = 0
+            deadline = time.monotonic() + 1
+            while time.monotonic() < deadline and sent < 64 * 1024 * 1024:
+                try:
+                    sent += sock.send(b"x" * 65536)
+                except BlockingIOError:
+                    time.sleep(0.01)
+            sock.close()
+
+        # Socket buffers only; a reading worker would have taken it all
+        assert sent < 4 * 1024 * 1024
+
+
+class TestOverload(selector_tests.TestOverload):
+    """Test the asyncio engine sheds connections past max_connections"""
+
+    engine = "asyncio"
+
+
+class TestTimeouts(selector_tests.TestTimeouts):
+    """Test the asyncio engine gives up on stalled clients and origins"""
+
+    engine = "asyncio"
@@ -0,0 +1,62 @@
+import pytest
+import multiprocessing
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from benchmarks.loadgen import RequestFactory, percentile
+from benchmarks.origin import serve
+from benchmarks.run import SCENARIOS, run_scenario, wait_for_port
+from tests.conftest import free_port
+
+
+@pytest.fixture(scope="module")
+def origin_port():
+    port = free_port()
+    origin = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    origin.start()
+    wait_for_port(port)
+    yield port
+    origin.terminate()
+    origin.join()
+
+
+class TestLoadGenerator:
+    """Test the benchmark building blocks"""
+
+    def test_percentile(self):
+        samples = [float(i) for i in range(1000, 0, -1)]
+
+        assert percentile(samples, 0.5) == 500
+        assert percentile(samples, 0.99) == 990
+        assert percentile(samples, 0.999) == 999
+        assert percentile([], 0.5) == 0
+
+    def test_request_factory(self):
+        absolute = RequestFactory("127.0.0.1:80", "/size/1", unique=True)
+        tunneled = RequestFactory("127.0.0.1:80", "/size/1", origin_form=True)
+
+        assert absolute(7).startswith(
+            b"GET http://127.0.0.1:80/size/1?n=7 HTTP/1.1\r\n"
+        )
+        assert tunneled(7).startswith(b"GET /size/1 HTTP/1.1\r\n")
+
+
+class TestScenarios:
+    """Smoke-test the scenarios against a real proxy"""
+
+    @pytest.mark.timeout(30)
+    @pytest.mark.parametrize("name", ["cache_hit", "connect_tunnel"])
+    def test_scenario_reports(self, origin_port, name):
+        result = run_scenario(
+            SCENARIOS[name], origin_port, workers=1, concurrency=2,
+            duration=0.3,
+        )
+
+        assert result["scenario"] == name
+        assert result["requests"] > 0
+        assert result["errors"] == 0
+        assert 0 < result["latency_ms"]["p50"] <= result["latency_ms"]["p999"]
+        assert result["rss_bytes"] > 0
@@ -0,0 +1,150 @@
+import pytest
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from admission import TinyLFU
+from cache import ResponseCache
+
+
+class TestResponseCache:
+    """Test the per-worker LRU response cache"""
+
+    def test_put_and_get(self):
+        """Test a stored response is returned"""
+        cache = ResponseCache(max_bytes=1024, ttl=60)
+        assert cache.put("GET http://a/", b"response", now=0)
+
+        assert cache.get("GET http://a/", now=1) == b"response"
+        assert cache.hits == 1
+        assert cache.current_bytes == len(b"response")
+
+    def test_miss(self):
+        """Test a missing key returns None and counts a miss"""
+        cache = ResponseCache(max_bytes=1024, ttl=60)
+
+        assert cache.get("GET http://a/") is None
+        assert cache.misses == 1
+
+    def test_ttl_expiry(self):
+        """Test entries expire after ttl seconds"""
+        cache = ResponseCache(max_bytes=1024, ttl=60)
+        cache.put("GET http://a/", b"response", now=0)
+
+        assert cache.get("GET http://a/", now=60) is None
+        assert "GET http://a/" not in cache
+        assert cache.current_bytes == 0
+
+    def test_expired_entry_kept_for_grace_period(self):
+        """Test an expired entry stays available to get_stale for a while"""
+        cache = ResponseCache(max_bytes=1024, ttl=60, grace=30)
+        cache.put("GET http://a/", b"response", now=0)
+
+        assert cache.get_stale("GET http://a/", now=59) is None
+        assert cache.get("GET http://a/", now=70) is None
+        assert cache.get_stale("GET http://a/", now=70) == (b"response", 10)
+
+        assert cache.get("GET http://a/", now=90) is None
+        assert cache.get_stale("GET http://a/", now=90) is None
+        assert "GET http://a/" not in cache
+
+    def test_put_with_own_ttl(self):
+        """Test a per-response ttl overrides the cache's"""
+        cache = ResponseCache(max_bytes=1024, ttl=60)
+        cache.put("GET http://a/", b"response", now=0, ttl=600)
+
+        assert cache.get("GET http://a/", now=300) == b"response"
+        assert cache.get("GET http://a/", now=600) is None
+
+    def test_lru_eviction_respects_byte_budget(self):
+        """Test least recently used entries are evicted to fit the budget"""
+        cache = ResponseCache(max_bytes=30, ttl=60)
+        cache.put("a", b"x" * 10, now=0)
+        cache.put("b", b"x" * 10, now=0)
+        cache.put("c", b"x" * 10, now=0)
+        cache.get("a", now=1)  # "b" is now least recently used
+        cache.put("d", b"x" * 10, now=2)
+
+        assert "b" not in cache
+        assert "a" in cache and "c" in cache and "d" in cache
+        assert cache.current_bytes == 30
+        assert cache.evictions == 1
+
+    def test_oversized_object_rejected(self):
+        """Test objects over max_object_size are not stored"""
+        cache = ResponseCache(max_bytes=100, ttl=60, max_object_size=10)
+
+        assert not cache.put("a", b"x" * 11)
+        assert len(cache) == 0
+
+    def test_replace_updates_size(self):
+        """Test storing an existing key replaces the old entry"""
+        cache = ResponseCache(max_bytes=100, ttl=60)
+        cache.put("a", b"x" * 10)
+        cache.put("a", b"x" * 20)
+
+        assert len(cache) == 1
+        assert cache.current_bytes == 20
+
+
+class TestAdmission:
+    """Test the cache with a TinyLFU admission policy in front"""
+
+    def test_one_off_does_not_evict_popular_entry(self):
+        """Test a new entry loses to a more frequently requested victim"""
+        admission = TinyLFU(capacity=64)
+        cache = ResponseCache(max_bytes=10, ttl=60, admission=admission)
+        for _ in range(3):
+            cache.get("GET http://popular/", now=0)
+        cache.put("GET http://popular/", b"x" * 10, now=0)
+
+        cache.get("GET http://once/", now=0)
+        assert not cache.put("GET http://once/", b"y" * 10, now=0)
+        assert cache.get("GET http://popular/", now=1) == b"x" * 10
+        assert admission.rejected == 1
+
+    def test_popular_entry_admitted(self):
+        """Test a new entry wins once it is requested more than the victim"""
+        admission = TinyLFU(capacity=64)
+        cache = ResponseCache(max_bytes=10, ttl=60, admission=admission)
+        cache.put("GET http://old/", b"x" * 10, now=0)
+        for _ in range(2):
+            cache.get("GET http://new/", now=0)
+
+        assert cache.put("GET http://new/", b"y" * 10, now=0)
+        assert "GET http://old/" not in cache
+        assert admission.admitted == 1
+
+    def test_scan_does_not_flush_cache(self):
+        """Test a scan of unique URLs leaves the working set cached"""
+        def run(admission):
+            cache = ResponseCache(
+                max_bytes=100, ttl=60, admission=admission
+            )
+            hot = [f"GET http://hot/{i}" for i in range(5)]
+            for _ in range(3):
+                for key in hot:
+                    if cache.get(key, now=0) is None:
+                        cache.put(key, b"h" * 10, now=0)
+            for i in range(100):
+                key = f"GET http://scan/{i}"
+                cache.get(key, now=0)
+                cache.put(key, b"s" * 10, now=0)
+            for key in hot:
+                cache.get(key, now=0)
+            return cache.hit_ratio
+
+        assert run(TinyLFU(capacity=64)) > run(None)
+
+    def test_expired_victims_do_not_count(self):
+        """Test entries past their grace period are evicted regardless"""
+        admission = TinyLFU(capacity=64)
+        cache = ResponseCache(max_bytes=10, ttl=60, admission=admission)
+        for _ in range(3):
+            cache.get("GET http://old/", now=0)
+        cache.put("GET http://old/", b"x" * 10, now=0)
+
+        assert cache.put("GET http://new/", b"y" * 10, now=61)
+        assert admission.admitted == admission.rejected == 0
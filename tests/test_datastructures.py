@@ -47,11 +47,106 @@ class TestProxyConfig:
         with pytest.raises(ValueError, match="cache_size must be at least 0"):
             ProxyConfig(cache_size=-1)
 
+    def test_invalid_cache_max_object_size(self):
+        """Test validation of cache_max_object_size"""
+        with pytest.raises(
+            ValueError, match="cache_max_object_size must be at least 0"
+        ):
+            ProxyConfig(cache_max_object_size=-1)
+
+    def test_invalid_cache_backend(self):
+        """Test validation of cache_backend"""
+        with pytest.raises(ValueError, match="cache_backend must be one of"):
+            ProxyConfig(cache_backend="redis")
+
+    def test_invalid_cache_policy(self):
+        """Test validation of cache_policy"""
+        with pytest.raises(ValueError, match="cache_policy must be one of"):
+            ProxyConfig(cache_policy="arc")
+        with pytest.raises(ValueError, match="requires the local"):
+            ProxyConfig(cache_policy="tinylfu")
+        assert ProxyConfig(
+            cache_policy="tinylfu", cache_backend="local"
+        ).cache_policy == "tinylfu"
+
+    def test_invalid_admin_port(self):
+        """Test validation of admin_port"""
+        with pytest.raises(ValueError, match="admin_port must be between"):
+            ProxyConfig(admin_port=70000)
+
+    def test_invalid_connection_limits(self):
+        """Test validation of max_connections and accept_batch"""
+        with pytest.raises(
+            ValueError, match="max_connections must be at least 1"
+        ):
+            ProxyConfig(max_connections=0)
+        with pytest.raises(
+            ValueError, match="accept_batch must be at least 1"
+        ):
+            ProxyConfig(accept_batch=0)
+
+    def test_invalid_timeouts(self):
+        """Test validation of the timeouts; 0 disables them"""
+        with pytest.raises(
+            ValueError, match="upstream_timeout must be at least 0"
+        ):
+            ProxyConfig(upstream_timeout=-1)
+        config = ProxyConfig(keep_alive_timeout=0, tunnel_idle_timeout=0)
+        assert config.keep_alive_timeout == 0
+
+    def test_max_body_size(self):
+        """Test MAX_BODY_SIZE is read and validated"""
+        config = ProxyConfig.from_env({"MAX_BODY_SIZE": "1000"})
+        assert config.max_body_size == 1000
+        with pytest.raises(
+            ValueError, match="max_body_size must be at least 0"
+        ):
+            ProxyConfig(max_body_size=-1)
+
+    def test_invalid_disk_cache_size(self):
+        """Test validation of disk_cache_size"""
+        with pytest.raises(
+            ValueError, match="disk_cache_size must be at least 0"
+        ):
+            ProxyConfig(disk_cache_size=-1)
+
     def test_invalid_cache_ttl(self):
         """Test validation of cache_ttl"""
         with pytest.raises(ValueError, match="cache_ttl must be at least 0"):
             ProxyConfig(cache_ttl=-1)
 
+    def test_invalid_stale_windows(self):
+        """Test validation of the stale cache settings"""
+        with pytest.raises(
+            ValueError, match="cache_stale_if_error must be at least 0"
+        ):
+            ProxyConfig(cache_stale_if_error=-1)
+
+    def test_cache_grace_covers_stale_windows(self):
+        """Test expired entries are kept as long as any stale window"""
+        assert ProxyConfig(cache_keep_stale=10).cache_grace == 10
+        assert ProxyConfig(
+            cache_keep_stale=10, cache_stale_while_revalidate=60
+        ).cache_grace == 60
+
+    def test_invalid_tunnel_relay(self):
+        """Test validation of tunnel_relay"""
+        with pytest.raises(ValueError, match="tunnel_relay must be one of"):
+            ProxyConfig(tunnel_relay="sendfile")
+
+    def test_access_log_and_profile_dir(self):
+        """Test the observability settings"""
+        assert ProxyConfig().access_log == ""
+        config = ProxyConfig(access_log="-", profile_dir="/var/tmp")
+        assert config.access_log == "-"
+        assert config.profile_dir == "/var/tmp"
+
+    def test_invalid_log_level(self):
+        """Test validation of log_level"""
+        assert ProxyConfig().log_level == "INFO"
+        with pytest.raises(ValueError, match="log_level must be one of"):
+            ProxyConfig(log_level="TRACE")
+
     def test_from_env_with_defaults(self):
         """Test loading from environment with defaults"""
         # Save original env
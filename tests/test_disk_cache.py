@@ -0,0 +1,152 @@
+import pytest
+import time
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from cache import CacheEntry
+from disk_cache import DiskCache
+
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    return DiskCache(str(tmp_path), max_bytes=10000, max_object_size=5000)
+
+
+def read_hit(hit):
+    cache_file, offset, length = hit
+    with cache_file:
+        cache_file.seek(offset)
+        return cache_file.read(length)
+
+
+class TestDiskCache:
+    """Test the on-disk cache tier"""
+
+    def test_put_and_lookup(self, disk_cache):
+        """Test a stored response can be read back from its offset"""
+        disk_cache.put("GET http://a/", b"response", expires=time.time() + 60)
+
+        hit = disk_cache.lookup("GET http://a/")
+        assert hit is not None
+        assert read_hit(hit) == b"response"
+        assert disk_cache.hits == 1
+
+    def test_miss(self, disk_cache):
+        """Test an unknown key is a miss"""
+        assert disk_cache.lookup("GET http://missing/") is None
+        assert disk_cache.misses == 1
+
+    def test_expired_entry_removed(self, disk_cache):
+        """Test an expired file is a miss and is deleted"""
+        disk_cache.put("GET http://a/", b"response", expires=100.0)
+
+        assert disk_cache.lookup("GET http://a/", now=100.0) is None
+        assert disk_cache.current_bytes == 0
+
+    def test_expired_entry_kept_for_grace_period(self, tmp_path):
+        """Test an expired file stays available to lookup_stale for a while"""
+        disk_cache = DiskCache(
+            str(tmp_path), max_bytes=10000, max_object_size=5000, grace=30
+        )
+        disk_cache.put("GET http://a/", b"response", expires=100.0)
+
+        assert disk_cache.lookup("GET http://a/", now=110.0) is None
+        cache_file, offset, length, staleness = disk_cache.lookup_stale(
+            "GET http://a/", now=110.0
+        )
+        assert read_hit((cache_file, offset, length)) == b"response"
+        assert staleness == 10.0
+
+        assert disk_cache.lookup_stale("GET http://a/", now=130.0) is None
+        assert disk_cache.current_bytes == 0
+
+    def test_refresh(self, disk_cache):
+        """Test refresh gives a stored file a new expiry in place"""
+        disk_cache.put("GET http://a/", b"response", expires=100.0)
+
+        assert disk_cache.refresh("GET http://a/", 200.0)
+        assert read_hit(disk_cache.lookup("GET http://a/", now=150.0)) == (
+            b"response"
+        )
+        assert not disk_cache.refresh("GET http://missing/", 200.0)
+
+    def test_streaming_writer(self, disk_cache):
+        """Test a response written in pieces is only visible on commit"""
+        writer = disk_cache.begin("GET http://a/")
+        writer.write(b"part one, ")
+        assert disk_cache.lookup("GET http://a/") is None
+        writer.write(b"part two")
+        writer.commit(time.time() + 60)
+
+        assert read_hit(disk_cache.lookup("GET http://a/")) == (
+            b"part one, part two"
+        )
+
+    def test_aborted_writer_leaves_nothing(self, disk_cache, tmp_path):
+        """Test aborting a write removes its temporary file"""
+        writer = disk_cache.begin("GET http://a/")
+        writer.write(b"partial")
+        writer.abort()
+
+        assert disk_cache.lookup("GET http://a/") is None
+        assert os.listdir(tmp_path / "tmp") == []
+
+    def test_budget_evicts_least_recently_used(self, disk_cache):
+        """Test the directory is kept under max_bytes"""
+        expires = time.time() + 60
+        for i in range(4):
+            disk_cache.put(f"k{i}", b"x" * 3000, expires)
+
+        assert disk_cache.current_bytes <= disk_cache.max_bytes
+        assert disk_cache.lookup("k0") is None
+        assert disk_cache.lookup("k3") is not None
+        assert disk_cache.evictions >= 1
+
+    def test_oversized_object_rejected(self, disk_cache):
+        """Test objects over max_object_size are not stored"""
+        assert not disk_cache.put("big", b"x" * 5001, time.time() + 60)
+
+    def test_index_reloaded_from_directory(self, disk_cache, tmp_path):
+        """Test a new instance picks up existing files"""
+        disk_cache.put("GET http://a/", b"response", time.time() + 60)
+
+        reopened = DiskCache(str(tmp_path), 10000, 5000)
+        assert reopened.current_bytes == disk_cache.current_bytes
+        assert read_hit(reopened.lookup("GET http://a/")) == b"response"
+
+    def test_budget_split_between_workers(self, tmp_path):
+        """Test workers sharing a directory each budget their own part"""
+        expires = time.time() + 60
+        first = DiskCache(str(tmp_path), 10000, 5000, part=0, parts=2)
+        second = DiskCache(str(tmp_path), 10000, 5000, part=1, parts=2)
+        first.put("k0", b"x" * 3000, expires)
+        # Served to the other worker, which leaves it to the first
+        assert second.lookup("k0") is not None
+        assert second.current_bytes == 0
+        for i in range(1, 8):
+            second.put(f"k{i}", b"x" * 3000, expires)
+        assert first.current_bytes + second.current_bytes <= 20000
+
+        # A restart splits the files between the workers again
+        sizes = [
+            DiskCache(str(tmp_path), 10000, 5000, part=part, parts=2)
+            .current_bytes
+            for part in range(2)
+        ]
+        on_disk = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(tmp_path)
+            for name in names
+        )
+        assert sum(sizes) == on_disk
+
+    def test_spill_keeps_remaining_lifetime(self, disk_cache):
+        """Test evicted memory entries are written to disk while fresh"""
+        disk_cache.spill("fresh", CacheEntry(b"r", time.monotonic() + 60))
+        disk_cache.spill("stale", CacheEntry(b"r", time.monotonic() - 1))
+
+        assert disk_cache.lookup("fresh") is not None
+        assert disk_cache.lookup("stale") is None
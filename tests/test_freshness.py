@@ -0,0 +1,131 @@
+import pytest
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from freshness import (
+    VaryIndex,
+    parse_cache_control,
+    primary_key,
+    request_cacheable,
+    request_wants_validation,
+    response_ttl,
+    stale_windows,
+    variant_key,
+    vary_names,
+)
+from http_parser import Headers
+
+DATE = "Sun, 06 Nov 1994 08:49:37 GMT"
+NOW = 784111777.0  # DATE as a timestamp
+
+
+def headers(*fields):
+    result = Headers()
+    for name, value in fields:
+        result.add(name, value)
+    return result
+
+
+class TestCacheControl:
+    """Test Cache-Control parsing and request directives"""
+
+    def test_parse_directives(self):
+        """Test names are lowercased and quoted arguments unquoted"""
+        assert parse_cache_control(
+            'Max-Age=60, no-cache="Set-Cookie", public'
+        ) == {"max-age": "60", "no-cache": "Set-Cookie", "public": None}
+        assert parse_cache_control(None) == {}
+
+    def test_request_cacheable(self):
+        """Test credentials and no-store keep a request out of the cache"""
+        assert request_cacheable(headers())
+        assert not request_cacheable(headers(("Authorization", "Basic x")))
+        assert not request_cacheable(headers(("Cache-Control", "no-store")))
+
+    @pytest.mark.parametrize("fields, expected", [
+        ((), False),
+        ((("Cache-Control", "no-cache"),), True),
+        ((("Cache-Control", "max-age=0"),), True),
+        ((("Cache-Control", "max-age=10"),), False),
+        ((("Pragma", "no-cache"),), True),
+        ((("Cache-Control", "max-age=10"), ("Pragma", "no-cache")), False),
+    ])
+    def test_request_wants_validation(self, fields, expected):
+        assert request_wants_validation(headers(*fields)) is expected
+
+
+class TestResponseTTL:
+    """Test how long responses stay fresh"""
+
+    @pytest.mark.parametrize("fields, expected", [
+        ((), 300),
+        ((("Cache-Control", "max-age=60"),), 60),
+        ((("Cache-Control", "max-age=60, s-maxage=120"),), 120),
+        ((("Cache-Control", "max-age=60"), ("Age", "20")), 40),
+        ((("Cache-Control", "max-age=10"), ("Age", "20")), 0),
+        ((("Cache-Control", "no-cache"),), 0),
+        ((("Cache-Control", "no-store"),), None),
+        ((("Cache-Control", "private, max-age=60"),), None),
+        ((("Expires", "0"),), 0),
+    ])
+    def test_response_ttl(self, fields, expected):
+        assert response_ttl(headers(*fields), 300, now=NOW) == expected
+
+    def test_expires_relative_to_date(self):
+        """Test Expires counts from the origin's Date, minus its age"""
+        fields = headers(
+            ("Date", DATE), ("Expires", "Sun, 06 Nov 1994 08:50:37 GMT")
+        )
+        assert response_ttl(fields, 300, now=NOW) == 60
+        assert response_ttl(fields, 300, now=NOW + 15) == 45
+
+    def test_stale_windows(self):
+        """Test directives override the configured stale windows"""
+        assert stale_windows(headers(), 10, 20) == (10, 20)
+        assert stale_windows(
+            headers(("Cache-Control", "stale-while-revalidate=5")), 10, 20
+        ) == (5, 20)
+        assert stale_windows(
+            headers(("Cache-Control", "max-age=5, must-revalidate")), 10, 20
+        ) == (0, 0)
+
+
+class TestVary:
+    """Test variant keys for responses with Vary"""
+
+    def test_vary_names(self):
+        """Test names are normalized and * is unmatchable"""
+        assert vary_names(headers()) == ()
+        assert vary_names(headers(
+            ("Vary", "Accept-Encoding, accept-language"),
+            ("Vary", "Accept-Encoding"),
+        )) == ("accept-encoding", "accept-language")
+        assert vary_names(headers(("Vary", "Accept, *"))) is None
+
+    def test_variant_key(self):
+        """Test the key includes the request's normalized values"""
+        request = headers(("Accept-Language", "en,  fr"))
+        names = ("accept-encoding", "accept-language")
+
+        key = variant_key("GET http://a/", names, request)
+        assert key == (
+            "GET http://a/ vary(accept-encoding=; accept-language=en, fr)"
+        )
+        assert primary_key(key) == "GET http://a/"
+        assert variant_key("GET http://a/", (), request) == "GET http://a/"
+
+    def test_vary_index_forgets_least_recently_used(self):
+        index = VaryIndex(max_entries=2)
+        index.set("a", ("accept",))
+        index.set("b", ("accept",))
+        index.get("a")
+        index.set("c", ("accept",))
+
+        assert index.get("b") is None
+        assert index.get("a") == ("accept",)
+        index.set("a", ())
+        assert index.get("a") is None
+        assert len(index) == 1
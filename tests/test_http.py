@@ -5,7 +5,22 @@ import os
 # Add src to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
-from http_parser import parse_http_request, build_http_response, status_code_to_reason
+from http_parser import (
+    parse_http_request,
+    build_http_response,
+    status_code_to_reason,
+    prepare_upstream_request,
+    build_cache_key,
+    parse_status_code,
+    rewrite_response_head,
+    conditional_request,
+    update_stored_head,
+    Headers,
+    MessageFramer,
+    RequestError,
+    RequestParser,
+    ResponseFramer,
+)
 
 
 class TestHTTPRequestParsing:
@@ -80,6 +95,322 @@ class TestHTTPRequestParsing:
         assert result == {}
 
 
+class TestUpstreamRequestRewriting:
+    """Test rewriting client requests before forwarding upstream"""
+
+    def test_adds_connection_close(self):
+        """Test the upstream request asks the origin to close"""
+        request = b"GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n"
+        result = prepare_upstream_request(request)
+
+        assert result.endswith(b"Connection: close\r\n\r\n")
+        assert b"Host: example.com" in result
+
+    def test_strips_hop_by_hop_headers(self):
+        """Test client connection headers are not forwarded"""
+        request = (
+            b"GET http://example.com/ HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"Proxy-Connection: keep-alive\r\n"
+            b"Connection: keep-alive\r\n"
+            b"\r\n"
+        )
+        result = prepare_upstream_request(request)
+
+        assert b"keep-alive" not in result
+        assert result.count(b"Connection:") == 1
+
+    def test_body_is_preserved(self):
+        """Test bytes after the header block pass through unchanged"""
+        request = (
+            b"POST http://example.com/ HTTP/1.1\r\n"
+            b"Host: example.com\r\n"
+            b"Content-Length: 4\r\n"
+            b"\r\n"
+            b"a\r\nb"
+        )
+        result = prepare_upstream_request(request)
+
+        assert result.endswith(b"\r\n\r\na\r\nb")
+
+    def test_keep_alive_request(self):
+        """Test the origin can be asked to keep the connection open"""
+        request = b"GET http://example.com/ HTTP/1.1\r\nHost: example.com\r\n\r\n"
+        result = prepare_upstream_request(request, keep_alive=True)
+
+        assert result.endswith(b"Connection: keep-alive\r\n\r\n")
+
+
+def parse_one(data):
+    parser = RequestParser()
+    parser.feed(data)
+    return parser.next_request()
+
+
+class TestRequestParser:
+    """Test the incremental request parser"""
+
+    def test_request_without_body(self):
+        """Test a request ends after its header block"""
+        data = b"GET http://a/x HTTP/1.1\r\nHost: a\r\n\r\n"
+        request, raw = parse_one(data)
+
+        assert raw == data
+        assert (request.method, request.target, request.version) == (
+            "GET", "http://a/x", "HTTP/1.1"
+        )
+        assert request.headers.get("host") == "a"
+        assert request.head_size == len(data)
+
+    def test_incomplete_request(self):
+        """Test nothing is returned until the head is complete"""
+        assert parse_one(b"GET / HTTP/1.1\r\nHost: a\r\n") is None
+
+    def test_fed_one_byte_at_a_time(self):
+        """Test a request split into single bytes is still found"""
+        data = b"GET / HTTP/1.1\r\nHost: a\r\n\r\n"
+        parser = RequestParser()
+        results = []
+        for i in range(len(data)):
+            parser.feed(data[i:i + 1])
+            results.append(parser.next_request())
+
+        assert results[:-1] == [None] * (len(data) - 1)
+        assert results[-1][1] == data
+
+    def test_content_length_body(self):
+        """Test a Content-Length body must be complete"""
+        head = b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 4\r\n\r\n"
+        parser = RequestParser()
+        parser.feed(head + b"ab")
+        assert parser.next_request() is None
+
+        parser.feed(b"cd")
+        request, raw = parser.next_request()
+        assert request.content_length == 4
+        assert raw == head + b"abcd"
+
+    def test_chunked_body(self):
+        """Test a chunked body ends after the last chunk"""
+        head = b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+        body = b"3\r\nabc\r\n0\r\n\r\n"
+        parser = RequestParser()
+        parser.feed(head + body[:-2])
+        assert parser.next_request() is None
+
+        parser.feed(body[-2:])
+        request, raw = parser.next_request()
+        assert request.chunked
+        assert raw == head + body
+
+    def test_pipelined_requests(self):
+        """Test buffered requests are returned one at a time, in order"""
+        first = b"GET /a HTTP/1.1\r\nHost: a\r\n\r\n"
+        second = b"GET /b HTTP/1.1\r\nHost: a\r\n\r\n"
+        parser = RequestParser()
+        parser.feed(first + second + b"GET /c")
+
+        assert parser.next_request()[1] == first
+        assert parser.next_request()[1] == second
+        assert parser.next_request() is None
+        assert parser.take_buffered() == b"GET /c"
+
+    def test_header_multimap(self):
+        """Test header lookup ignores case and keeps repeated fields"""
+        request, _ = parse_one(
+            b"GET / HTTP/1.1\r\nHost: a\r\n"
+            b"Accept: text/html\r\naccept: */*\r\n\r\n"
+        )
+
+        assert request.headers.get("ACCEPT") == "text/html, */*"
+        assert request.headers.get_all("accept") == ["text/html", "*/*"]
+        assert "Host" in request.headers
+        assert "Cookie" not in request.headers
+
+    def test_head_too_large(self):
+        """Test an oversized header block is refused with 431"""
+        parser = RequestParser(max_head_size=64)
+        parser.feed(b"GET / HTTP/1.1\r\nX-Big: " + b"x" * 100)
+
+        with pytest.raises(RequestError) as exc_info:
+            parser.next_request()
+        assert exc_info.value.status == 431
+
+    def test_content_length_too_large(self):
+        """Test a declared body over max_body_size is refused at once"""
+        parser = RequestParser(max_body_size=4)
+        parser.feed(b"POST / HTTP/1.1\r\nContent-Length: 4000000000\r\n\r\n")
+
+        with pytest.raises(RequestError) as exc_info:
+            parser.next_request()
+        assert exc_info.value.status == 413
+
+    def test_chunked_body_too_large(self):
+        """Test a chunked body is refused once it grows past the limit"""
+        parser = RequestParser(max_body_size=16)
+        parser.feed(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n")
+        parser.feed(b"3\r\nabc\r\n")
+        assert parser.next_request() is None
+
+        parser.feed(b"a\r\n0123456789\r\n")
+        with pytest.raises(RequestError) as exc_info:
+            parser.next_request()
+        assert exc_info.value.status == 413
+
+    def test_body_at_limit_accepted(self):
+        """Test a body of exactly max_body_size is accepted"""
+        parser = RequestParser(max_body_size=4)
+        parser.feed(b"POST / HTTP/1.1\r\nContent-Length: 4\r\n\r\nabcd")
+
+        request, _ = parser.next_request()
+        assert request.content_length == 4
+
+    @pytest.mark.parametrize("data", [
+        b"GET /\r\n\r\n",
+        b"GET / HTTP/1.1\r\nHost : a\r\n\r\n",
+        b"GET / HTTP/1.1\r\nHost: a\r\n folded\r\n\r\n",
+        b"POST / HTTP/1.1\r\nContent-Length: x\r\n\r\n",
+        b"POST / HTTP/1.1\r\nContent-Length: \xb2\r\n\r\n",
+        b"POST / HTTP/1.1\r\nContent-Length: 1\xb9\r\n\r\n",
+        b"POST / HTTP/1.1\r\nContent-Length: 1\r\nContent-Length: 2\r\n\r\n",
+        b"POST / HTTP/1.1\r\nContent-Length: 3\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n",
+        b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n",
+    ])
+    def test_malformed_request(self, data):
+        """Test malformed or ambiguous requests are refused with 400"""
+        with pytest.raises(RequestError) as exc_info:
+            parse_one(data)
+        assert exc_info.value.status == 400
+
+    @pytest.mark.parametrize("size", [b"-5", b"0x5", b"+5", b"1_0", b""])
+    def test_malformed_chunk_size(self, size):
+        """Test a chunk size that is not plain hex digits gets 400"""
+        with pytest.raises(RequestError) as exc_info:
+            parse_one(
+                b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+                + size + b"\r\nhello\r\n0\r\n\r\n"
+            )
+        assert exc_info.value.status == 400
+
+    def test_keep_alive_defaults(self):
+        """Test HTTP/1.1 persists unless closed, HTTP/1.0 only on request"""
+        def keep_alive(version, header=b""):
+            request, _ = parse_one(
+                b"GET / " + version + b"\r\nHost: a\r\n" + header + b"\r\n"
+            )
+            return request.keep_alive
+
+        assert keep_alive(b"HTTP/1.1")
+        assert not keep_alive(b"HTTP/1.1", b"Connection: close\r\n")
+        assert not keep_alive(b"HTTP/1.0")
+        assert keep_alive(b"HTTP/1.0", b"Proxy-Connection: Keep-Alive\r\n")
+
+
+class TestHeaders:
+    """Test the case-insensitive header multimap"""
+
+    def test_preserves_order_and_spelling(self):
+        headers = Headers()
+        headers.add("X-One", "1")
+        headers.add("x-two", "2")
+
+        assert list(headers) == [("X-One", "1"), ("x-two", "2")]
+        assert len(headers) == 2
+        assert headers.get("X-THREE", "default") == "default"
+
+
+class TestResponseRewriting:
+    """Test response heads rewritten for the client"""
+
+    def test_rewrite_response_head(self):
+        """Test response hop-by-hop headers are replaced by our own"""
+        head = (
+            b"HTTP/1.1 100 Continue\r\n\r\n"
+            b"HTTP/1.1 200 OK\r\nConnection: close\r\n"
+            b"Keep-Alive: timeout=5\r\nContent-Length: 0\r\n\r\n"
+        )
+
+        assert rewrite_response_head(head, b"keep-alive") == (
+            b"HTTP/1.1 100 Continue\r\n\r\n"
+            b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+        assert b"Connection" not in rewrite_response_head(head)
+
+
+class TestRevalidation:
+    """Test revalidation requests and 304 handling"""
+
+    STORED = (
+        b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\nETag: \"v1\"\r\n"
+        b"Last-Modified: Mon, 05 Jan 2026 10:00:00 GMT\r\n"
+        b"Cache-Control: max-age=60\r\n\r\n"
+    )
+
+    def test_conditional_request_uses_stored_validators(self):
+        """Test the client's validators are replaced by the stored ones"""
+        request = (
+            b"GET http://a/ HTTP/1.1\r\nHost: a\r\n"
+            b"If-None-Match: \"other\"\r\n\r\n"
+        )
+        result = conditional_request(request, self.STORED)
+
+        assert result == (
+            b"GET http://a/ HTTP/1.1\r\nHost: a\r\n"
+            b"If-None-Match: \"v1\"\r\n"
+            b"If-Modified-Since: Mon, 05 Jan 2026 10:00:00 GMT\r\n\r\n"
+        )
+
+    def test_conditional_request_needs_validator(self):
+        """Test a stored response without validators cannot be revalidated"""
+        stored = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\n"
+        request = b"GET http://a/ HTTP/1.1\r\nHost: a\r\n\r\n"
+
+        assert conditional_request(request, stored) is None
+
+    def test_update_stored_head(self):
+        """Test 304 fields replace stored ones, except framing fields"""
+        not_modified = (
+            b"HTTP/1.1 304 Not Modified\r\nETag: \"v1\"\r\n"
+            b"Cache-Control: max-age=120\r\nContent-Length: 0\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+        )
+
+        assert update_stored_head(self.STORED, not_modified) == (
+            b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n"
+            b"Last-Modified: Mon, 05 Jan 2026 10:00:00 GMT\r\n"
+            b"ETag: \"v1\"\r\nCache-Control: max-age=120\r\n\r\n"
+        )
+
+
+class TestCacheKeys:
+    """Test cache key construction"""
+
+    def test_absolute_url_key(self):
+        """Test absolute-form targets are used as-is"""
+        key = build_cache_key("GET", "http://example.com/a", "example.com")
+        assert key == "GET http://example.com/a"
+
+    def test_origin_form_key(self):
+        """Test origin-form targets are completed from the Host header"""
+        key = build_cache_key("GET", "/a", "example.com:8080")
+        assert key == "GET http://example.com:8080/a"
+
+
+class TestStatusCodeParsing:
+    """Test reading the status code from a raw response"""
+
+    def test_parse_status(self):
+        assert parse_status_code(b"HTTP/1.1 404 Not Found\r\n\r\n") == 404
+
+    def test_parse_incomplete_status(self):
+        assert parse_status_code(b"HTTP/1.1") == 0
+
+    def test_parse_garbage(self):
+        assert parse_status_code(b"garbage here\r\n") == 0
+
+
 class TestHTTPResponseBuilding:
     """Test HTTP response building functionality"""
 
@@ -121,3 +452,149 @@ class TestStatusCodeMapping:
     def test_status_404(self):
         assert status_code_to_reason(404) == "Not Found"
 
+    def test_status_502(self):
+        assert status_code_to_reason(502) == "Bad Gateway"
+
+    def test_status_431(self):
+        assert (
+            status_code_to_reason(431) == "Request Header Fields Too Large"
+        )
+
+    def test_status_413(self):
+        assert status_code_to_reason(413) == "Content Too Large"
+
+
+class TestResponseFramer:
+    """Test finding the end of streamed upstream responses"""
+
+    def feed_bytewise(self, framer, data):
+        return sum(framer.feed(data[i:i + 1]) for i in range(len(data)))
+
+    def test_content_length(self):
+        """Test a Content-Length body completes after its last byte"""
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello"
+        framer = ResponseFramer()
+
+        assert framer.feed(response[:-1]) == len(response) - 1
+        assert not framer.complete
+        assert framer.feed(response[-1:]) == 1
+        assert framer.complete
+        assert framer.status == 200
+        assert framer.keep_alive
+
+    def test_extra_bytes_not_consumed(self):
+        """Test bytes after the end of the response are not claimed"""
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nokEXTRA"
+        framer = ResponseFramer()
+
+        assert framer.feed(response) == len(response) - 5
+        assert framer.complete
+
+    def test_chunked(self):
+        """Test chunked bodies complete after the last chunk and trailers"""
+        response = (
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"5;ext=1\r\nhello\r\n"
+            b"6\r\n world\r\n"
+            b"0\r\nX-Trailer: yes\r\n\r\n"
+        )
+        framer = ResponseFramer()
+
+        assert self.feed_bytewise(framer, response) == len(response)
+        assert framer.complete
+
+    def test_close_delimited(self):
+        """Test a body without framing runs until EOF and is not reusable"""
+        framer = ResponseFramer()
+        framer.feed(b"HTTP/1.1 200 OK\r\n\r\nsome body")
+
+        assert not framer.complete
+        assert not framer.keep_alive
+        assert framer.finish()
+
+    def test_truncated_response(self):
+        """Test EOF before Content-Length is reached is reported"""
+        framer = ResponseFramer()
+        framer.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort")
+
+        assert not framer.finish()
+
+    @pytest.mark.parametrize("method,status", [
+        ("HEAD", 200),
+        ("GET", 204),
+        ("GET", 304),
+    ])
+    def test_responses_without_body(self, method, status):
+        """Test HEAD, 204 and 304 responses end after the headers"""
+        framer = ResponseFramer(method)
+        framer.feed(
+            f"HTTP/1.1 {status} X\r\nContent-Length: 100\r\n\r\n".encode()
+        )
+
+        assert framer.complete
+
+    def test_interim_response_skipped(self):
+        """Test a 100 Continue is followed by the real response"""
+        framer = ResponseFramer()
+        framer.feed(b"HTTP/1.1 100 Continue\r\n\r\n")
+        assert not framer.complete
+
+        framer.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        assert framer.complete
+        assert framer.status == 200
+
+    def test_connection_close(self):
+        """Test Connection: close and HTTP/1.0 defaults disable reuse"""
+        closing = ResponseFramer()
+        closing.feed(
+            b"HTTP/1.1 200 OK\r\nConnection: close\r\n"
+            b"Content-Length: 0\r\n\r\n"
+        )
+        old = ResponseFramer()
+        old.feed(b"HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n")
+        old_keep_alive = ResponseFramer()
+        old_keep_alive.feed(
+            b"HTTP/1.0 200 OK\r\nConnection: keep-alive\r\n"
+            b"Content-Length: 0\r\n\r\n"
+        )
+
+        assert not closing.keep_alive
+        assert not old.keep_alive
+        assert old_keep_alive.keep_alive
+
+    def test_malformed_status_line(self):
+        """Test garbage instead of a status line is rejected"""
+        with pytest.raises(ValueError):
+            ResponseFramer().feed(b"garbage\r\n\r\n")
+
+    @pytest.mark.parametrize(
+        "head",
+        [
+            b"HTTP/1.1 2_00 OK\r\n\r\n",
+            b"HTTP/1.1 OK\r\n\r\n",
+            b"HTTP/1.1 200 OK\r\nContent-Length: 1_0\r\n\r\n",
+            b"HTTP/1.1 200 OK\r\nContent-Length: ten\r\n\r\n",
+        ],
+    )
+    def test_malformed_status_or_length(self, head):
+        """Test unparseable status codes and lengths are rejected"""
+        with pytest.raises(ValueError, match="malformed"):
+            ResponseFramer().feed(head)
+
+    @pytest.mark.parametrize("size", [b"-5", b"0x5", b"+5", b"1_0"])
+    def test_malformed_chunk_size(self, size):
+        """Test a chunk size that is not plain hex digits is rejected"""
+        framer = ResponseFramer()
+        framer.feed(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        with pytest.raises(ValueError, match="malformed chunk size"):
+            framer.feed(size + b"\r\nhello\r\n")
+
+    def test_framer_without_head_parsing_rejected(self):
+        """Test a message framer must say how to read its head"""
+
+        class NoHead(MessageFramer):
+            pass
+
+        with pytest.raises(TypeError):
+            NoHead()
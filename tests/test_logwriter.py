@@ -0,0 +1,65 @@
+import pytest
+import logging
+import os
+import sys
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from logwriter import BackgroundWriter, RingHandler
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    path = tmp_path / "out.log"
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    yield path, fd
+    os.close(fd)
+
+
+class TestBackgroundWriter:
+    """Test the batched background writer"""
+
+    def test_batch_written_in_order(self, log_file):
+        """Test submitted items are formatted and written in order"""
+        path, fd = log_file
+        writer = BackgroundWriter(fd, lambda item: f"line {item}\n")
+        for i in range(3):
+            writer.submit(i)
+        writer.close()
+
+        assert path.read_text() == "line 0\nline 1\nline 2\n"
+
+    def test_oldest_dropped_when_full(self, log_file):
+        """Test a full ring drops its oldest items instead of blocking"""
+        path, fd = log_file
+        writer = BackgroundWriter(
+            fd, lambda item: f"{item}\n", capacity=2, interval=60
+        )
+        for i in range(5):
+            writer.submit(i)
+        writer.close()
+
+        lines = path.read_text().splitlines()
+        assert lines[:2] == ["3", "4"]
+        assert lines[2].startswith("3 lines dropped")
+
+
+class TestRingHandler:
+    """Test the logging handler"""
+
+    def test_records_written(self, log_file):
+        """Test records are formatted and written by the handler's writer"""
+        path, fd = log_file
+        handler = RingHandler(fd)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger = logging.getLogger("test_logwriter")
+        logger.addHandler(handler)
+        logger.propagate = False
+        try:
+            logger.warning("Sent %d bytes", 10)
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        assert path.read_text() == "WARNING Sent 10 bytes\n"
@@ -0,0 +1,135 @@
+import pytest
+import socket
+import sys
+import os
+import urllib.error
+import urllib.request
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from admin import start_admin_server
+from cache import ResponseCache
+from datastructures import ProxyConfig, WorkerContext
+from metrics import MetricsRegion, WorkerMetrics
+from tests.conftest import free_port, running_worker
+from worker import publish_cache_stats
+
+
+@pytest.fixture
+def region():
+    metrics = MetricsRegion.create(2)
+    yield metrics
+    metrics.close()
+    metrics.unlink()
+
+
+def sample(text, series):
+    """Return the value of one sample line of a Prometheus exposition"""
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.rsplit(" ", 1)[1])
+    raise AssertionError(f"{series} not in metrics")
+
+
+class TestMetricsRegion:
+    """Test per-worker metrics blocks and their aggregate"""
+
+    def test_counters_summed_across_workers(self, region):
+        first, second = region.worker(0), region.worker(1)
+        first.add("proxy_requests_total", 3)
+        second.add("proxy_requests_total", 2)
+        first.add("proxy_active_connections", 2)
+        first.add("proxy_active_connections", -1)
+        second.set('proxy_cache_hits_total{tier="memory"}', 7)
+        first.release()
+        second.release()
+
+        text = region.render()
+        assert sample(text, "proxy_requests_total") == 5
+        assert sample(text, "proxy_active_connections") == 1
+        assert sample(text, 'proxy_cache_hits_total{tier="memory"}') == 7
+        assert "# TYPE proxy_active_connections gauge" in text
+
+    def test_histogram_buckets_are_cumulative(self, region):
+        metrics = region.worker(0)
+        metrics.observe("proxy_upstream_ttfb_seconds", 0.003)
+        metrics.observe("proxy_upstream_ttfb_seconds", 0.1)
+        metrics.observe("proxy_upstream_ttfb_seconds", 60)
+        metrics.release()
+
+        text = region.render()
+        name = "proxy_upstream_ttfb_seconds"
+        assert sample(text, f'{name}_bucket{{le="0.0025"}}') == 0
+        assert sample(text, f'{name}_bucket{{le="0.005"}}') == 1
+        assert sample(text, f'{name}_bucket{{le="0.1"}}') == 2
+        assert sample(text, f'{name}_bucket{{le="10.0"}}') == 2
+        assert sample(text, f'{name}_bucket{{le="+Inf"}}') == 3
+        assert sample(text, f"{name}_count") == 3
+        assert sample(text, f"{name}_sum") == pytest.approx(60.103)
+
+    def test_cache_totals_survive_respawn(self, region):
+        """Test a new worker in a used block adds to its cache counters"""
+        key = 'proxy_cache_hits_total{tier="memory"}'
+        # A worker publishing 4 then 6 hits, then its replacement 1
+        for hits in ([4, 6], [1]):
+            # Each worker process counts from 0 again
+            cache = ResponseCache(1024, 60)
+            ctx = WorkerContext(
+                ProxyConfig(), None, cache=cache, metrics=region.worker(0)
+            )
+            for count in hits:
+                cache.hits = count
+                publish_cache_stats(ctx)
+            ctx.metrics.release()
+        assert sample(region.render(), key) == 7
+
+    def test_private_metrics(self):
+        """Test a worker without a region still counts"""
+        metrics = WorkerMetrics()
+        metrics.add("proxy_requests_total")
+        assert sum(metrics.values()) == 1
+
+
+class TestAdminEndpoint:
+    """Test the master's metrics endpoint"""
+
+    def test_serves_metrics(self, region):
+        port = free_port()
+        server = start_admin_server("127.0.0.1", port, region)
+        try:
+            with urllib.request.urlopen(
+                f"http://127.0.0.1:{port}/metrics", timeout=5
+            ) as response:
+                content_type = response.headers["Content-Type"]
+                text = response.read().decode()
+            with pytest.raises(urllib.error.HTTPError) as missing:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=5)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert content_type.startswith("text/plain; version=0.0.4")
+        assert sample(text, "proxy_requests_total") == 0
+        assert missing.value.code == 404
+
+    @pytest.mark.timeout(10)
+    def test_worker_records_requests(self, region):
+        """Test a worker's traffic shows up in the region"""
+        with running_worker(metrics=region) as port:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+            response = sock.recv(65536)
+            # The worker closes only once the response is accounted for
+            assert sock.recv(1) == b""
+            sock.close()
+        text = region.render()
+
+        assert response.startswith(b"HTTP/1.1 400")
+        assert sample(text, "proxy_requests_total") == 1
+        # running_worker's readiness probe is the other connection
+        assert sample(text, "proxy_connections_total") == 2
+        assert sample(text, "proxy_error_responses_total") == 1
+        assert sample(
+            text, 'proxy_client_bytes_total{direction="sent"}'
+        ) == len(response)
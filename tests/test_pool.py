@@ -0,0 +1,112 @@
+import pytest
+import socket
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from pool import UpstreamPool
+
+ADDRESS = ("origin.test", 80)
+
+
+@pytest.fixture
+def pool():
+    upstream_pool = UpstreamPool(max_idle_per_host=2, idle_timeout=30)
+    yield upstream_pool
+    upstream_pool.close()
+
+
+@pytest.fixture
+def socket_pairs():
+    """Connected (pooled end, origin end) socket pairs"""
+    pairs = []
+
+    def make():
+        pooled, origin = socket.socketpair()
+        pooled.setblocking(False)
+        pairs.append((pooled, origin))
+        return pooled, origin
+
+    yield make
+    for pooled, origin in pairs:
+        pooled.close()
+        origin.close()
+
+
+class TestUpstreamPool:
+    """Test the per-worker pool of idle upstream connections"""
+
+    def test_release_and_acquire(self, pool, socket_pairs):
+        """Test a released connection is handed out again"""
+        sock, _ = socket_pairs()
+        pool.release(ADDRESS, sock, now=0)
+
+        assert pool.acquire(ADDRESS, now=1) is sock
+        assert pool.reused == 1
+        assert len(pool) == 0
+
+    def test_keyed_by_address(self, pool, socket_pairs):
+        """Test connections are only reused for the same host and port"""
+        sock, _ = socket_pairs()
+        pool.release(ADDRESS, sock, now=0)
+
+        assert pool.acquire(("other.test", 80), now=1) is None
+        assert pool.acquire(("origin.test", 8080), now=1) is None
+
+    def test_most_recent_first(self, pool, socket_pairs):
+        """Test the most recently released connection is reused first"""
+        older, _ = socket_pairs()
+        newer, _ = socket_pairs()
+        pool.release(ADDRESS, older, now=0)
+        pool.release(ADDRESS, newer, now=1)
+
+        assert pool.acquire(ADDRESS, now=2) is newer
+
+    def test_max_idle_per_host(self, pool, socket_pairs):
+        """Test the oldest idle connection is closed beyond the limit"""
+        socks = [socket_pairs()[0] for _ in range(3)]
+        for i, sock in enumerate(socks):
+            pool.release(ADDRESS, sock, now=i)
+
+        assert len(pool) == 2
+        assert socks[0].fileno() == -1
+
+    def test_closed_by_origin_is_discarded(self, pool, socket_pairs):
+        """Test a connection the origin has closed is never handed out"""
+        sock, origin = socket_pairs()
+        pool.release(ADDRESS, sock, now=0)
+        origin.close()
+
+        assert pool.acquire(ADDRESS, now=1) is None
+        assert pool.discarded == 1
+
+    def test_unsolicited_data_is_discarded(self, pool, socket_pairs):
+        """Test a connection with unexpected pending bytes is not reused"""
+        sock, origin = socket_pairs()
+        pool.release(ADDRESS, sock, now=0)
+        origin.sendall(b"HTTP/1.1 408 Request Timeout\r\n\r\n")
+
+        assert pool.acquire(ADDRESS, now=1) is None
+
+    def test_idle_timeout(self, pool, socket_pairs):
+        """Test connections idle past the timeout are pruned"""
+        stale, _ = socket_pairs()
+        fresh, _ = socket_pairs()
+        pool.release(ADDRESS, stale, now=0)
+        pool.release(ADDRESS, fresh, now=20)
+
+        pool.prune(now=35)
+        assert len(pool) == 1
+        assert stale.fileno() == -1
+        assert pool.acquire(ADDRESS, now=36) is fresh
+
+    def test_disabled_pool_closes(self, socket_pairs):
+        """Test max_idle_per_host=0 closes released connections"""
+        upstream_pool = UpstreamPool(max_idle_per_host=0, idle_timeout=30)
+        sock, _ = socket_pairs()
+        upstream_pool.release(ADDRESS, sock)
+
+        assert len(upstream_pool) == 0
+        assert sock.fileno() == -1
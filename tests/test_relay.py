@@ -0,0 +1,116 @@
+import pytest
+import socket
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from relay import (
+    BufferRelay,
+    Relay,
+    SpliceRelay,
+    SPLICE_AVAILABLE,
+    make_relay,
+)
+
+RELAYS = [BufferRelay]
+if SPLICE_AVAILABLE:
+    RELAYS.append(SpliceRelay)
+
+
+@pytest.fixture
+def sockets():
+    """Two non-blocking socket pairs: (src_writer, src), (dst, dst_reader)"""
+    src_writer, src = socket.socketpair()
+    dst, dst_reader = socket.socketpair()
+    for sock in (src, dst):
+        sock.setblocking(False)
+    yield src_writer, src, dst, dst_reader
+    for sock in (src_writer, src, dst, dst_reader):
+        sock.close()
+
+
+@pytest.mark.parametrize("relay_class", RELAYS)
+class TestRelays:
+    """Test relays move bytes between sockets"""
+
+    def test_fill_and_drain(self, relay_class, sockets):
+        """Test bytes read from the source arrive at the destination"""
+        src_writer, src, dst, dst_reader = sockets
+        relay = relay_class()
+        src_writer.sendall(b"hello tunnel")
+
+        assert relay.fill(src) is True
+        assert relay.pending == 12
+        assert relay.drain(dst) == 12
+        assert relay.pending == 0
+        assert dst_reader.recv(100) == b"hello tunnel"
+        relay.close()
+
+    def test_fill_without_data(self, relay_class, sockets):
+        """Test filling from an idle source is not treated as EOF"""
+        _, src, _, _ = sockets
+        relay = relay_class()
+
+        assert relay.fill(src) is True
+        assert relay.pending == 0
+        relay.close()
+
+    def test_fill_reports_eof(self, relay_class, sockets):
+        """Test a closed source is reported as EOF"""
+        src_writer, src, _, _ = sockets
+        relay = relay_class()
+        src_writer.shutdown(socket.SHUT_WR)
+
+        assert relay.fill(src) is False
+        relay.close()
+
+    def test_feed_is_delivered_first(self, relay_class, sockets):
+        """Test proxy-generated bytes precede relayed bytes"""
+        src_writer, src, dst, dst_reader = sockets
+        relay = relay_class()
+        relay.feed(b"HTTP/1.1 200 OK\r\n\r\n")
+        src_writer.sendall(b"payload")
+        relay.fill(src)
+        relay.drain(dst)
+
+        assert dst_reader.recv(100) == b"HTTP/1.1 200 OK\r\n\r\npayload"
+        relay.close()
+
+    def test_full_relay_stops_reading(self, relay_class, sockets):
+        """Test a relay never holds more than its capacity"""
+        src_writer, src, _, _ = sockets
+        relay = relay_class(capacity=4096)
+        src_writer.sendall(b"x" * 16384)
+
+        for _ in range(8):
+            relay.fill(src)
+        assert relay.full
+        assert relay.pending == relay.capacity
+        relay.close()
+
+
+class TestMakeRelay:
+    """Test relay selection"""
+
+    def test_buffer_mode(self):
+        relay = make_relay("buffer")
+        assert isinstance(relay, BufferRelay)
+        relay.close()
+
+    @pytest.mark.skipif(not SPLICE_AVAILABLE, reason="splice(2) not available")
+    def test_splice_mode(self):
+        relay = make_relay("splice")
+        assert isinstance(relay, SpliceRelay)
+        relay.close()
+
+    def test_incomplete_relay_rejected(self):
+        """Test a relay missing a method fails when it is created"""
+
+        class FillOnly(Relay):
+            def fill(self, src):
+                return True
+
+        with pytest.raises(TypeError):
+            FillOnly()
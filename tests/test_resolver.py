@@ -0,0 +1,131 @@
+import pytest
+import select
+import socket
+import sys
+import os
+import threading
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import resolver as resolver_module
+from resolver import DNSResolver
+
+
+class FakeGetaddrinfo:
+    """Stand-in for socket.getaddrinfo that counts lookups"""
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, host, port, family=0, type=0, *args):
+        self.calls.append(host)
+        self.release.wait(5)
+        answer = self.answers.get(host)
+        if isinstance(answer, OSError):
+            raise answer
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (answer, 0))]
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    fake = FakeGetaddrinfo({
+        "origin.test": "10.0.0.1",
+        "missing.test": socket.gaierror(socket.EAI_NONAME, "not known"),
+        "flaky.test": socket.gaierror(socket.EAI_AGAIN, "try again"),
+    })
+    monkeypatch.setattr(resolver_module.socket, "getaddrinfo", fake)
+    return fake
+
+
+@pytest.fixture
+def resolver():
+    dns = DNSResolver(ttl=60)
+    yield dns
+    dns.close()
+
+
+def resolve(dns, host, count=1):
+    """Resolve host as the event loop would, returning the callback results"""
+    results = []
+    for _ in range(count):
+        dns.resolve(host, lambda a, e: results.append((a, e)))
+    while len(results) < count:
+        readable, _, _ = select.select([dns.wakeup_socket], [], [], 5)
+        assert readable, "resolver never woke the loop"
+        dns.process_completions()
+    return results
+
+
+class TestDNSResolver:
+    """Test the per-worker DNS cache"""
+
+    def test_resolves_in_background(self, resolver, lookups):
+        """Test a miss is resolved by a thread and wakes the loop"""
+        results = []
+        resolver.resolve("origin.test", lambda a, e: results.append((a, e)))
+        assert results == []
+
+        assert resolve(resolver, "origin.test") == [("10.0.0.1", None)]
+        assert results == [("10.0.0.1", None)]
+
+    def test_hit_is_answered_immediately(self, resolver, lookups):
+        """Test a cached name calls back without another lookup"""
+        resolve(resolver, "origin.test")
+
+        results = []
+        resolver.resolve("origin.test", lambda a, e: results.append((a, e)))
+        assert results == [("10.0.0.1", None)]
+        assert lookups.calls == ["origin.test"]
+        assert resolver.hits == 1
+
+    def test_entry_expires_after_ttl(self, lookups):
+        """Test a name is looked up again once its TTL has passed"""
+        dns = DNSResolver(ttl=0)
+        try:
+            resolve(dns, "origin.test")
+            resolve(dns, "origin.test")
+        finally:
+            dns.close()
+        assert lookups.calls == ["origin.test", "origin.test"]
+
+    def test_concurrent_requests_share_lookup(self, resolver, lookups):
+        """Test callers waiting on the same name share one lookup"""
+        lookups.release.clear()
+        results = []
+        for _ in range(3):
+            resolver.resolve(
+                "origin.test", lambda a, e: results.append((a, e))
+            )
+        lookups.release.set()
+
+        resolve(resolver, "origin.test")
+        assert results == [("10.0.0.1", None)] * 3
+        assert lookups.calls == ["origin.test"]
+
+    def test_nonexistent_name_is_cached(self, resolver, lookups):
+        """Test NXDOMAIN is remembered and reported without a lookup"""
+        [(address, error)] = resolve(resolver, "missing.test")
+        assert address is None
+        assert isinstance(error, socket.gaierror)
+
+        [(address, error)] = resolve(resolver, "missing.test")
+        assert address is None
+        assert error.errno == socket.EAI_NONAME
+        assert lookups.calls == ["missing.test"]
+
+    def test_temporary_failure_is_not_cached(self, resolver, lookups):
+        """Test a transient resolver error is retried on the next request"""
+        resolve(resolver, "flaky.test")
+        resolve(resolver, "flaky.test")
+        assert lookups.calls == ["flaky.test", "flaky.test"]
+
+    def test_ip_literal_skips_lookup(self, resolver, lookups):
+        """Test an IPv4 address is passed through unresolved"""
+        results = []
+        resolver.resolve("127.0.0.1", lambda a, e: results.append((a, e)))
+        assert results == [("127.0.0.1", None)]
+        assert lookups.calls == []
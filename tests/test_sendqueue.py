@@ -0,0 +1,94 @@
+import pytest
+import socket
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from sendqueue import SendQueue, MAX_IOVECS
+
+
+@pytest.fixture
+def pair():
+    """A non-blocking socket and the peer that reads from it"""
+    writer, reader = socket.socketpair()
+    writer.setblocking(False)
+    yield writer, reader
+    writer.close()
+    reader.close()
+
+
+def read_exactly(sock: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+class TestSendQueue:
+    """Test queued chunks go out in order without being copied"""
+
+    def test_empty(self):
+        """Test a new queue is empty and empty chunks are skipped"""
+        queue = SendQueue()
+        queue.append(b"")
+        assert len(queue) == 0
+        assert not queue
+
+    def test_initial_data(self, pair):
+        """Test data given to the constructor is queued"""
+        writer, reader = pair
+        queue = SendQueue(b"hello")
+        assert len(queue) == 5
+        assert queue.send(writer) == 5
+        assert not queue
+        assert read_exactly(reader, 5) == b"hello"
+
+    def test_chunks_sent_together(self, pair):
+        """Test several chunks go out in order in one call"""
+        writer, reader = pair
+        queue = SendQueue(b"head\r\n\r\n")
+        queue.append(memoryview(b"xbody")[1:])
+        queue.append(bytearray(b"!"))
+        assert len(queue) == 13
+        assert queue.send(writer) == 13
+        assert read_exactly(reader, 13) == b"head\r\n\r\nbody!"
+
+    def test_more_chunks_than_iovecs(self, pair):
+        """Test chunks beyond MAX_IOVECS wait for the next send"""
+        writer, reader = pair
+        queue = SendQueue()
+        for i in range(MAX_IOVECS + 10):
+            queue.append(b"%d," % i)
+        expected = b"".join(b"%d," % i for i in range(MAX_IOVECS + 10))
+        total = 0
+        while queue:
+            total += queue.send(writer)
+        assert total == len(expected)
+        assert read_exactly(reader, total) == expected
+
+    def test_partial_send_keeps_remainder(self, pair):
+        """Test a chunk the socket only partly took is finished later"""
+        writer, reader = pair
+        writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        body = bytes(range(256)) * 4096
+        queue = SendQueue(b"head")
+        queue.append(body)
+        first = queue.send(writer)
+        assert 0 < first < len(body)
+        assert len(queue) == len(body) + 4 - first
+        with pytest.raises(BlockingIOError):
+            queue.send(writer)
+
+        received = read_exactly(reader, first)
+        while queue:
+            try:
+                queue.send(writer)
+            except BlockingIOError:
+                pass
+            received += reader.recv(65536)
+        received += read_exactly(reader, len(body) + 4 - len(received))
+        assert received == b"head" + body
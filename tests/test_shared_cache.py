@@ -0,0 +1,192 @@
+import pytest
+import multiprocessing
+import signal
+import sys
+import os
+import time
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from shared_cache import (
+    HOLDER,
+    HOLDER_OFFSET,
+    TAKEOVER_AFTER,
+    SharedResponseCache,
+    _key_hash,
+)
+
+
+@pytest.fixture
+def shared_cache():
+    cache = SharedResponseCache.create(
+        size=1024 * 1024, ttl=60, max_object_size=1024 * 1024, stripes=4
+    )
+    yield cache
+    cache.close()
+    cache.unlink()
+
+
+def store_in_child(cache, key, response):
+    cache.put(key, response)
+
+
+def die_holding_lock(cache, key):
+    with cache._locked(_key_hash(key)):
+        os.kill(os.getpid(), signal.SIGKILL)
+
+
+def hold_lock(cache, key, held, release):
+    with cache._locked(_key_hash(key)):
+        held.set()
+        release.wait(10)
+
+
+class TestSharedResponseCache:
+    """Test the cross-worker shared memory cache"""
+
+    def test_put_and_get(self, shared_cache):
+        """Test a stored response is returned"""
+        assert shared_cache.put("GET http://a/", b"response", now=0)
+
+        assert shared_cache.get("GET http://a/", now=1) == b"response"
+        assert shared_cache.hits == 1
+
+    def test_miss(self, shared_cache):
+        """Test a missing key returns None"""
+        assert shared_cache.get("GET http://missing/") is None
+        assert shared_cache.misses == 1
+
+    def test_ttl_expiry(self, shared_cache):
+        """Test entries expire after ttl seconds"""
+        shared_cache.put("GET http://a/", b"response", now=0)
+
+        assert shared_cache.get("GET http://a/", now=60) is None
+
+    def test_expired_entry_kept_for_grace_period(self):
+        """Test an expired entry stays available to get_stale for a while"""
+        cache = SharedResponseCache.create(
+            size=1024 * 1024, ttl=60, max_object_size=1024, grace=30
+        )
+        try:
+            cache.put("GET http://a/", b"response", now=0)
+
+            assert cache.get_stale("GET http://a/", now=59) is None
+            assert cache.get("GET http://a/", now=70) is None
+            assert cache.get_stale("GET http://a/", now=70) == (
+                b"response", 10
+            )
+            assert cache.get_stale("GET http://a/", now=90) is None
+            assert cache.get_stale("GET http://a/", now=70) is None
+        finally:
+            cache.close()
+            cache.unlink()
+
+    def test_put_with_own_ttl(self, shared_cache):
+        """Test a per-response ttl overrides the cache's"""
+        shared_cache.put("GET http://a/", b"response", now=0, ttl=600)
+
+        assert shared_cache.get("GET http://a/", now=300) == b"response"
+        assert shared_cache.get("GET http://a/", now=600) is None
+
+    def test_replace(self, shared_cache):
+        """Test storing an existing key replaces its response"""
+        shared_cache.put("GET http://a/", b"old", now=0)
+        shared_cache.put("GET http://a/", b"new", now=0)
+
+        assert shared_cache.get("GET http://a/", now=1) == b"new"
+
+    def test_remove(self, shared_cache):
+        """Test removed keys are no longer returned"""
+        shared_cache.put("GET http://a/", b"response")
+        shared_cache.remove("GET http://a/")
+
+        assert shared_cache.get("GET http://a/") is None
+
+    def test_oversized_object_rejected(self, shared_cache):
+        """Test objects larger than a quarter stripe ring are not stored"""
+        assert not shared_cache.put("big", b"x" * shared_cache.data_size)
+
+    def test_ring_wrap_invalidates_old_records(self, shared_cache):
+        """Test overwritten records are never returned"""
+        value = b"x" * (shared_cache.max_object_size - 64)
+        keys = [f"GET http://a/{i}" for i in range(64)]
+        for key in keys:
+            shared_cache.put(key, value, now=0)
+
+        found = [key for key in keys if shared_cache.get(key, now=1)]
+        # Only roughly the last ring's worth of each stripe survives
+        assert 0 < len(found) < len(keys)
+        assert keys[-1] in found
+        for key in found:
+            assert shared_cache.get(key, now=1) == value
+
+    def test_visible_across_processes(self, shared_cache):
+        """Test an entry stored by another process is visible here"""
+        child = multiprocessing.Process(
+            target=store_in_child,
+            args=(shared_cache, "GET http://shared/", b"from child"),
+        )
+        child.start()
+        child.join(timeout=10)
+
+        assert shared_cache.get("GET http://shared/") == b"from child"
+
+    def test_lock_of_killed_holder_taken_over(self, shared_cache):
+        """Test a stripe stays usable after its lock holder was killed"""
+        key = "GET http://killed/"
+        shared_cache.put(key, b"before")
+        child = multiprocessing.Process(
+            target=die_holding_lock, args=(shared_cache, key)
+        )
+        child.start()
+        child.join(timeout=10)
+        assert child.exitcode == -signal.SIGKILL
+
+        # Misses until enough attempts failed to check on the holder
+        lookups = [shared_cache.get(key) for _ in range(TAKEOVER_AFTER)]
+        assert lookups == [None] * (TAKEOVER_AFTER - 1) + [b"before"]
+        assert shared_cache.put(key, b"after")
+        assert shared_cache.get(key) == b"after"
+
+    def test_busy_stripe_is_a_miss(self, shared_cache):
+        """Test a lock held by a live process is a miss, without waiting"""
+        key = "GET http://busy/"
+        shared_cache.put(key, b"response")
+        held, release = multiprocessing.Event(), multiprocessing.Event()
+        child = multiprocessing.Process(
+            target=hold_lock, args=(shared_cache, key, held, release)
+        )
+        child.start()
+        try:
+            assert held.wait(10)
+            started = time.monotonic()
+            for _ in range(TAKEOVER_AFTER * 2):
+                assert shared_cache.get(key) is None
+                assert not shared_cache.put(key, b"other")
+            assert time.monotonic() - started < 0.5
+        finally:
+            release.set()
+            child.join(timeout=10)
+        assert shared_cache.get(key) == b"response"
+
+    def test_holder_cleared_on_release(self, shared_cache):
+        """Test a stripe records its holder only while the lock is held"""
+        key = "GET http://holder/"
+        key_hash = _key_hash(key)
+        stripe = key_hash % shared_cache.stripes
+        offset = stripe * shared_cache.stripe_size + HOLDER_OFFSET
+
+        def holder():
+            return HOLDER.unpack_from(shared_cache._shm.buf, offset)[0]
+
+        with shared_cache._locked(key_hash):
+            assert holder() == os.getpid()
+        assert holder() == 0
+
+    def test_too_small(self):
+        """Test a segment too small for the index is rejected"""
+        with pytest.raises(ValueError, match="too small"):
+            SharedResponseCache.create(
+                size=1024, ttl=60, max_object_size=1024
+            )
@@ -0,0 +1,198 @@
+import pytest
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from metrics import MetricsRegion
+from supervisor import (
+    Supervisor,
+    create_shared_cache,
+    load_config,
+    read_env_file,
+)
+from tests.conftest import free_port
+from tests.test_worker import fetch, get_request, origin  # noqa: F401
+from tests.test_worker import read_response
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    """Write settings to a CONFIG_FILE; returns the writing function"""
+    path = tmp_path / "proxy.env"
+    port = free_port()
+
+    def write(**settings):
+        settings = {"LISTEN_PORT": port, "NUM_WORKERS": 2, **settings}
+        path.write_text(
+            "".join(f"{key}={value}\n" for key, value in settings.items())
+        )
+        return port
+
+    monkeypatch.setenv("CONFIG_FILE", str(path))
+    return write
+
+
+@pytest.fixture
+def supervisor():
+    """Run a Supervisor on the config in CONFIG_FILE in a thread"""
+    running = []
+
+    def start():
+        config = load_config()
+        metrics = MetricsRegion.create(config.num_workers * 2)
+        supervisor = Supervisor(config, metrics, create_shared_cache(config))
+        supervisor.start()
+        thread = threading.Thread(target=supervisor.run, daemon=True)
+        thread.start()
+        running.append((supervisor, thread, metrics))
+        for worker_process in supervisor.workers.values():
+            assert worker_process.ready.wait(10)
+        return supervisor
+
+    yield start
+    for supervisor, thread, metrics in running:
+        supervisor.stopping = True
+        thread.join()
+        supervisor.stop()
+        metrics.close()
+        metrics.unlink()
+
+
+class TestConfigFile:
+    """Test settings are read from CONFIG_FILE"""
+
+    def test_read_env_file(self, tmp_path):
+        """Test KEY=VALUE lines are read, comments and blanks skipped"""
+        path = tmp_path / "proxy.env"
+        path.write_text("# cache\nCACHE_TTL = 60\n\nENGINE=asyncio\n")
+        assert read_env_file(str(path)) == {
+            "CACHE_TTL": "60",
+            "ENGINE": "asyncio",
+        }
+
+    def test_malformed_line(self, tmp_path):
+        """Test a line without = is reported with its number"""
+        path = tmp_path / "proxy.env"
+        path.write_text("CACHE_TTL=60\nnonsense\n")
+        with pytest.raises(ValueError, match="proxy.env:2"):
+            read_env_file(str(path))
+
+    def test_file_overrides_environment(self, config_file, monkeypatch):
+        """Test CONFIG_FILE settings win over the environment"""
+        monkeypatch.setenv("CACHE_TTL", "10")
+        monkeypatch.setenv("DNS_CACHE_TTL", "20")
+        config_file(CACHE_TTL=60)
+        config = load_config()
+        assert config.cache_ttl == 60
+        assert config.dns_cache_ttl == 20
+
+
+class TestSupervisor:
+    """Test the master keeps its workers running and replaces them"""
+
+    @pytest.mark.timeout(20)
+    def test_dead_worker_respawned(self, config_file, supervisor, origin):
+        """Test a killed worker is replaced in its slot"""
+        port = config_file()
+        sup = supervisor()
+        killed = sup.workers[0].process.pid
+        os.kill(killed, signal.SIGKILL)
+
+        wait_until(
+            lambda: 0 in sup.workers
+            and sup.workers[0].process.pid != killed
+            and sup.workers[0].ready.is_set()
+        )
+        assert sup.failures[0] == 1
+        response = fetch(port, origin, "/supervise/size/10")
+        assert response.startswith(b"HTTP/1.1 200")
+
+    @pytest.mark.timeout(30)
+    @pytest.mark.parametrize("engine", ["selectors", "asyncio"])
+    def test_reload_drains_old_workers(
+        self, config_file, supervisor, origin, engine  # noqa: F811
+    ):
+        """Test a reload finishes requests in flight on the old workers"""
+        port = config_file(ENGINE=engine)
+        sup = supervisor()
+        old = [w.process for w in sup.workers.values()]
+        old_cache = sup.shared_cache
+
+        idle = socket.create_connection(("127.0.0.1", port), timeout=5)
+        idle.sendall(get_request(origin, "/reload/size/10"))
+        assert read_response(idle)[0].startswith(b"HTTP/1.1 200")
+        busy = socket.create_connection(("127.0.0.1", port), timeout=5)
+        busy.sendall(get_request(origin, "/reload/slow"))
+        time.sleep(0.5)
+
+        config_file(ENGINE=engine, CACHE_TTL=0)
+        sup.request_reload()
+        wait_until(lambda: sup.generation == 1)
+        assert sup.config.cache_ttl == 0
+        # Served by the new workers while the old ones drain
+        response = fetch(port, origin, "/reload/size/20")
+        assert response.startswith(b"HTTP/1.1 200")
+
+        response, _ = read_response(busy)
+        assert response.startswith(b"HTTP/1.1 200")
+        assert busy.recv(1) == b""
+        assert idle.recv(1) == b""
+        busy.close()
+        idle.close()
+
+        wait_until(lambda: not sup.draining)
+        assert not any(process.is_alive() for process in old)
+        assert all(process.exitcode == 0 for process in old)
+        # The old cache segment went with the workers using it
+        assert sup.shared_cache is not old_cache
+        assert sup.retired_caches == []
+
+    @pytest.mark.timeout(20)
+    def test_invalid_reload_keeps_workers(self, config_file, supervisor):
+        """Test a reload with a broken config leaves the workers alone"""
+        config_file()
+        sup = supervisor()
+        pids = {w.process.pid for w in sup.workers.values()}
+
+        config_file(CACHE_BACKEND="redis")
+        sup.request_reload()
+        wait_until(lambda: not sup.reload_requested)
+        time.sleep(0.2)
+        assert sup.generation == 0
+        assert {w.process.pid for w in sup.workers.values()} == pids
+
+    @pytest.mark.timeout(20)
+    def test_unallocatable_cache_keeps_workers(self, config_file, supervisor):
+        """Test a reload whose shared cache cannot be created is skipped"""
+        config_file()
+        sup = supervisor()
+        pids = {w.process.pid for w in sup.workers.values()}
+        old_cache = sup.shared_cache
+
+        # Valid settings, but too small to lay out a shared segment
+        config_file(CACHE_SIZE=1000)
+        sup.request_reload()
+        wait_until(lambda: not sup.reload_requested)
+        time.sleep(0.2)
+        assert sup.generation == 0
+        assert sup.config.cache_size != 1000
+        assert sup.shared_cache is old_cache
+        assert {w.process.pid for w in sup.workers.values()} == pids
+
+        # The master is still supervising: a good reload goes through
+        config_file(CACHE_TTL=5)
+        sup.request_reload()
+        wait_until(lambda: sup.generation == 1)
@@ -0,0 +1,97 @@
+import sys
+import os
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from timers import COMPACT_MIN, Timer, TimerHeap
+
+
+class TestTimerHeap:
+    """Test timers fire once their deadline has passed"""
+
+    def test_fires_in_deadline_order(self):
+        """Test due timers fire earliest first, the rest wait"""
+        heap = TimerHeap()
+        fired = []
+        for name, deadline in (("b", 2.0), ("a", 1.0), ("c", 3.0)):
+            heap.arm(Timer(lambda name=name: fired.append(name)), deadline)
+
+        assert heap.timeout(0.5) == 0.5
+        assert heap.run(2.0) == 2
+        assert fired == ["a", "b"]
+        assert heap.timeout(2.5) == 0.5
+        assert heap.run(5.0) == 1
+        assert fired == ["a", "b", "c"]
+        assert heap.timeout(5.0) is None
+
+    def test_cancelled_timer_does_not_fire(self):
+        """Test a cancelled timer is dropped and can be armed again"""
+        heap = TimerHeap()
+        fired = []
+        timer = Timer(lambda: fired.append(1))
+        heap.arm(timer, 1.0)
+        heap.cancel(timer)
+        assert not timer.armed
+        assert len(heap) == 0
+        assert heap.timeout(0.0) is None
+        assert heap.run(2.0) == 0
+
+        heap.arm(timer, 3.0)
+        assert heap.run(3.0) == 1
+        assert fired == [1]
+        assert not timer.armed
+
+    def test_pushed_back_deadline(self):
+        """Test a later deadline is honoured without firing early"""
+        heap = TimerHeap()
+        fired = []
+        timer = Timer(lambda: fired.append(1))
+        heap.arm(timer, 1.0)
+        heap.arm(timer, 5.0)
+        assert heap.run(1.0) == 0
+        assert heap.timeout(1.0) == 4.0
+        assert heap.run(5.0) == 1
+        assert fired == [1]
+
+    def test_brought_forward_deadline(self):
+        """Test an earlier deadline fires at the earlier time, once"""
+        heap = TimerHeap()
+        fired = []
+        timer = Timer(lambda: fired.append(1))
+        heap.arm(timer, 5.0)
+        heap.arm(timer, 1.0)
+        assert heap.timeout(0.0) == 1.0
+        assert heap.run(1.0) == 1
+        assert heap.run(10.0) == 0
+        assert fired == [1]
+        assert len(heap) == 0
+
+    def test_rearm_from_callback(self):
+        """Test a callback can arm its own timer again"""
+        heap = TimerHeap()
+        fired = []
+
+        def tick():
+            fired.append(len(fired))
+            if len(fired) < 3:
+                heap.arm(timer, len(fired) + 1.0)
+
+        timer = Timer(tick)
+        heap.arm(timer, 1.0)
+        for now in (1.0, 2.0, 3.0, 4.0):
+            heap.run(now)
+        assert fired == [0, 1, 2]
+
+    def test_cancelled_entries_compacted(self):
+        """Test cancelled entries do not pile up in the heap"""
+        heap = TimerHeap()
+        keep = Timer(lambda: None)
+        heap.arm(keep, 1000.0)
+        for i in range(COMPACT_MIN * 4):
+            timer = Timer(lambda: None)
+            heap.arm(timer, float(i))
+            heap.cancel(timer)
+        assert len(heap) == 1
+        assert len(heap._heap) <= COMPACT_MIN * 2
+        assert heap.timeout(0.0) == 1000.0
@@ -1,4 +1,7 @@
 import pytest
+import socket
+import threading
+import time
 import sys
 import os
 
@@ -6,6 +9,7 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
 
 from tunnel import parse_host_port
+from tests.conftest import free_port, running_worker
 
 
 class TestHostPortParsing:
@@ -55,3 +59,123 @@ class TestHostPortParsing:
         assert hostname == "localhost"
         assert port == 80
 
+
+
+def echo_until_eof(client):
+    """Echo everything back, then close once the peer half-closes"""
+    with client:
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            client.sendall(data)
+
+
+@pytest.fixture(scope="module")
+def echo_port():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+
+    def serve():
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=echo_until_eof, args=(client,), daemon=True
+            ).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield server.getsockname()[1]
+    server.close()
+
+
+def open_connect(proxy_port, target_port):
+    """Open a CONNECT tunnel through the proxy and return the socket"""
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+    sock.sendall(
+        f"CONNECT 127.0.0.1:{target_port} HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{target_port}\r\n\r\n".encode()
+    )
+    response = b""
+    while b"\r\n\r\n" not in response:
+        data = sock.recv(4096)
+        if not data:
+            break
+        response += data
+    return sock, response
+
+
+def recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return b"".join(chunks)
+        chunks.append(data)
+
+
+class TestEventLoopTunnel:
+    """Test CONNECT tunnels relayed by the worker's selector"""
+
+    engine = "selectors"
+
+    @pytest.mark.timeout(10)
+    def test_tunnel_established_and_relays(self, proxy_port, echo_port):
+        """Test the tunnel answers 200 and relays both directions"""
+        sock, response = open_connect(proxy_port, echo_port)
+        assert response == b"HTTP/1.1 200 Connection Established\r\n\r\n"
+        sock.sendall(b"ping")
+        assert sock.recv(4) == b"ping"
+        sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_half_close_delivers_all_data(self, proxy_port, echo_port):
+        """Test client EOF is propagated after buffered data drains"""
+        sock, _ = open_connect(proxy_port, echo_port)
+        payload = os.urandom(2 * 1024 * 1024)
+        sender = threading.Thread(
+            target=lambda: (
+                sock.sendall(payload),
+                sock.shutdown(socket.SHUT_WR),
+            )
+        )
+        sender.start()
+        echoed = recv_all(sock)
+        sender.join()
+        sock.close()
+        assert echoed == payload
+
+    @pytest.mark.timeout(10)
+    def test_concurrent_tunnels(self, proxy_port, echo_port):
+        """Test many tunnels are open at once on a single worker"""
+        tunnels = [open_connect(proxy_port, echo_port)[0] for _ in range(50)]
+        for i, sock in enumerate(tunnels):
+            sock.sendall(f"tunnel-{i}".encode())
+        for i, sock in enumerate(tunnels):
+            expected = f"tunnel-{i}".encode()
+            assert sock.recv(len(expected)) == expected
+            sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_refused_target_returns_502(self, proxy_port):
+        """Test a refused CONNECT target is reported as 502"""
+        sock, response = open_connect(proxy_port, free_port())
+        sock.close()
+        assert response.startswith(b"HTTP/1.1 502 Bad Gateway")
+
+    @pytest.mark.timeout(10)
+    def test_idle_tunnel_closed(self, echo_port):
+        """Test a tunnel without traffic is closed after its timeout"""
+        with running_worker(
+            engine=self.engine, tunnel_idle_timeout=1
+        ) as port:
+            sock, _ = open_connect(port, echo_port)
+            sock.sendall(b"ping")
+            assert sock.recv(4) == b"ping"
+            started = time.monotonic()
+            assert sock.recv(1) == b""
+            assert time.monotonic() - started >= 0.9
+            sock.close()
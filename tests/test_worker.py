@@ -0,0 +1,895 @@
+import pytest
+import selectors
+import socket
+import struct
+import threading
+import time
+import sys
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add src to path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from datastructures import Connection, ConnectionState, ProxyConfig
+from http_parser import ResponseFramer
+from tests.conftest import free_port, running_worker
+from worker import collect_response, create_context, join_collapsed
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """
+    Local origin: /slow sleeps before answering, /size/N returns N bytes,
+    /chunked/N returns N bytes in 1000-byte chunks, /trickle/N returns N
+    bytes in four parts a little apart, /etag/N returns N bytes with an
+    ETag and honours If-None-Match, /flaky/ fails after its first request,
+    /max-age/N, /no-store/ and /vary/ send those Cache-Control and Vary
+    headers (/vary/ echoes the request's Accept-Language), /malformed/
+    sends a response whose status line or Content-Length (the last path
+    segment) cannot be parsed
+    """
+
+    protocol_version = "HTTP/1.1"
+    requests_seen = {}
+    # Proxy-side (host, port) of every request, to observe reuse
+    peers_seen = {}
+    # If-None-Match of every request, to observe revalidation
+    validators_seen = {}
+
+    def do_GET(self):
+        path = self.path.split("://", 1)[-1].split("/", 1)[-1]
+        OriginHandler.peers_seen[path] = self.client_address
+        OriginHandler.requests_seen[path] = (
+            OriginHandler.requests_seen.get(path, 0) + 1
+        )
+        OriginHandler.validators_seen.setdefault(path, []).append(
+            self.headers.get("If-None-Match")
+        )
+        if self.path.endswith("/slow"):
+            time.sleep(2)
+        if "/etag/" in self.path:
+            self.send_etag(int(self.path.rsplit("/", 1)[1]))
+            return
+        if "/flaky/" in self.path and OriginHandler.requests_seen[path] > 1:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if "/chunked/" in self.path:
+            self.send_chunked(int(self.path.rsplit("/", 1)[1]))
+            return
+        if "/trickle/" in self.path:
+            self.send_trickle(int(self.path.rsplit("/", 1)[1]))
+            return
+        if "/malformed/" in self.path:
+            self.send_malformed(self.path.rsplit("/", 1)[1])
+            return
+        body = b"hello from origin"
+        if "/size/" in self.path:
+            body = b"x" * int(self.path.rsplit("/", 1)[1])
+        if "/vary/" in self.path:
+            body = self.headers.get("Accept-Language", "none").encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if "/max-age/" in self.path:
+            max_age = self.path.rsplit("/", 1)[1]
+            self.send_header("Cache-Control", f"max-age={max_age}")
+        if "/no-store/" in self.path:
+            self.send_header("Cache-Control", "no-store")
+        if "/vary/" in self.path:
+            self.send_header("Vary", "Accept-Language")
+        self.end_headers()
+        self.wfile.write(body)
+        if "/drop/" in self.path:
+            # Hang up without announcing it, like an idle timeout
+            self.close_connection = True
+
+    def send_chunked(self, size):
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, size, 1000):
+            chunk = b"y" * min(1000, size - start)
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_etag(self, size):
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(b"e" * size)
+
+    def send_trickle(self, size):
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.flush()
+        part = size // 4
+        for start in range(0, size, part):
+            time.sleep(0.2)
+            self.wfile.write(b"z" * min(part, size - start))
+            self.wfile.flush()
+
+    def send_malformed(self, part):
+        status, length = "200", "5"
+        if part == "status":
+            status = "2xx"
+        else:
+            length = "five"
+        self.wfile.write(
+            f"HTTP/1.1 {status} OK\r\nContent-Length: {length}\r\n\r\n"
+            "hello".encode()
+        )
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(proxy_port, origin_port, path, host="127.0.0.1", extra=""):
+    """Send a proxied GET and return the raw response bytes"""
+    sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=10)
+    sock.sendall(
+        f"GET http://{host}:{origin_port}{path} HTTP/1.1\r\n"
+        f"Host: {host}:{origin_port}\r\n{extra}"
+        "Connection: close\r\n\r\n".encode()
+    )
+    response = b""
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        response += data
+    sock.close()
+    return response
+
+
+def get_request(origin_port, path, extra=""):
+    return (
+        f"GET http://127.0.0.1:{origin_port}{path} HTTP/1.1\r\n"
+        f"Host: 127.0.0.1:{origin_port}\r\n{extra}\r\n"
+    ).encode()
+
+
+def read_response(sock, buffered=b""):
+    """Read one framed response; return (response, bytes read past it)"""
+    framer = ResponseFramer()
+    response = b""
+    data = buffered
+    while True:
+        used = framer.feed(data)
+        response += data[:used]
+        if framer.complete:
+            return response, data[used:]
+        data = sock.recv(65536)
+        assert data, "connection closed mid-response"
+
+
+class TestUpstreamProxying:
+    """Test the non-blocking upstream path of a single worker"""
+
+    @pytest.mark.timeout(10)
+    def test_simple_get(self, proxy_port, origin):
+        """Test a proxied GET returns the origin's response"""
+        response = fetch(proxy_port, origin, "/")
+        assert response.startswith(b"HTTP/1.1 200")
+        assert response.endswith(b"hello from origin")
+
+    @pytest.mark.timeout(10)
+    def test_large_body_not_truncated(self, proxy_port, origin):
+        """Test bodies spanning many reads are forwarded completely"""
+        response = fetch(proxy_port, origin, "/size/1000000")
+        head, _, body = response.partition(b"\r\n\r\n")
+        assert len(body) == 1000000
+
+    @pytest.mark.timeout(10)
+    @pytest.mark.parametrize("part", ["status", "length"])
+    def test_malformed_response_is_bad_gateway(
+        self, proxy_port, origin, part
+    ):
+        """Test an unparseable origin response head is answered with 502"""
+        response = fetch(proxy_port, origin, f"/malformed/{part}")
+        assert response.startswith(b"HTTP/1.1 502")
+
+    @pytest.mark.timeout(10)
+    def test_chunked_body_streamed(self, proxy_port, origin):
+        """Test a chunked response is relayed with its framing intact"""
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+        sock.sendall(get_request(origin, "/chunked/250000"))
+        response, _ = read_response(sock)
+        # The connection is still usable afterwards
+        sock.sendall(get_request(origin, "/chunked/10"))
+        second, _ = read_response(sock)
+        sock.close()
+
+        head, _, body = response.partition(b"\r\n\r\n")
+        assert b"Transfer-Encoding: chunked" in head
+        assert body.endswith(b"0\r\n\r\n")
+        assert body.count(b"y") == 250000
+        assert second.startswith(b"HTTP/1.1 200")
+
+    @pytest.mark.timeout(10)
+    def test_slow_reader_gets_whole_body(self, proxy_port, origin):
+        """Test a client reading slowly still receives every byte"""
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=10)
+        sock.sendall(
+            get_request(origin, "/size/3000000", "Connection: close\r\n")
+        )
+        received = 0
+        while True:
+            data = sock.recv(8192)
+            if not data:
+                break
+            received += len(data)
+            if received < 1000000:
+                time.sleep(0.001)
+        sock.close()
+        assert received > 3000000
+
+    @pytest.mark.timeout(10)
+    def test_slow_origin_does_not_block_worker(self, proxy_port, origin):
+        """Test a fast request completes while a slow one is in flight"""
+        slow = threading.Thread(
+            target=fetch, args=(proxy_port, origin, "/slow")
+        )
+        slow.start()
+        time.sleep(0.2)
+        start = time.monotonic()
+        response = fetch(proxy_port, origin, "/")
+        elapsed = time.monotonic() - start
+        slow.join()
+        assert response.startswith(b"HTTP/1.1 200")
+        assert elapsed < 1.0
+
+    @pytest.mark.timeout(10)
+    def test_unreachable_upstream_returns_502(self, proxy_port):
+        """Test a refused upstream connect is reported as 502"""
+        response = fetch(proxy_port, free_port(), "/")
+        assert response.startswith(b"HTTP/1.1 502 Bad Gateway")
+
+    @pytest.mark.timeout(10)
+    def test_upstream_connection_reused(self, proxy_port, origin):
+        """Test consecutive requests to one origin share a connection"""
+        for name in ("first", "second", "third"):
+            response = fetch(proxy_port, origin, f"/reuse/{name}")
+            assert response.endswith(b"hello from origin")
+
+        peers = {
+            OriginHandler.peers_seen[f"reuse/{name}"]
+            for name in ("first", "second", "third")
+        }
+        assert len(peers) == 1
+
+    @pytest.mark.timeout(10)
+    def test_origin_dropping_pooled_connection(self, proxy_port, origin):
+        """Test a pooled connection closed by the origin is not used"""
+        first = fetch(proxy_port, origin, "/drop/first")
+        second = fetch(proxy_port, origin, "/drop/second")
+
+        assert first.endswith(b"hello from origin")
+        assert second.endswith(b"hello from origin")
+
+    @pytest.mark.timeout(10)
+    def test_stale_pooled_connection_retried(self, proxy_port):
+        """Test a request the origin drops on a reused connection is resent"""
+        listener = socket.create_server(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        reply = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+        def serve():
+            # Answer once, then drop the reused connection unanswered
+            first, _ = listener.accept()
+            first.recv(65536)
+            first.sendall(reply)
+            first.recv(65536)
+            first.close()
+            fresh, _ = listener.accept()
+            fresh.recv(65536)
+            fresh.sendall(reply)
+            fresh.close()
+
+        server = threading.Thread(target=serve, daemon=True)
+        server.start()
+        try:
+            assert fetch(proxy_port, port, "/stale/1").endswith(b"ok")
+            assert fetch(proxy_port, port, "/stale/2").endswith(b"ok")
+        finally:
+            server.join(timeout=5)
+            listener.close()
+
+    @pytest.mark.timeout(10)
+    def test_hostname_resolved_by_worker(self, proxy_port, origin):
+        """Test an upstream given by name is resolved and proxied"""
+        response = fetch(proxy_port, origin, "/named", host="localhost")
+        assert response.startswith(b"HTTP/1.1 200")
+
+    @pytest.mark.timeout(10)
+    def test_unresolvable_host_returns_502(self, proxy_port):
+        """Test a name that does not resolve is reported as 502"""
+        response = fetch(proxy_port, 80, "/", host="no-such-host.invalid")
+        assert response.startswith(b"HTTP/1.1 502 Bad Gateway")
+
+
+class TestResponseCaching:
+    """Test repeat GETs are served from the worker's cache"""
+
+    @pytest.mark.timeout(10)
+    def test_repeat_get_served_from_cache(self, proxy_port, origin):
+        """Test the second GET for a URL does not reach the origin"""
+        first = fetch(proxy_port, origin, "/cached/asset.js")
+        second = fetch(proxy_port, origin, "/cached/asset.js")
+
+        assert first == second
+        assert first.startswith(b"HTTP/1.1 200")
+        assert OriginHandler.requests_seen["cached/asset.js"] == 1
+
+    @pytest.mark.timeout(10)
+    def test_distinct_urls_cached_separately(self, proxy_port, origin):
+        """Test different URLs get different cache entries"""
+        fetch(proxy_port, origin, "/cached/a")
+        fetch(proxy_port, origin, "/cached/b")
+        fetch(proxy_port, origin, "/cached/a")
+
+        assert OriginHandler.requests_seen["cached/a"] == 1
+        assert OriginHandler.requests_seen["cached/b"] == 1
+
+
+class TestCacheControl:
+    """Test Cache-Control and Vary decide what is cached and for how long"""
+
+    @pytest.mark.timeout(10)
+    def test_max_age_overrides_default_ttl(self, origin):
+        """Test a response's max-age keeps it fresh past cache_ttl"""
+        with running_worker(cache_backend="local", cache_ttl=0) as port:
+            fetch(port, origin, "/cc/max-age/60")
+            fetch(port, origin, "/cc/max-age/60")
+
+        assert OriginHandler.requests_seen["cc/max-age/60"] == 1
+
+    @pytest.mark.timeout(10)
+    def test_no_store_response_not_cached(self, proxy_port, origin):
+        """Test a no-store response goes to the origin every time"""
+        fetch(proxy_port, origin, "/cc/no-store/")
+        fetch(proxy_port, origin, "/cc/no-store/")
+
+        assert OriginHandler.requests_seen["cc/no-store/"] == 2
+
+    @pytest.mark.timeout(10)
+    def test_request_no_cache_refetches(self, proxy_port, origin):
+        """Test a client's no-cache bypasses and refreshes the entry"""
+        fetch(proxy_port, origin, "/cc/reload")
+        fetch(proxy_port, origin, "/cc/reload",
+              extra="Cache-Control: no-cache\r\n")
+        fetch(proxy_port, origin, "/cc/reload")
+
+        assert OriginHandler.requests_seen["cc/reload"] == 2
+
+    @pytest.mark.timeout(10)
+    def test_authorized_request_not_cached(self, proxy_port, origin):
+        """Test responses to requests with credentials are not shared"""
+        for _ in range(2):
+            fetch(proxy_port, origin, "/cc/private",
+                  extra="Authorization: Basic dXNlcjpwYXNz\r\n")
+
+        assert OriginHandler.requests_seen["cc/private"] == 2
+
+    @pytest.mark.timeout(10)
+    def test_vary_variants_cached_separately(self, proxy_port, origin):
+        """Test each Accept-Language gets its own cached variant"""
+        bodies = []
+        for language in ("en", "fr", "en", "fr"):
+            response = fetch(proxy_port, origin, "/cc/vary/",
+                             extra=f"Accept-Language: {language}\r\n")
+            bodies.append(response.partition(b"\r\n\r\n")[2])
+
+        assert bodies == [b"en", b"fr", b"en", b"fr"]
+        assert OriginHandler.requests_seen["cc/vary/"] == 2
+
+
+class TestDiskCacheTier:
+    """Test large responses are cached on disk and served with sendfile"""
+
+    @pytest.mark.timeout(10)
+    def test_large_response_served_from_disk(self, origin, tmp_path):
+        """Test a response over the memory limit is cached on disk"""
+        with running_worker(
+            cache_backend="local",
+            cache_max_object_size=1000,
+            disk_cache_dir=str(tmp_path),
+        ) as port:
+            first = fetch(port, origin, "/disk/size/500000")
+            second = fetch(port, origin, "/disk/size/500000")
+
+        assert first == second
+        assert len(first.partition(b"\r\n\r\n")[2]) == 500000
+        assert OriginHandler.requests_seen["disk/size/500000"] == 1
+
+
+class TestRevalidation:
+    """Test expired entries are revalidated and served stale"""
+
+    @pytest.mark.timeout(10)
+    def test_expired_entry_revalidated(self, origin):
+        """Test a 304 answers the client from the expired entry"""
+        with running_worker(cache_backend="local", cache_ttl=0) as port:
+            first = fetch(port, origin, "/reval/etag/100")
+            second = fetch(port, origin, "/reval/etag/100")
+
+        assert second.startswith(b"HTTP/1.1 200")
+        assert second.endswith(b"\r\n\r\n" + b"e" * 100)
+        assert first.partition(b"\r\n\r\n")[2] == b"e" * 100
+        assert OriginHandler.validators_seen["reval/etag/100"] == [
+            None, '"v1"'
+        ]
+
+    @pytest.mark.timeout(10)
+    def test_expired_disk_entry_revalidated(self, origin, tmp_path):
+        """Test a 304 refreshes an entry in the disk tier"""
+        with running_worker(
+            cache_backend="local",
+            cache_ttl=0,
+            cache_max_object_size=1000,
+            disk_cache_dir=str(tmp_path),
+        ) as port:
+            fetch(port, origin, "/revaldisk/etag/500000")
+            second = fetch(port, origin, "/revaldisk/etag/500000")
+
+        assert second.startswith(b"HTTP/1.1 200")
+        assert second.endswith(b"\r\n\r\n" + b"e" * 500000)
+        assert OriginHandler.validators_seen["revaldisk/etag/500000"] == [
+            None, '"v1"'
+        ]
+
+    @pytest.mark.timeout(10)
+    def test_stale_while_revalidate(self, origin):
+        """Test a stale entry is served and revalidated in the background"""
+        with running_worker(
+            cache_backend="local", cache_ttl=0, cache_stale_while_revalidate=60
+        ) as port:
+            fetch(port, origin, "/swr/etag/100")
+            second = fetch(port, origin, "/swr/etag/100")
+            for _ in range(50):
+                if len(OriginHandler.validators_seen["swr/etag/100"]) == 2:
+                    break
+                time.sleep(0.05)
+
+        assert second.endswith(b"\r\n\r\n" + b"e" * 100)
+        assert OriginHandler.validators_seen["swr/etag/100"] == [
+            None, '"v1"'
+        ]
+
+    @pytest.mark.timeout(10)
+    def test_stale_if_error(self, origin):
+        """Test a stale entry is served when revalidation fails"""
+        with running_worker(
+            cache_backend="local", cache_ttl=0, cache_stale_if_error=60
+        ) as port:
+            fetch(port, origin, "/sie/flaky/")
+            second = fetch(port, origin, "/sie/flaky/")
+        with running_worker(cache_backend="local", cache_ttl=0) as port:
+            fetch(port, origin, "/nosie/flaky/")
+            failed = fetch(port, origin, "/nosie/flaky/")
+
+        assert OriginHandler.requests_seen["sie/flaky/"] == 2
+        assert second.startswith(b"HTTP/1.1 200")
+        assert second.endswith(b"hello from origin")
+        assert failed.startswith(b"HTTP/1.1 500")
+
+
+class TestClientKeepAlive:
+    """Test persistent and pipelined client connections"""
+
+    @pytest.mark.timeout(10)
+    def test_requests_share_client_connection(self, proxy_port, origin):
+        """Test an HTTP/1.1 client can send several requests on one socket"""
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+        for path in ("/keep/a", "/keep/b", "/keep/a"):
+            sock.sendall(get_request(origin, path))
+            response, extra = read_response(sock)
+            assert response.startswith(b"HTTP/1.1 200")
+            assert b"Connection: keep-alive" in response
+            assert response.endswith(b"hello from origin")
+            assert extra == b""
+        sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_pipelined_requests_answered_in_order(self, proxy_port, origin):
+        """Test requests sent back to back get responses in order"""
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+        sizes = [10, 5000, 20]
+        sock.sendall(
+            b"".join(get_request(origin, f"/size/{n}") for n in sizes)
+        )
+        extra = b""
+        for n in sizes:
+            response, extra = read_response(sock, extra)
+            assert response.endswith(b"\r\n\r\n" + b"x" * n)
+        sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_connection_close_honoured(self, proxy_port, origin):
+        """Test Connection: close ends the connection after the response"""
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+        sock.sendall(
+            get_request(origin, "/keep/close", "Connection: close\r\n")
+        )
+        response, _ = read_response(sock)
+        assert b"Connection: close" in response
+        assert sock.recv(1) == b""
+        sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_http10_closes_by_default(self, proxy_port, origin):
+        """Test an HTTP/1.0 client without keep-alive is disconnected"""
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+        sock.sendall(
+            f"GET http://127.0.0.1:{origin}/keep/old HTTP/1.0\r\n"
+            f"Host: 127.0.0.1:{origin}\r\n\r\n".encode()
+        )
+        response, _ = read_response(sock)
+        assert b"Connection: close" in response
+        assert sock.recv(1) == b""
+        sock.close()
+
+
+class TestMalformedRequests:
+    """Test requests the parser refuses are answered, not dropped"""
+
+    engine = "selectors"
+
+    def exchange(self, proxy_port, data):
+        sock = socket.create_connection(("127.0.0.1", proxy_port), timeout=5)
+        sock.sendall(data)
+        response, _ = read_response(sock)
+        assert sock.recv(1) == b""
+        sock.close()
+        return response
+
+    @pytest.mark.timeout(10)
+    def test_oversized_headers_return_431(self, proxy_port, origin):
+        """Test a header block over MAX_HEADER_SIZE gets 431"""
+        response = self.exchange(
+            proxy_port,
+            get_request(origin, "/", "X-Big: " + "x" * 70000 + "\r\n"),
+        )
+        assert response.startswith(b"HTTP/1.1 431")
+
+    @pytest.mark.timeout(10)
+    def test_bad_request_line_returns_400(self, proxy_port):
+        """Test a request line without a version gets 400"""
+        response = self.exchange(proxy_port, b"GET /\r\n\r\n")
+        assert response.startswith(b"HTTP/1.1 400")
+
+    @pytest.mark.timeout(10)
+    def test_missing_host_returns_400(self, proxy_port):
+        """Test an origin-form request without Host gets 400"""
+        response = self.exchange(proxy_port, b"GET / HTTP/1.1\r\n\r\n")
+        assert response.startswith(b"HTTP/1.1 400")
+
+    @pytest.mark.timeout(10)
+    def test_huge_content_length_returns_413(self, proxy_port, origin):
+        """Test a body over max_body_size is refused before it arrives"""
+        response = self.exchange(
+            proxy_port,
+            f"POST http://127.0.0.1:{origin}/ HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{origin}\r\n"
+            "Content-Length: 4000000000\r\n\r\nabc".encode(),
+        )
+        assert response.startswith(b"HTTP/1.1 413")
+
+    @pytest.mark.timeout(10)
+    def test_endless_chunked_body_returns_413(self, origin):
+        """Test a chunked body is cut off once it passes max_body_size"""
+        with running_worker(engine=self.engine, max_body_size=10000) as port:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.sendall(
+                f"POST http://127.0.0.1:{origin}/ HTTP/1.1\r\n"
+                f"Host: 127.0.0.1:{origin}\r\n"
+                "Transfer-Encoding: chunked\r\n\r\n".encode()
+            )
+            chunk = b"3e8\r\n" + b"x" * 1000 + b"\r\n"
+            for _ in range(20):
+                sock.sendall(chunk)
+            response, _ = read_response(sock)
+            sock.close()
+
+        assert response.startswith(b"HTTP/1.1 413")
+
+    @pytest.mark.timeout(10)
+    def test_non_ascii_length_returns_400(self, proxy_port, origin):
+        """Test a Content-Length of non-ASCII digits gets 400"""
+        response = self.exchange(
+            proxy_port,
+            f"POST http://127.0.0.1:{origin}/ HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{origin}\r\n"
+            "Content-Length: \xb2\r\n\r\nab".encode("latin-1"),
+        )
+        assert response.startswith(b"HTTP/1.1 400")
+
+    @pytest.mark.timeout(10)
+    @pytest.mark.parametrize("size", ["-5", "0x5", "+5", "1_0"])
+    def test_bad_chunk_size_returns_400(self, proxy_port, origin, size):
+        """Test a chunk size that is not plain hex gets 400, not a hang"""
+        response = self.exchange(
+            proxy_port,
+            f"POST http://127.0.0.1:{origin}/ HTTP/1.1\r\n"
+            f"Host: 127.0.0.1:{origin}\r\n"
+            f"Transfer-Encoding: chunked\r\n\r\n{size}\r\nhello\r\n".encode(),
+        )
+        assert response.startswith(b"HTTP/1.1 400")
+        assert fetch(proxy_port, origin, "/").startswith(b"HTTP/1.1 200")
+
+
+class TestCollapsedForwarding:
+    """Test concurrent misses for one URL share a single upstream fetch"""
+
+    def fetch_concurrently(self, proxy_port, origin, path, count, extras=()):
+        responses = [None] * count
+
+        def run(i):
+            extra = extras[i] if extras else ""
+            responses[i] = fetch(proxy_port, origin, path, extra=extra)
+
+        threads = [
+            threading.Thread(target=run, args=(i,)) for i in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    @pytest.mark.timeout(10)
+    def test_concurrent_misses_collapsed(self, proxy_port, origin):
+        """Test only the first of several concurrent misses reaches origin"""
+        responses = self.fetch_concurrently(
+            proxy_port, origin, "/collapse/slow", 4
+        )
+        assert OriginHandler.requests_seen["collapse/slow"] == 1
+        for response in responses:
+            assert response.startswith(b"HTTP/1.1 200")
+            assert response.endswith(b"hello from origin")
+
+    @pytest.mark.timeout(10)
+    def test_followers_streamed_as_response_arrives(self, proxy_port, origin):
+        """Test followers receive a slowly arriving body in full"""
+        responses = self.fetch_concurrently(
+            proxy_port, origin, "/collapse/trickle/40000", 3
+        )
+        assert OriginHandler.requests_seen["collapse/trickle/40000"] == 1
+        for response in responses:
+            assert response.startswith(b"HTTP/1.1 200")
+            assert response.endswith(b"\r\n\r\n" + b"z" * 40000)
+
+    @pytest.mark.timeout(10)
+    def test_followers_of_other_variants_refetched(self, proxy_port, origin):
+        """Test a Vary response is only shared with matching followers"""
+        extras = [f"Accept-Language: {lang}\r\n" for lang in "aab"]
+        responses = self.fetch_concurrently(
+            proxy_port, origin, "/collapse/vary/slow", 3, extras
+        )
+        bodies = sorted(r.partition(b"\r\n\r\n")[2] for r in responses)
+        assert bodies == [b"a", b"a", b"b"]
+        assert OriginHandler.requests_seen["collapse/vary/slow"] == 2
+
+    @pytest.mark.timeout(10)
+    def test_followers_survive_leader_disconnect(self, proxy_port, origin):
+        """Test a follower takes over when the leading client goes away"""
+        request = get_request(origin, "/handover/trickle/40000")
+        leader = socket.create_connection(("127.0.0.1", proxy_port))
+        leader.sendall(request)
+        time.sleep(0.1)
+        follower = socket.create_connection(
+            ("127.0.0.1", proxy_port), timeout=5
+        )
+        follower.sendall(request)
+        time.sleep(0.1)
+        # Reset the leader's connection instead of closing it cleanly
+        leader.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+        )
+        leader.close()
+
+        response, _ = read_response(follower)
+        follower.close()
+        assert response.endswith(b"\r\n\r\n" + b"z" * 40000)
+        assert OriginHandler.requests_seen["handover/trickle/40000"] == 1
+
+    def test_late_follower_with_backlog(self):
+        """Test a late follower's backlog does not stop the leader growing"""
+        head = b"HTTP/1.1 200 OK\r\nContent-Length: 400010\r\n\r\n"
+        body = bytes(range(256)) * 1562 + b"x" * 128
+        selector = selectors.DefaultSelector()
+        ctx = create_context(0, ProxyConfig(), selector, None, None)
+        leader = Connection(None, ("127.0.0.1", 0), cache_key="k")
+        leader.state = ConnectionState.RECV_UPSTREAM
+        leader.cache_response = bytearray(head + body)
+        ctx.collapsed["k"] = leader
+        writer, reader = socket.socketpair()
+        # Too small for what the leader has collected so far
+        writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        writer.setblocking(False)
+        follower = Connection(writer, ("127.0.0.1", 0), cache_key="k")
+        try:
+            assert join_collapsed(follower, ctx)
+            sent = follower.send_buffer.send(writer)
+            assert 0 < sent < len(head) + len(body)
+
+            collect_response(leader, ctx, b"0123456789")
+            assert leader.cache_response.endswith(b"0123456789")
+            received = b""
+            while follower.send_buffer:
+                try:
+                    follower.send_buffer.send(writer)
+                except BlockingIOError:
+                    pass
+                received += reader.recv(65536)
+            writer.close()
+            while True:
+                data = reader.recv(65536)
+                if not data:
+                    break
+                received += data
+            assert received.endswith(b"\r\n\r\n" + body)
+        finally:
+            writer.close()
+            reader.close()
+            ctx.resolver.close()
+            selector.close()
+
+
+class TestAccessLog:
+    """Test the per-request access log"""
+
+    @pytest.mark.timeout(15)
+    def test_requests_logged_with_phases(self, origin, tmp_path):
+        """Test a miss and a hit are logged with their cache outcome"""
+        path = tmp_path / "access.log"
+        with running_worker(access_log=str(path)) as port:
+            fetch(port, origin, "/logged/size/100")
+            fetch(port, origin, "/logged/size/100")
+            # The log is written by a background thread, in batches
+            for _ in range(50):
+                lines = path.read_text().splitlines() if path.exists() else []
+                if len(lines) == 2:
+                    break
+                time.sleep(0.1)
+
+        assert len(lines) == 2
+        miss, hit = lines
+        request = f'"GET http://127.0.0.1:{origin}/logged/size/100"'
+        assert f"{request} 200 " in miss
+        assert "cache=miss" in miss
+        assert "ttfb=-" not in miss
+        assert "cache=hit" in hit
+        assert "dns=- connect=- send=- ttfb=-" in hit
+
+
+class TestOverload:
+    """Test connections past max_connections are shed, not queued"""
+
+    engine = "selectors"
+
+    @pytest.mark.timeout(15)
+    def test_connections_past_limit_get_503(self, origin):
+        """Test a connection over the limit gets 503 and Retry-After"""
+        with running_worker(engine=self.engine, max_connections=2) as port:
+            held = []
+            while len(held) < 2:
+                # running_worker's own probe may not be closed yet
+                sock = socket.create_connection(("127.0.0.1", port), 5)
+                sock.sendall(get_request(origin, "/overload/held"))
+                response, _ = read_response(sock)
+                if response.startswith(b"HTTP/1.1 503"):
+                    sock.close()
+                    time.sleep(0.1)
+                    continue
+                assert response.startswith(b"HTTP/1.1 200")
+                held.append(sock)
+
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            response, _ = read_response(sock)
+            assert response.startswith(b"HTTP/1.1 503")
+            assert b"Retry-After: 1\r\n" in response
+            assert sock.recv(1) == b""
+            sock.close()
+
+            # A connection is let in again once one of the others closes
+            held.pop().close()
+            for _ in range(50):
+                response = fetch(port, origin, "/overload/again")
+                if not response.startswith(b"HTTP/1.1 503"):
+                    break
+                time.sleep(0.1)
+            assert response.startswith(b"HTTP/1.1 200")
+            for sock in held:
+                sock.close()
+
+    @pytest.mark.timeout(15)
+    def test_burst_accepted_across_batches(self, origin):
+        """Test a burst larger than accept_batch is served in full"""
+        with running_worker(engine=self.engine, accept_batch=1) as port:
+            socks = [
+                socket.create_connection(("127.0.0.1", port), timeout=5)
+                for _ in range(20)
+            ]
+            for sock in socks:
+                sock.sendall(get_request(origin, "/overload/burst"))
+            for sock in socks:
+                response, _ = read_response(sock)
+                assert response.startswith(b"HTTP/1.1 200")
+                sock.close()
+
+
+class TestTimeouts:
+    """Test stalled clients and origins are given up on"""
+
+    engine = "selectors"
+
+    @pytest.mark.timeout(10)
+    def test_silent_client_closed(self):
+        """Test a client that sends nothing is disconnected"""
+        with running_worker(
+            engine=self.engine, client_header_timeout=1
+        ) as port:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            started = time.monotonic()
+            assert sock.recv(1) == b""
+            assert time.monotonic() - started >= 0.9
+            sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_incomplete_request_gets_408(self, origin):
+        """Test a client that stops mid-request gets 408"""
+        with running_worker(
+            engine=self.engine, client_header_timeout=1
+        ) as port:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.sendall(get_request(origin, "/timeout/partial")[:20])
+            response, _ = read_response(sock)
+            assert response.startswith(b"HTTP/1.1 408")
+            assert sock.recv(1) == b""
+            sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_idle_keep_alive_closed(self, origin):
+        """Test a keep-alive client is disconnected once idle too long"""
+        with running_worker(
+            engine=self.engine, keep_alive_timeout=1
+        ) as port:
+            sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sock.sendall(get_request(origin, "/timeout/keep"))
+            response, _ = read_response(sock)
+            assert response.startswith(b"HTTP/1.1 200")
+            started = time.monotonic()
+            assert sock.recv(1) == b""
+            assert time.monotonic() - started >= 0.9
+            sock.close()
+
+    @pytest.mark.timeout(10)
+    def test_slow_origin_gets_504(self, origin):
+        """Test an origin slower than upstream_timeout is answered 504"""
+        with running_worker(
+            engine=self.engine, upstream_timeout=1
+        ) as port:
+            response = fetch(port, origin, "/timeout/slow")
+            assert response.startswith(b"HTTP/1.1 504")
+            # Origins that answer in time are unaffected
+            response = fetch(port, origin, "/timeout/size/10")
+            assert response.startswith(b"HTTP/1.1 200")